@@ -0,0 +1,235 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode:nil -*-
+# vi: set ft=python sts=4 sw=4 et:
+
+"""
+Cluster inference on meshes (or any graph given as CSR adjacency matrix).
+TFCE is computed by one union-find sweep over vertices sorted by value,
+cluster extents of many maps are labeled by one connected components call.
+"""
+
+import numpy as np
+from . import mesh_tools
+
+
+def tfce(adjacency, statmap, E = 0.5, H = 2.0, dh = 0.1, weights = None, tail = 'positive'):
+    """
+    Threshold-free cluster enhancement
+    tfce(v) = sum(h->h_k <= stat(v)) e(h)^E*h^H*dh, e(h) is the extent of cluster containing v at threshold h
+    Vertices are added in descending order of value and merged by union-find,
+    extents of clusters only change when vertices are added, so contributions of all height steps are settled lazily on cluster roots.
+
+    Parameters:
+    -----------
+    adjacency: CSR adjacency matrix
+    statmap: statistic map, n_vertex array
+    E: extent exponent, by default is 0.5
+    H: height exponent, by default is 2.0
+    dh: height step, by default is 0.1
+    weights: extent of each vertex, e.g. vertex areas, by default is None, which uses 1
+    tail: 'positive', 'negative' or 'both'
+          'negative' enhances -statmap, 'both' enhances each sign separately and keeps the sign
+
+    Return:
+    -------
+    tfcemap: enhanced map
+
+    Example:
+    --------
+    >>> tfcemap = tfce(mesh.adjacency, tmap, weights = mesh.vertex_areas)
+    """
+    statmap = np.asarray(statmap, dtype = np.float64).ravel()
+    if tail == 'positive':
+        return _tfce_positive(adjacency, statmap, E, H, dh, weights)
+    elif tail == 'negative':
+        return _tfce_positive(adjacency, -statmap, E, H, dh, weights)
+    elif tail == 'both':
+        return _tfce_positive(adjacency, statmap, E, H, dh, weights) - _tfce_positive(adjacency, -statmap, E, H, dh, weights)
+    else:
+        raise Exception("tail should be 'positive', 'negative' or 'both'")
+
+def _tfce_positive(adjacency, statmap, E, H, dh, weights):
+    """
+    TFCE of positive part of statmap
+    """
+    n_vertex = statmap.size
+    tfcemap = np.zeros(n_vertex)
+    valid = np.isfinite(statmap) & (statmap >= dh)
+    if not np.any(valid):
+        return tfcemap
+    if weights is None:
+        weights = np.ones(n_vertex)
+    weights = np.asarray(weights, dtype = np.float64).ravel()
+    # stepsum[k] = sum(h_i^H*dh) of the first k height steps, height step of vertex v is floor(stat(v)/dh)
+    n_step = int(np.floor(statmap[valid].max()/dh))
+    steps = dh*np.arange(1, n_step+1)
+    stepsum = np.concatenate(([0.0], np.cumsum(steps**H*dh)))
+    cumheight = stepsum[np.minimum(np.floor(statmap[valid]/dh).astype(np.int64), n_step)]
+    order = np.argsort(-statmap[valid], kind = 'stable')
+    vertices = np.flatnonzero(valid)[order].tolist()
+    cumheight = cumheight[order].tolist()
+
+    indptr = adjacency.indptr.tolist()
+    indices = adjacency.indices.tolist()
+    weights = weights.tolist()
+    parent = list(range(n_vertex))
+    # score of vertex v is the sum of offset along the path from v to its root
+    offset = [0.0]*n_vertex
+    extent = [0.0]*n_vertex
+    rank = [0]*n_vertex
+    lastheight = [0.0]*n_vertex
+    added = [False]*n_vertex
+
+    def find(x):
+        path = []
+        while parent[x] != x:
+            path.append(x)
+            x = parent[x]
+        # compress path from the node nearest to root, offsets are accumulated up to the root
+        acc = 0.0
+        for node in reversed(path):
+            acc += offset[node]
+            offset[node] = acc
+            parent[node] = x
+        return x
+
+    for v, ch in zip(vertices, cumheight):
+        added[v] = True
+        extent[v] = weights[v]
+        lastheight[v] = ch
+        for u in indices[indptr[v]:indptr[v+1]]:
+            if not added[u]:
+                continue
+            ru = find(u)
+            rv = find(v)
+            if ru == rv:
+                continue
+            # settle contributions of both clusters down to the current height
+            offset[ru] += extent[ru]**E*(lastheight[ru]-ch)
+            offset[rv] += extent[rv]**E*(lastheight[rv]-ch)
+            if rank[ru] < rank[rv]:
+                ru, rv = rv, ru
+            parent[rv] = ru
+            offset[rv] -= offset[ru]
+            extent[ru] += extent[rv]
+            lastheight[ru] = ch
+            if rank[ru] == rank[rv]:
+                rank[ru] += 1
+    for v in vertices:
+        if parent[v] == v:
+            offset[v] += extent[v]**E*lastheight[v]
+    for v in vertices:
+        root = find(v)
+        tfcemap[v] = offset[v] if root == v else offset[v] + offset[root]
+    return tfcemap
+
+def cluster_extent(adjacency, statmaps, threshold, weights = None):
+    """
+    Extent of supra-threshold clusters, all maps are labeled in one connected components call
+
+    Parameters:
+    -----------
+    adjacency: CSR adjacency matrix
+    statmaps: statistic maps, n_vertex or n_vertex x n_map
+    threshold: cluster forming threshold, vertices with statistic > threshold are clustered
+    weights: extent of each vertex, e.g. vertex areas, by default is None, which uses 1
+
+    Return:
+    -------
+    extentmap: extent of the cluster containing each vertex, 0 outside clusters, same shape as statmaps
+    maxextent: maximum cluster extent of each map
+
+    Example:
+    --------
+    >>> extentmap, maxextent = cluster_extent(mesh.adjacency, tmap, 2.3)
+    """
+    statmaps = np.asarray(statmaps)
+    outshape = statmaps.shape
+    statmaps = statmaps.reshape(statmaps.shape[0], -1)
+    n_vertex, n_map = statmaps.shape
+    labels, _ = mesh_tools.connected_components(adjacency, statmaps > threshold)
+    if weights is None:
+        weights = np.ones(n_vertex)
+    weights = np.broadcast_to(np.asarray(weights, dtype = np.float64).reshape(n_vertex, 1), labels.shape)
+    inside = labels >= 0
+    extents = np.bincount(labels[inside], weights[inside])
+    extentmap = np.zeros(labels.shape)
+    extentmap[inside] = extents[labels[inside]]
+    maxextent = extentmap.max(axis = 0) if n_vertex else np.zeros(n_map)
+    return extentmap.reshape(outshape), maxextent
+
+def one_sample_t(data):
+    """
+    One sample t statistic of each row
+
+    Parameters:
+    -----------
+    data: n_vertex x n_subj data
+
+    Return:
+    -------
+    tmap: t value of each vertex
+    """
+    data = np.asarray(data, dtype = np.float64)
+    n_subj = data.shape[1]
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return np.mean(data, axis = 1)/(np.std(data, axis = 1, ddof = 1)/np.sqrt(n_subj))
+
+def permutation_fwe(adjacency, data, method = 'tfce', n_perm = 1000, threshold = None, weights = None, seed = None, **tfceparams):
+    """
+    FWE corrected one sample test on mesh by sign flipping permutation
+    The maximum of enhanced statistic (tfce) or cluster extent (cluster) over vertices builds the null distribution
+
+    Parameters:
+    -----------
+    adjacency: CSR adjacency matrix
+    data: n_vertex x n_subj data, e.g. contrast maps of subjects
+    method: 'tfce' or 'cluster'
+    n_perm: permutation number, by default is 1000
+    threshold: cluster forming threshold of t values, needed by method 'cluster'
+    weights: extent of each vertex, e.g. vertex areas, by default is None, which uses 1
+    seed: seed of random sign flipping
+    tfceparams: E, H, dh and tail passed to tfce
+
+    Return:
+    -------
+    tmap: one sample t map
+    scoremap: enhanced map (tfce) or cluster extent map (cluster)
+    pmap: FWE corrected p value of each vertex
+    nullmax: maximum of each permutation
+
+    Example:
+    --------
+    >>> tmap, tfcemap, pmap, nullmax = permutation_fwe(mesh.adjacency, copes, 'tfce', 5000, weights = mesh.vertex_areas)
+    """
+    data = np.asarray(data, dtype = np.float64)
+    n_vertex, n_subj = data.shape
+    if method == 'cluster' and threshold is None:
+        raise Exception('threshold is needed by cluster method')
+    if method not in ('tfce', 'cluster'):
+        raise Exception("method should be 'tfce' or 'cluster'")
+    rng = np.random.default_rng(seed)
+    flips = np.where(rng.random((n_perm, n_subj)) < 0.5, -1.0, 1.0)
+    # sign flipping keeps sum of squares, so t values of all flips come from one matrix product
+    sumsq = np.sum(data**2, axis = 1, keepdims = True)
+
+    def tvalues(signs):
+        mean = np.dot(data, signs.T)/n_subj
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            std = np.sqrt(np.maximum(sumsq - n_subj*mean**2, 0)/(n_subj-1))
+            return mean/(std/np.sqrt(n_subj))
+
+    tmap = one_sample_t(data)
+    if method == 'tfce':
+        score = lambda tmaps: np.column_stack([tfce(adjacency, t, weights = weights, **tfceparams) for t in tmaps.T])
+    else:
+        score = lambda tmaps: cluster_extent(adjacency, tmaps, threshold, weights)[0]
+    scoremap = score(tmap[:, np.newaxis])[:, 0]
+    nullmax = np.zeros(n_perm)
+    chunksize = 100
+    for start in range(0, n_perm, chunksize):
+        nullscore = score(tvalues(flips[start:start+chunksize]))
+        nullmax[start:start+chunksize] = np.max(np.abs(nullscore), axis = 0)
+    # number of permutations with maximum not less than score of each vertex
+    exceed = n_perm - np.searchsorted(np.sort(nullmax), np.abs(scoremap), side = 'left')
+    pmap = (exceed + 1.0)/(n_perm + 1.0)
+    return tmap, scoremap, pmap, nullmax
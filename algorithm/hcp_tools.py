@@ -5,6 +5,7 @@ import math
 import numpy as np
 import os
 import csv
+import fnmatch
 from ATT.iofunc import iofiles
 from ATT.algorithm import surf_tools
 import pandas as pd
@@ -15,15 +16,276 @@ stem_path = 'e:\\projects\\genetic_imaging\\HCPdata\\HCP900'
 output_stem_path = 'E:\\projects\\genetic_imaging\\testResults'
  
 
+# options of data types, used to build file paths of HCP data
+func_stem_path = os.path.join('MNINonLinear', 'Results', 'tfMRI_WM')
+cope_folders = {'body-avg': 'cope19.feat', 'face-avg': 'cope20.feat', 'place-avg': 'cope21.feat', 'tool-avg': 'cope22.feat'}
+func_data_types = {'t': 'tstat1.dtseries.nii', 'beta': 'cope1.dtseries.nii'}
+stru_types = {'myelin': '.MyelinMap_MSMAll.32k_fs_LR.dscalar.nii',
+              'curvature': '.curvature_MSMAll.32k_fs_LR.dscalar.nii',
+              'thickness': '.thickness_MSMAll.32k_fs_LR.dscalar.nii'}
+brain_regions = {'left': '.L', 'right': '.R', 'whole': ''}
+other_types = ('motion', 'brain_size')
+
+
+class HCPManifest(object):
+    """
+    Manifest of files in HCP data directory (e.g. HCP900/HCP1200), scanned once and saved as a compact .npz table
+    Each file is a record of subject x modality x path x size x mtime.
+    Paths are stored as templates relative to subject folder with subject id replaced by {subject},
+    so templates are shared by subjects, a path is found by a binary search of (subject, template) code,
+    and the manifest could be used with a copy of HCP data in another directory.
+    Modified times of scanned folders are kept too, so adding or removing files makes the manifest stale (see is_stale).
+
+    Parameters:
+    -----------
+    subjects: subject ids
+    templates: path templates of files relative to subject folder
+    subject_code, template_code: subject and template position of each file
+    size: file size in bytes
+    mtime: modified time of file
+    folders: path templates of scanned folders, relative to subject folder ('' for subject folder)
+    folder_subject_code, folder_code, folder_mtime: subject, folder template position and modified time of each scanned folder
+    subdirs: folders in subject folder that were scanned, None for all
+
+    Example:
+    --------
+    >>> manifest = HCPManifest.scan(stem_path, subdirs = ['MNINonLinear', 'T1w'])
+    >>> manifest.save('hcp_manifest.npz')
+    >>> manifest = HCPManifest.load('hcp_manifest.npz')
+    >>> path_list = manifest.paths(stem_path, 'MNINonLinear/fsaverage_LR32k/{subject}.thickness_MSMAll.32k_fs_LR.dscalar.nii')
+    """
+    def __init__(self, subjects, templates, subject_code, template_code, size, mtime, folders, folder_subject_code, folder_code, folder_mtime, subdirs = None):
+        self.subjects = np.asarray(subjects, dtype = str)
+        self.templates = np.asarray(templates, dtype = str)
+        self.subject_code = np.asarray(subject_code, dtype = np.int32)
+        self.template_code = np.asarray(template_code, dtype = np.int32)
+        self.size = np.asarray(size, dtype = np.int64)
+        self.mtime = np.asarray(mtime, dtype = np.float64)
+        self.folders = np.asarray(folders, dtype = str)
+        self.folder_subject_code = np.asarray(folder_subject_code, dtype = np.int32)
+        self.folder_code = np.asarray(folder_code, dtype = np.int32)
+        self.folder_mtime = np.asarray(folder_mtime, dtype = np.float64)
+        self.subdirs = None if subdirs is None else list(subdirs)
+        self._template_pos = dict(zip(self.templates.tolist(), range(self.templates.size)))
+        # sorted (subject, template) keys of files for binary search
+        key = self.subject_code.astype(np.int64)*max(self.templates.size, 1) + self.template_code
+        self._order = np.argsort(key, kind = 'stable')
+        self._key = key[self._order]
+
+    @classmethod
+    def scan(cls, stem_path, subdirs = None):
+        """
+        Scan HCP data directory once
+
+        Parameters:
+        -----------
+        stem_path: HCP data directory
+        subdirs: folders in subject folder to be scanned, e.g. ['MNINonLinear', 'T1w'], by default is None, which scans all
+
+        Return:
+        -------
+        manifest: HCPManifest instance
+        """
+        subjects = _list_subjects(stem_path)
+        templates, folders = {}, {}
+        subject_code, template_code, size, mtime = [], [], [], []
+        folder_subject_code, folder_code, folder_mtime = [], [], []
+        for i, subj in enumerate(subjects):
+            subjpath = os.path.join(stem_path, subj)
+            if subdirs is None:
+                tovisit = [subjpath]
+            else:
+                tovisit = [os.path.join(subjpath, d) for d in subdirs if os.path.isdir(os.path.join(subjpath, d))]
+            while tovisit:
+                folder = tovisit.pop()
+                folder_subject_code.append(i)
+                folder_code.append(folders.setdefault(_path_template(folder, subjpath, subj), len(folders)))
+                folder_mtime.append(os.stat(folder).st_mtime)
+                for entry in os.scandir(folder):
+                    if entry.is_dir(follow_symlinks = False):
+                        tovisit.append(entry.path)
+                    elif entry.is_file():
+                        stat = entry.stat()
+                        subject_code.append(i)
+                        template_code.append(templates.setdefault(_path_template(entry.path, subjpath, subj), len(templates)))
+                        size.append(stat.st_size)
+                        mtime.append(stat.st_mtime)
+        templates = sorted(templates, key = templates.get)
+        folders = sorted(folders, key = folders.get)
+        return cls(subjects, templates, subject_code, template_code, size, mtime, folders, folder_subject_code, folder_code, folder_mtime, subdirs)
+
+    @classmethod
+    def load(cls, npzpath):
+        """
+        Load manifest saved by HCPManifest.save
+        """
+        npzdata = np.load(npzpath)
+        subdirs = npzdata['subdirs'].tolist() if npzdata['scan_all'] == 0 else None
+        return cls(npzdata['subjects'], npzdata['templates'], npzdata['subject_code'], npzdata['template_code'], npzdata['size'], npzdata['mtime'],
+                   npzdata['folders'], npzdata['folder_subject_code'], npzdata['folder_code'], npzdata['folder_mtime'], subdirs)
+
+    def save(self, npzpath):
+        """
+        Save manifest into compact .npz file
+        """
+        np.savez_compressed(npzpath, subjects = self.subjects, templates = self.templates,
+                            subject_code = self.subject_code, template_code = self.template_code, size = self.size, mtime = self.mtime,
+                            folders = self.folders, folder_subject_code = self.folder_subject_code, folder_code = self.folder_code, folder_mtime = self.folder_mtime,
+                            subdirs = np.asarray(self.subdirs if self.subdirs is not None else [], dtype = str), scan_all = int(self.subdirs is None))
+
+    @property
+    def n_file(self):
+        return self.subject_code.size
+
+    def is_stale(self, stem_path):
+        """
+        Check whether HCP data directory changed after scanning
+        Subject folders are listed again, scanned folders and files are checked by their modified time (and size), without listing folders
+
+        Parameters:
+        -----------
+        stem_path: HCP data directory, could be a copy of the scanned one
+
+        Return:
+        -------
+        stale: True if subjects are added or removed, files are added, removed or modified
+        """
+        if _list_subjects(stem_path) != self.subjects.tolist():
+            return True
+        records = [(self.folder_subject_code, self.folders[self.folder_code], None, self.folder_mtime),
+                   (self.subject_code, self.templates[self.template_code], self.size, self.mtime)]
+        for subjcode, templates, size, mtime in records:
+            for k, (i, template) in enumerate(zip(subjcode.tolist(), templates.tolist())):
+                try:
+                    stat = os.stat(_template_path(stem_path, self.subjects[i], template))
+                except OSError:
+                    return True
+                if (stat.st_mtime != mtime[k]) or ((size is not None) and (stat.st_size != size[k])):
+                    return True
+        return False
+
+    def modalities(self):
+        """
+        Modality of each path template, the first folder in subject folder, e.g. 'MNINonLinear', 'T1w'
+        """
+        return np.array([t.split('/')[0] for t in self.templates.tolist()])
+
+    def _find(self, template):
+        """
+        Position of file of template for each subject, -1 for subjects without the file
+        """
+        pos = np.full(self.subjects.size, -1, dtype = np.int64)
+        if template not in self._template_pos:
+            return pos
+        key = np.arange(self.subjects.size, dtype = np.int64)*self.templates.size + self._template_pos[template]
+        loc = np.searchsorted(self._key, key)
+        found = loc < self._key.size
+        found[found] = self._key[loc[found]] == key[found]
+        pos[found] = self._order[loc[found]]
+        return pos
+
+    def paths(self, stem_path, template, subjects = None):
+        """
+        Full paths of a path template for subjects
+
+        Parameters:
+        -----------
+        stem_path: HCP data directory that paths are resolved against, could be a copy of the scanned one
+        template: path template relative to subject folder, use {subject} for subject id and '/' as separator
+        subjects: subject ids, by default is None, which uses all subjects
+
+        Return:
+        -------
+        path_list: list of paths, None for subjects without the file
+        """
+        template = template.replace(os.sep, '/')
+        pos = self._find(template)
+        subjpos = dict(zip(self.subjects.tolist(), range(self.subjects.size)))
+        if subjects is None:
+            subjects = self.subjects.tolist()
+        path_list = []
+        for subj in subjects:
+            if (subj not in subjpos) or (pos[subjpos[subj]] < 0):
+                path_list.append(None)
+            else:
+                path_list.append(_template_path(stem_path, subj, template))
+        return path_list
+
+    def match_templates(self, pattern):
+        """
+        Path templates matching a shell-style pattern, e.g. 'MNINonLinear/Results/tfMRI_WM/*.feat/*'
+        """
+        return [t for t in self.templates.tolist() if fnmatch.fnmatchcase(t, pattern)]
+
+    def to_frame(self, pattern = None):
+        """
+        Manifest as pandas.DataFrame with columns subject, modality, path and size and mtime, path is relative to subject folder
+
+        Parameters:
+        -----------
+        pattern: shell-style pattern of path templates to be kept, by default is None, which keeps all files
+        """
+        keep = np.ones(self.n_file, dtype = bool)
+        if pattern is not None:
+            keep = np.isin(self.template_code, [self._template_pos[t] for t in self.match_templates(pattern)])
+        subj = self.subjects[self.subject_code[keep]]
+        templates = self.templates[self.template_code[keep]]
+        return pd.DataFrame({'subject': subj,
+                             'modality': self.modalities()[self.template_code[keep]],
+                             'path': [t.replace('{subject}', s) for s, t in zip(subj.tolist(), templates.tolist())],
+                             'size': self.size[keep],
+                             'mtime': self.mtime[keep]})
+
+def _list_subjects(stem_path):
+    """
+    Sorted subject ids, names of folders in HCP data directory
+    """
+    return sorted(e.name for e in os.scandir(stem_path) if e.is_dir())
+
+def _path_template(path, subjpath, subj):
+    """
+    Path template relative to subject folder, '/' separated, subject id is replaced by {subject}
+    """
+    relpath = os.path.relpath(path, subjpath)
+    if relpath == '.':
+        return ''
+    return relpath.replace(os.sep, '/').replace(subj, '{subject}')
+
+def _template_path(stem_path, subj, template):
+    """
+    Full path of a path template of a subject
+    """
+    parts = [p.replace('{subject}', subj) for p in template.split('/') if p]
+    return os.path.join(stem_path, subj, *parts)
+
+
 class get_hcp_data(object):
     """
     usage
-    >>>get_data = get_hcp_data(data_path)
-    >>>get_data.getsave_certain_data('func',label_data,output_stem_path,face-avg_t.csv)
+    >>>get_data = get_hcp_data(data_path, manifest = 'hcp_manifest.npz')
+    >>>get_data.getsave_certain_data('func',label_data,output_stem_path,'face-avg_t.csv', category = 'hp200_s4_level2', contrast = 'face-avg', datatype = 't')
+
+    if manifest is given, HCP directory is scanned at the first run and the manifest is saved, later runs query paths from the saved manifest
+    paths are resolved against stem_path, so a manifest could be used with a copy of HCP data in another directory
+    if check_stale is True, a manifest made before data changed is rescanned (see HCPManifest.is_stale)
+    motion data are not covered by manifest, see get_path_list
     """
-    def __init__(self,stem_path):
+    def __init__(self,stem_path,manifest = None,subdirs = None,check_stale = False):
         self.stem_path = stem_path
-        subid = os.listdir(stem_path) #get subjects' id according to to folder's name
+        self.manifest = None
+        if manifest is not None:
+            if os.path.isfile(manifest):
+                self.manifest = HCPManifest.load(manifest)
+                # rescan with the same folders if data changed after the manifest was made
+                if check_stale and self.manifest.is_stale(stem_path):
+                    self.manifest = HCPManifest.scan(stem_path, self.manifest.subdirs)
+                    self.manifest.save(manifest)
+            else:
+                self.manifest = HCPManifest.scan(stem_path, subdirs)
+                self.manifest.save(manifest)
+            subid = self.manifest.subjects.tolist()
+        else:
+            subid = _list_subjects(stem_path) #get subjects' id according to to folder's name, same as manifest
         self.subid = subid
 
     def motion_FD(self,path_list):
@@ -115,97 +377,92 @@ class get_hcp_data(object):
                 relative_meanRMS.append([])
         return relative_meanRMS
 
+    def func_categories(self):
+        """
+        Folders of different types of level2 results, e.g. tfMRI_WM_hp200_s4_level2.feat
+        """
+        if self.manifest is not None:
+            prefix = func_stem_path.replace(os.sep, '/')+'/'
+            return sorted(set(t[len(prefix):].split('/')[0] for t in self.manifest.match_templates(prefix+'*/*')))
+        return sorted(os.listdir(os.path.join(self.stem_path, self.subid[0], func_stem_path)))
+
+    def _paths(self, template):
+        """
+        Paths of a template ('/' separated, {subject} as subject id) for all subjects
+        Paths are got from manifest if it's given, nonexistent files in manifest are kept as their paths so loading them raises IOError
+        """
+        path_list = [_template_path(self.stem_path, i, template) for i in self.subid]
+        if self.manifest is not None:
+            found = self.manifest.paths(self.stem_path, template, self.subid)
+            path_list = [f if f is not None else p for f, p in zip(found, path_list)]
+        return path_list
+
     @decorators.timer
-    def get_path_list(self,file_type):
+    def get_path_list(self,file_type,category = None,contrast = 'face-avg',datatype = 't',structure = 'thickness',hemisphere = 'whole',other_type = 'motion'):
         """
         generate a list containing needed file path
         file_type: func
                    stru
                    other
+        category: func, level2 folder, full name or part of it, e.g. 'hp200_s4_level2' for *.hp200_s4_level2.feat, see func_categories()
+        contrast: func, 'body-avg', 'face-avg', 'place-avg' or 'tool-avg'
+        datatype: func, 't' for t value or 'beta'
+        structure: stru, 'myelin', 'curvature' or 'thickness'
+        hemisphere: stru, 'left', 'right' or 'whole'
+        other_type: other, 'motion' or 'brain_size'
+
+        paths of func, stru and brain_size files are looked up in manifest if it's given
+        motion paths are MNINonLinear/Results folders of subjects, motion_RMS/motion_FD read movement files of runs in them,
+        so they are not covered by manifest and are always built from stem_path
         """
         if file_type == 'func':
-
-            func_sample_path = os.path.join(self.stem_path, '100307', 'MNINonLinear', 'Results', 'tfMRI_WM')
-            func_stem_path = os.path.join('MNINonLinear', 'Results', 'tfMRI_WM')
-
-            catagory_num = int(input('''
-    please input the number of  catagoty you want:
-    1.*.hp200_s12_level12.feat 
-    2.*.hp200_s2_level2.feat 
-    3.*.hp200_s2_level2_MSMALL.feat
-    4.*.hp200_s4_level2.feat
-    5.*.hp200_s4_level2_MSMALL.feat
-    6.**.hp200_s8_level2.feat
-    --
-            '''))
-            datatype_num = int(input('please input the number of your data type:\n:1.t value 2.beta\n--'))
-            cope_num = int(input('''
-                        please input the contrast type
-                        1.body-avg
-                        2.face-avg
-                        3.place-avg
-                        4.tool-avg
-                        '''))
-
-            catagory = os.listdir(func_sample_path) #get different type of folders
-            cope_folders = ['cope19.feat', 'cope20.feat', 'cope21.feat', 'cope22.feat']
-            data_type =['tstat1.dtseries.nii','cope1.dtseries.nii']
-            self.catagory = catagory[catagory_num-1]
-
-            path_list = [os.path.join(self.stem_path,i, func_stem_path, catagory[catagory_num - 1], 'GrayordinatesStats',cope_folders[cope_num - 1],data_type[datatype_num-1]) for i in self.subid]
+            if category is None:
+                raise Exception('please give category, one of {0}'.format(self.func_categories()))
+            if contrast not in cope_folders:
+                raise Exception('contrast should be one of {0}'.format(sorted(cope_folders)))
+            if datatype not in func_data_types:
+                raise Exception('datatype should be one of {0}'.format(sorted(func_data_types)))
+            catagory = [c for c in self.func_categories() if c == category]
+            if not catagory:
+                catagory = [c for c in self.func_categories() if category+'.feat' in c]
+            if len(catagory) != 1:
+                raise Exception('category {0} does not match one of {1}'.format(category, self.func_categories()))
+            self.catagory = catagory[0]
+            path_list = self._paths('/'.join([func_stem_path.replace(os.sep, '/'), self.catagory, 'GrayordinatesStats', cope_folders[contrast], func_data_types[datatype]]))
 
         elif file_type == 'stru':
             self.catagory = ''
-            stru_type_num = int(input('''
-    please input the structure file you need (THE number) 
-    1.*.MyelinMap_MSMAll.32k_fs_LR.dscalar.nii
-    2.*.curvature_MSMAll.32k_fs_LR.dscalar.nii
-    3.*.thickness_MSMAll.32k_fs_LR.dscalar.nii
-    --
-            '''))
-            brain_region_num = int(input('''
-    please input number of your target region
-    1. left hemisphere
-    2. right hemishpere
-    3. whole brain
-    --
-             '''))
-
-            brain_region = ['.L','.R','']
-            stru_type = ['.MyelinMap_MSMAll.32k_fs_LR.dscalar.nii',
-                         '.curvature_MSMAll.32k_fs_LR.dscalar.nii',
-                         '.thickness_MSMAll.32k_fs_LR.dscalar.nii']
-
-            path_list  = [os.path.join(self.stem_path,i, 'MNINonLinear', 'fsaverage_LR32k',i+brain_region[brain_region_num-1]+stru_type[stru_type_num-1]) for i in self.subid]
-
+            if structure not in stru_types:
+                raise Exception('structure should be one of {0}'.format(sorted(stru_types)))
+            if hemisphere not in brain_regions:
+                raise Exception('hemisphere should be one of {0}'.format(sorted(brain_regions)))
+            path_list = self._paths('MNINonLinear/fsaverage_LR32k/{subject}'+brain_regions[hemisphere]+stru_types[structure])
 
         elif file_type == 'other':
-            other_type = int(input('''
-            please input the type of data you want
-            1.Motion
-            2.brain_size
-            '''))
-            if other_type == 1:
+            if other_type == 'motion':
                 self.other_type ='motion'
                 path_list = [os.path.join(self.stem_path,i,'MNINonLinear','Results') for i in self.subid]
-            elif other_type == 2:
+            elif other_type == 'brain_size':
                 self.other_type = 'brain_size'
-                path_list = [os.path.join(self.stem_path,i,'T1w',i,'stats','aseg.stats') for i in self.subid]
+                path_list = self._paths('T1w/{subject}/stats/aseg.stats')
+            else:
+                raise Exception('other_type should be one of {0}'.format(other_types))
         else:
             raise Exception('please input the right file type: func, stru, other')
         return path_list
 
     @decorators.timer
-    def getsave_certain_data(self,file_type,label_data,output_stem_path,output_filename):
+    def getsave_certain_data(self,file_type,label_data,output_stem_path,output_filename,**query):
         """
         
         :param file_type: the type of data you want to get. It can be 'func','stru',or 'other'
         :param label_data: matrix cantains label_data
         :param output_filename: the name of the csv file. eg. face-avg_t.csv
         :param output_stem_path: 
+        :param query: options of data passed to get_path_list, e.g. category, contrast, datatype, structure, hemisphere, other_type
         :return: nothing returned, only a csv file is created
         """
-        path_list = self.get_path_list(file_type)
+        path_list = self.get_path_list(file_type,**query)
         data_list = []
         if file_type == 'func' or file_type=='stru':
 
@@ -215,16 +472,22 @@ class get_hcp_data(object):
                 os.makedirs(output_path)
 
             avg_list = []
+            loaded = []
             for i in path_list:
                 try:
                     data = iofiles._CIFTI(i).load()
                     avg_list.append([np.average(data[0:59412]),np.average(data[0:29696]),np.average(data[29696:59412])]) # get global signal for whole brain ,left brian, and right brain
-                    data_list.append(surf_tools.get_signals(data, label_data))  # get roi mean value of each roi of each subject
+                    data_list.append(np.asarray(data, dtype = np.float32).ravel())
+                    loaded.append(True)
                 except IOError as e:
                     print(e)
                     avg_list.append([])
-                    data_list.append([])
-            pd_data_list = pd.DataFrame(data_list, index=self.subid, columns=list(range(1, 361)))
+                    loaded.append(False)
+            # get roi mean value of each roi of all subjects at once, subjects failed to load are kept as nan
+            roi_signals = np.full((len(path_list), 360), np.nan)
+            if data_list:
+                roi_signals[np.array(loaded)] = surf_tools.get_signals(np.column_stack(data_list), label_data, labelnum = 360)
+            pd_data_list = pd.DataFrame(roi_signals, index=self.subid, columns=list(range(1, 361)))
             avg_pd = pd.DataFrame(avg_list,index = self.subid,columns=['whole','left','right'])
             pd_data_list = pd.concat([pd_data_list,avg_pd],axis=1) #contact averaged roi signal and average global sigal
 
@@ -255,8 +518,8 @@ if __name__ == '__main__':
     import nibabel as nib
     label_img = nib.load('e:/coding/ATT/data/Q1-Q6_RelatedParcellation210.CorticalAreas_dil_Final_Final_Areas_Group_Colors.32k_fs_LR.dlabel.nii')
     label_data = label_img.get_data()[0]
-    get_data = get_hcp_data(stem_path)
-    get_data.getsave_certain_data('stru',label_data,output_stem_path,'curvature_msmall.csv')
+    get_data = get_hcp_data(stem_path, manifest = os.path.join(output_stem_path, 'hcp_manifest.npz'), subdirs = ['MNINonLinear', 'T1w'])
+    get_data.getsave_certain_data('stru',label_data,output_stem_path,'curvature_msmall.csv',structure = 'curvature',hemisphere = 'whole')
 
 
 
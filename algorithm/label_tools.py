@@ -0,0 +1,713 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode:nil -*-
+# vi: set ft=python sts=4 sw=4 et:
+
+"""
+Tools for label images.
+Label selection and relabeling are done by a lookup table indexed by label value,
+so the image is passed once no matter how many labels are requested.
+"""
+
+import numpy as np
+from scipy import sparse
+
+# label images with larger label values fall back to sorting based methods
+_MAX_LUT_SIZE = 2**24
+
+def _label_codes(image):
+    """
+    Convert label image into a compact non-negative integer array used to index lookup table
+
+    Return:
+    -------
+    codes: integer label array, None if image contains negative or non-integer labels
+    maxcode: maximum label value
+    """
+    image = np.asarray(image)
+    if image.size == 0:
+        return image.astype(np.uint8), 0
+    lo, hi = np.min(image), np.max(image)
+    if lo < 0 or not np.isfinite(hi) or hi > _MAX_LUT_SIZE:
+        return None, None
+    hi = int(hi)
+    if np.issubdtype(image.dtype, np.integer):
+        return image, hi
+    codes = image.astype(np.min_scalar_type(hi))
+    if not np.array_equal(codes, image):
+        return None, None
+    return codes, hi
+
+def label_mask(image, labellist):
+    """
+    Get a boolean mask of voxels/vertices whose labels are in labellist
+
+    Parameters:
+    -----------
+    image: label image
+    labellist: label or list of labels
+
+    Return:
+    -------
+    mask: boolean mask with the same shape as image
+
+    Example:
+    --------
+    >>> mask = label_mask(image, [1, 3, 5])
+    """
+    labels = np.unique(np.asarray(labellist).ravel())
+    codes, maxcode = _label_codes(image)
+    if codes is None:
+        return np.isin(image, labels)
+    lut = np.zeros(maxcode+1, dtype = bool)
+    labels = labels[(labels >= 0) & (labels <= maxcode)]
+    labels = labels[labels == np.floor(labels)]
+    lut[labels.astype(int)] = True
+    return lut[codes]
+
+def remap_labels(image, mapping, default = None):
+    """
+    Map labels of image into new labels
+
+    Parameters:
+    -----------
+    image: label image
+    mapping: dictionary as {old label: new label}, or a list of (old label, new label) pairs
+    default: value of labels not in mapping, by default is None, which keeps these labels unchanged
+
+    Return:
+    -------
+    outimage: relabeled image
+
+    Example:
+    --------
+    >>> outimage = remap_labels(image, {1: 2, 3: 2}, default = 0)
+    """
+    if isinstance(mapping, dict):
+        mapping = mapping.items()
+    mapping = list(mapping)
+    oldlabel = np.array([m[0] for m in mapping])
+    newlabel = np.array([m[1] for m in mapping])
+    outdtype = np.result_type(np.asarray(image).dtype, newlabel.dtype)
+    if default is not None:
+        outdtype = np.result_type(outdtype, np.min_scalar_type(default))
+    codes, maxcode = _label_codes(image)
+    if codes is None:
+        uniq, inverse = np.unique(image, return_inverse = True)
+        lut = uniq.astype(outdtype) if default is None else np.full(uniq.shape, default, dtype = outdtype)
+        loc = np.searchsorted(uniq, oldlabel)
+        found = (loc < uniq.size) & (uniq[np.minimum(loc, uniq.size-1)] == oldlabel)
+        lut[loc[found]] = newlabel[found]
+        return lut[inverse].reshape(np.shape(image))
+    if default is None:
+        lut = np.arange(maxcode+1).astype(outdtype)
+    else:
+        lut = np.full(maxcode+1, default, dtype = outdtype)
+    # labels out of the lookup table (negative, too large or non-integer) do not exist in image
+    inrange = (oldlabel >= 0) & (oldlabel <= maxcode) & (oldlabel == np.floor(oldlabel))
+    lut[oldlabel[inrange].astype(int)] = newlabel[inrange]
+    return lut[codes]
+
+def relabel_consecutive(image):
+    """
+    Relabel image into continuous label sequence (1, 2, ..., n), 0 is kept as background
+
+    Parameters:
+    -----------
+    image: label image
+
+    Return:
+    -------
+    relabelimg: relabeled image
+    rawlabel: original labels, rawlabel[i] is relabeled as i+1
+
+    Example:
+    --------
+    >>> relabelimg, rawlabel = relabel_consecutive(image)
+    """
+    codes, maxcode = _label_codes(image)
+    if codes is None:
+        rawlabel = np.unique(image)
+        rawlabel = rawlabel[rawlabel != 0]
+    else:
+        rawlabel = np.flatnonzero(np.bincount(codes.ravel(), minlength = maxcode+1))
+        rawlabel = rawlabel[rawlabel != 0]
+    newlabel = np.arange(1, rawlabel.size+1)
+    relabelimg = remap_labels(image, zip(rawlabel, newlabel), default = 0)
+    return relabelimg.astype(np.asarray(image).dtype), rawlabel
+
+def compact_labels(image):
+    """
+    Sorted unique labels of image and position of each voxel/vertex label in them
+
+    Parameters:
+    -----------
+    image: label image
+
+    Return:
+    -------
+    labels: sorted unique labels, background 0 included if present
+    positions: position of label of each voxel/vertex in labels, same shape as image
+
+    Example:
+    --------
+    >>> labels, positions = compact_labels(image)
+    """
+    codes, maxcode = _label_codes(image)
+    if codes is None:
+        labels, inverse = np.unique(image, return_inverse = True)
+        return labels, inverse.reshape(np.shape(image))
+    labels = np.flatnonzero(np.bincount(codes.ravel(), minlength = maxcode+1))
+    lut = np.zeros(maxcode+1, dtype = np.min_scalar_type(max(labels.size-1, 0)))
+    lut[labels] = np.arange(labels.size)
+    return labels.astype(np.asarray(image).dtype), lut[codes]
+
+def label_cooccurrence(image1, image2, return_positions = False):
+    """
+    Co-occurrence table of labels between two label images, counted by one bincount of combined label codes
+
+    Parameters:
+    -----------
+    image1, image2: label images with the same shape
+    return_positions: return positions of labels of each voxel/vertex or not, by default is False
+
+    Return:
+    -------
+    table: n_label1 x n_label2 array, voxel/vertex number labelled as labels1[i] in image1 and labels2[j] in image2
+    labels1, labels2: sorted unique labels of image1 and image2, background 0 included if present
+    positions1, positions2: position of label of each voxel/vertex in labels1 and labels2, see compact_labels,
+                            returned if return_positions is True
+
+    Example:
+    --------
+    >>> table, labels1, labels2 = label_cooccurrence(roidata, template)
+    >>> table, labels1, labels2, pos1, pos2 = label_cooccurrence(roidata, template, return_positions = True)
+    """
+    if np.shape(image1) != np.shape(image2):
+        raise Exception('image1 and image2 should have the same shape')
+    labels1, pos1 = compact_labels(image1)
+    labels2, pos2 = compact_labels(image2)
+    code = pos1.ravel().astype(np.int64)*labels2.size + pos2.ravel()
+    table = np.bincount(code, minlength = labels1.size*labels2.size).reshape(labels1.size, labels2.size)
+    if return_positions:
+        return table, labels1, labels2, pos1, pos2
+    return table, labels1, labels2
+
+def label_matrix(stack, labels, weights = None, average = False):
+    """
+    Sparse indicator matrix mapping vertices/voxels of a label stack onto labels of each subject
+    Row s*n_label+l marks the l-th label of subject s, column v*n_subj+s is the flat index of stack[v, s].
+    Then reduction of data with the same shape as stack into all labels of all subjects is one sparse product.
+
+    Parameters:
+    -----------
+    stack: label image (n_vertex) or label stack (n_vertex x n_subj)
+    labels: labels to compute, in order
+    weights: weights of vertices, n_vertex array, by default is None, which uses 1
+    average: normalize each row to sum 1 or not, by default is False
+             rows of empty labels keep zero
+
+    Return:
+    -------
+    matrix: (n_subj*n_label) x (n_vertex*n_subj) scipy.sparse CSR matrix
+
+    Example:
+    --------
+    >>> matrix = label_matrix(stack, [1, 2, 3], average = True)
+    >>> roimean = (matrix*data.ravel()).reshape(n_subj, 3)
+    """
+    stack = np.asarray(stack)
+    n_vertex = stack.shape[0]
+    stack = stack.reshape(n_vertex, -1)
+    n_subj = stack.shape[1]
+    labels = np.asarray(labels).ravel()
+    n_label = labels.size
+    # position of each label plus 1, 0 for unselected labels
+    position = remap_labels(stack, zip(labels, np.arange(1, n_label+1)), default = 0)
+    flatidx = np.flatnonzero(position)
+    vertex, subj = np.divmod(flatidx, n_subj)
+    rows = subj*n_label + position.ravel()[flatidx] - 1
+    if weights is None:
+        data = np.ones(flatidx.size)
+    else:
+        data = np.asarray(weights, dtype = float).ravel()[vertex]
+    matrix = sparse.csr_matrix((data, (rows, flatidx)), shape = (n_subj*n_label, n_vertex*n_subj))
+    if average:
+        rowsum = np.asarray(matrix.sum(axis = 1)).ravel()
+        rowsum[rowsum == 0] = 1
+        matrix = sparse.diags(1.0/rowsum)*matrix
+    return matrix.tocsr()
+
+REDUCE_METHODS = ('size', 'sum', 'mean', 'std', 'ste', 'max', 'min', 'peak', 'median', 'skewness', 'kurtosis')
+
+def label_reduce(data, stack, labels, method = 'mean'):
+    """
+    Reduce data into labels of all subjects at once
+    A label image shared by subjects is reduced by one label x vertex sparse product with the whole data matrix,
+    a label stack with one label image per subject is reduced through the flat label_matrix.
+
+    Parameters:
+    -----------
+    data: data, n_vertex or n_vertex x n_subj
+    stack: label image (n_vertex) shared by subjects, or label stack (n_vertex x n_subj)
+    labels: labels to compute, in order
+    method: 'size', 'sum', 'mean', 'std', 'ste', 'max', 'min', 'peak', 'median', 'skewness' or 'kurtosis'
+            'size' is the vertex number of each label, 'peak' is the vertex with maximum value (the first one if tied)
+            nan values in data are ignored
+
+    Return:
+    -------
+    meas: n_subj x n_label array, nan for labels absent or without valid values
+
+    Example:
+    --------
+    >>> roimean = label_reduce(data, glasser, np.arange(1, 361), 'mean')
+    """
+    if method not in REDUCE_METHODS:
+        raise Exception('method is not supported!')
+    data = np.asarray(data)
+    stack = np.asarray(stack)
+    n_vertex = data.shape[0]
+    if stack.shape[0] != n_vertex:
+        raise Exception('data and label stack are not match!')
+    data = data.reshape(n_vertex, -1)
+    stack = stack.reshape(n_vertex, -1)
+    n_subj = max(data.shape[1], stack.shape[1])
+    if (data.shape[1] not in (1, n_subj)) or (stack.shape[1] not in (1, n_subj)):
+        raise Exception('data and label stack are not match!')
+    labels = np.asarray(labels).ravel()
+    if stack.shape[1] == 1:
+        matrix = label_matrix(stack, labels)
+        data = np.broadcast_to(data, (n_vertex, n_subj))
+        return _matrix_reduce(matrix, data, matrix.indices, method).T
+    matrix = label_matrix(stack, labels)
+    vertex, subj = np.divmod(np.arange(n_vertex*n_subj), n_subj)
+    flatdata = data[vertex, subj if data.shape[1] > 1 else 0]
+    meas = _matrix_reduce(matrix, flatdata[:, np.newaxis], matrix.indices//n_subj, method)
+    return meas.reshape(n_subj, labels.size)
+
+def _matrix_reduce(matrix, data, vertex, method):
+    """
+    Reduce columns of data into rows of a binary indicator matrix
+
+    Parameters:
+    -----------
+    matrix: n_row x n_col CSR indicator matrix, indices of each row are ascending
+    data: n_col x k array
+    vertex: vertex number of each entry of matrix.indices, used by 'peak'
+    method: method of label_reduce
+
+    Return:
+    -------
+    meas: n_row x k array
+    """
+    size = np.diff(matrix.indptr)
+    if method == 'size':
+        return np.repeat(size[:, np.newaxis].astype(np.float64), data.shape[1], axis = 1)
+    valid = ~np.isnan(data)
+    count = matrix*valid.astype(np.float64)
+    present = count > 0
+    meas = np.full(count.shape, np.nan)
+    if method in ('max', 'min', 'peak', 'median'):
+        # entries of each row are contiguous in CSR order
+        nonempty = size > 0
+        starts = matrix.indptr[:-1][nonempty]
+        grouped = data[matrix.indices]
+        if method == 'median':
+            if grouped.shape[1] == 1:
+                rowid = np.repeat(np.arange(size.size), size)
+                keep = valid[matrix.indices, 0]
+                rowid, values = rowid[keep], grouped[keep, 0]
+                n = count[:, 0].astype(np.int64)
+                start = np.cumsum(n) - n
+                sortvalues = _sort_within_rows(rowid, values)
+                rows = present[:, 0]
+                meas[rows, 0] = 0.5*(sortvalues[(start + (n-1)//2)[rows]] + sortvalues[(start + n//2)[rows]])
+            else:
+                for i in np.flatnonzero(nonempty & np.any(present, axis = 1)):
+                    segment = grouped[matrix.indptr[i]:matrix.indptr[i+1]]
+                    meas[i, present[i]] = np.nanmedian(segment[:, present[i]], axis = 0)
+        elif np.any(nonempty):
+            fill = np.inf if method == 'min' else -np.inf
+            grouped = np.where(np.isnan(grouped), fill, grouped)
+            ufunc = np.minimum if method == 'min' else np.maximum
+            extreme = ufunc.reduceat(grouped, starts, axis = 0)
+            if method == 'peak':
+                # first entry of each row reaching its maximum
+                rowid = np.repeat(np.arange(starts.size), size[nonempty])
+                entry = np.arange(grouped.shape[0])[:, np.newaxis]
+                first = np.minimum.reduceat(np.where(grouped == extreme[rowid], entry, grouped.shape[0]), starts, axis = 0)
+                extreme = np.asarray(vertex)[first].astype(np.float64)
+            meas[nonempty] = extreme
+    else:
+        data0 = np.where(valid, data, 0.0)
+        total = matrix*data0
+        safecount = np.maximum(count, 1)
+        mean = total/safecount
+        if method == 'sum':
+            meas = total
+        elif method == 'mean':
+            meas = mean
+        else:
+            # central moments, each entry is centered by the mean of its row
+            centered = np.zeros(data0.shape)
+            rowid = np.repeat(np.arange(size.size), size)
+            centered[matrix.indices] = data0[matrix.indices] - mean[rowid]
+            centered[~valid] = 0
+            moment = lambda k: (matrix*centered**k)/safecount
+            m2 = moment(2)
+            with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                if method == 'std':
+                    meas = np.sqrt(m2)
+                elif method == 'ste':
+                    meas = np.sqrt(m2)/np.sqrt(count)
+                elif method == 'skewness':
+                    meas = moment(3)/m2**1.5
+                else:
+                    meas = moment(4)/m2**2 - 3
+    meas[~present] = np.nan
+    return meas
+
+def _sort_within_rows(rowid, values):
+    """
+    Sort values inside each row, rows are kept in order
+    Values are sorted first, then stable sort by row id keeps the value order inside each row
+    """
+    order = np.argsort(values)
+    order = order[np.argsort(rowid[order], kind = 'stable')]
+    return values[order]
+
+class LabelIndex(object):
+    """
+    Inventory of a label image, computed once and shared by roi operations
+    Flat indices of each label are stored in CSR layout, so downstream operations only touch roi voxels/vertices.
+    Note that label 0 is taken as background.
+
+    Parameters:
+    -----------
+    image: label image
+
+    Attributes:
+    -----------
+    shape: shape of label image
+    labels: sorted non-zero labels in image
+    sizes: voxel/vertex number of each label
+    indptr, indices: flat indices of labels[i] are indices[indptr[i]:indptr[i+1]], sorted ascendingly
+    bbox_min, bbox_max: bounding box of each label, n_label x ndim array
+
+    Example:
+    --------
+    >>> lblindex = LabelIndex(mask)
+    >>> roiloc = lblindex.roi(2)
+    >>> signals = get_signals(atlas, lblindex)
+    """
+    def __init__(self, image):
+        image = np.asarray(image)
+        self.shape = image.shape
+        self.dtype = image.dtype
+        flat = image.ravel()
+        nonzero = np.flatnonzero(flat)
+        values = flat[nonzero]
+        codes, maxcode = _label_codes(values)
+        if codes is not None:
+            counts = np.bincount(codes, minlength = maxcode+1)
+            labels = np.flatnonzero(counts)
+            sizes = counts[labels]
+            order = np.argsort(codes, kind = 'stable')
+            labels = labels.astype(self.dtype)
+        else:
+            order = np.argsort(values, kind = 'stable')
+            labels, sizes = np.unique(values[order], return_counts = True)
+        self.labels = labels
+        self.sizes = sizes
+        self.indptr = np.concatenate(([0], np.cumsum(sizes))).astype(np.intp)
+        self.indices = nonzero[order]
+        if labels.size:
+            coords = np.transpose(np.unravel_index(self.indices, self.shape))
+            self.bbox_min = np.minimum.reduceat(coords, self.indptr[:-1], axis = 0)
+            self.bbox_max = np.maximum.reduceat(coords, self.indptr[:-1], axis = 0)
+        else:
+            self.bbox_min = np.empty((0, len(self.shape)), dtype = np.intp)
+            self.bbox_max = np.empty((0, len(self.shape)), dtype = np.intp)
+        self._position = dict(zip(labels.tolist(), range(labels.size)))
+
+    def __contains__(self, label):
+        return label in self._position
+
+    @property
+    def labelnum(self):
+        """
+        Maximum label of image, 0 if image contains no label
+        """
+        if self.labels.size == 0:
+            return 0
+        return int(np.max(self.labels))
+
+    def roi(self, label):
+        """
+        Flat indices of a label, empty array if label does not exist
+        """
+        pos = self._position.get(label)
+        if pos is None:
+            return self.indices[:0]
+        return self.indices[self.indptr[pos]:self.indptr[pos+1]]
+
+    def coords(self, label):
+        """
+        Coordinates of a label as a tuple of arrays, used to index image with the same shape
+        """
+        return np.unravel_index(self.roi(label), self.shape)
+
+    def size(self, label):
+        """
+        Voxel/vertex number of a label
+        """
+        pos = self._position.get(label)
+        if pos is None:
+            return 0
+        return self.sizes[pos]
+
+    def bbox(self, label):
+        """
+        Bounding box of a label as (min coordinate, max coordinate), None if label does not exist
+        """
+        pos = self._position.get(label)
+        if pos is None:
+            return None
+        return self.bbox_min[pos], self.bbox_max[pos]
+
+    def mask(self, label):
+        """
+        Boolean mask of a label
+        """
+        mask = np.zeros(self.shape, dtype = bool)
+        mask.flat[self.roi(label)] = True
+        return mask
+
+    def toarray(self):
+        """
+        Rebuild label image
+        """
+        image = np.zeros(self.shape, dtype = self.dtype)
+        image.flat[self.indices] = np.repeat(self.labels, self.sizes)
+        return image
+
+def as_labelindex(mask):
+    """
+    Get LabelIndex of mask, mask could be a label image or a LabelIndex
+    """
+    if isinstance(mask, LabelIndex):
+        return mask
+    return LabelIndex(mask)
+
+class LabelStack(object):
+    """
+    Sparse one-hot representation of a group label stack (vertices x subjects, or a 4D volume)
+    For each subject, vertex/voxel indices of each label are stored in CSR form with uint32 indices and no payload,
+    so computations are proportional to labelled vertices only.
+    Row s*n_label+i of the CSR layout holds indices of labels[i] in subject s.
+
+    Parameters:
+    -----------
+    stack: label stack, the last axis is subject. 2D (vertices x subjects) or 4D (x, y, z, subjects)
+    labels: labels to be stored, by default is None, which stores all non-zero labels
+
+    Example:
+    --------
+    >>> lblstack = LabelStack(imgdata)
+    >>> pm = lblstack.pm(meth = 'part')
+    """
+    def __init__(self, stack, labels = None):
+        stack = np.asarray(stack)
+        self.spatial_shape = stack.shape[:-1]
+        self.n_subj = stack.shape[-1]
+        self.n_vertex = int(np.prod(self.spatial_shape))
+        if self.n_vertex > np.iinfo(np.uint32).max:
+            raise Exception('Too many vertices/voxels to be stored as uint32 indices')
+        stack = stack.reshape(self.n_vertex, self.n_subj)
+        vertex, subj = np.nonzero(stack)
+        values = stack[vertex, subj]
+        if labels is None:
+            labels = np.unique(values)
+        labels = np.sort(np.asarray(labels).ravel())
+        # drop values not in labels
+        if labels.size:
+            pos = np.minimum(np.searchsorted(labels, values), labels.size-1)
+            keep = labels[pos] == values
+        else:
+            pos = np.zeros_like(vertex)
+            keep = np.zeros(vertex.shape, dtype = bool)
+        vertex, subj, pos = vertex[keep], subj[keep], pos[keep]
+        row = subj*labels.size + pos
+        order = np.argsort(row, kind = 'stable')
+        self.labels = labels
+        self.indices = vertex[order].astype(np.uint32)
+        self.indptr = np.concatenate(([0], np.cumsum(np.bincount(row, minlength = self.n_subj*labels.size)))).astype(np.int64)
+
+    @classmethod
+    def _from_csr(cls, spatial_shape, n_subj, labels, indptr, indices):
+        lblstack = cls.__new__(cls)
+        lblstack.spatial_shape = spatial_shape
+        lblstack.n_subj = n_subj
+        lblstack.n_vertex = int(np.prod(spatial_shape))
+        lblstack.labels = labels
+        lblstack.indptr = indptr
+        lblstack.indices = indices
+        return lblstack
+
+    @property
+    def n_label(self):
+        return self.labels.size
+
+    @property
+    def nbytes(self):
+        return self.indptr.nbytes + self.indices.nbytes
+
+    def _label_pos(self, label):
+        """
+        Position of label in stored labels, None if label is not stored
+        """
+        pos = np.searchsorted(self.labels, label)
+        if pos == self.labels.size or self.labels[pos] != label:
+            return None
+        return pos
+
+    def roi(self, subj, label):
+        """
+        Vertex/voxel indices of a label in a subject, empty for labels not stored
+        """
+        pos = self._label_pos(label)
+        if pos is None:
+            return np.zeros(0, dtype = self.indices.dtype)
+        row = subj*self.n_label + pos
+        return self.indices[self.indptr[row]:self.indptr[row+1]]
+
+    def sizes(self):
+        """
+        Size of each label of each subject, n_subj x n_label array
+        """
+        return np.diff(self.indptr).reshape(self.n_subj, self.n_label)
+
+    def label_codes(self):
+        """
+        Label position (0...n_label-1) of each stored index
+        """
+        return np.repeat(np.tile(np.arange(self.n_label), self.n_subj), np.diff(self.indptr))
+
+    def subject_codes(self):
+        """
+        Subject of each stored index
+        """
+        return np.repeat(np.arange(self.n_subj), np.sum(self.sizes(), axis = 1))
+
+    def rows_indices(self, rows):
+        """
+        Concatenated vertex/voxel indices of CSR rows, row s*n_label+i holds indices of labels[i] in subject s
+
+        Parameters:
+        -----------
+        rows: row numbers
+
+        Return:
+        -------
+        indices: concatenated indices of rows
+        lengths: index number of each row
+        """
+        rows = np.asarray(rows, dtype = np.int64)
+        starts = self.indptr[rows]
+        lengths = self.indptr[rows+1] - starts
+        offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        gather = np.repeat(starts - offsets, lengths) + np.arange(np.sum(lengths))
+        return self.indices[gather], lengths
+
+    def counts(self):
+        """
+        Number of subjects labelled in each vertex/voxel, n_vertex x n_label array
+        """
+        code = self.label_codes()*self.n_vertex + self.indices
+        counts = np.bincount(code, minlength = self.n_label*self.n_vertex)
+        return counts.reshape(self.n_label, self.n_vertex).T
+
+    def pm(self, meth = 'all'):
+        """
+        Probabilistic map of each label
+
+        Parameters:
+        -----------
+        meth: 'all' or 'part'
+              'all', all subjects are taken into account
+              'part', part subjects are taken into account, except subject with no roi label in specific roi
+
+        Return:
+        -------
+        pm: probabilistic map, n_vertex x n_label array
+        """
+        counts = self.counts().astype(float)
+        if meth == 'all':
+            n_subj = float(self.n_subj)
+        elif meth == 'part':
+            n_subj = np.sum(self.sizes() != 0, axis = 0).astype(float)
+            n_subj[n_subj == 0] = np.nan
+        else:
+            raise Exception('Miss parameter meth')
+        return counts/n_subj
+
+    def subjects(self, subj):
+        """
+        A new LabelStack of part subjects, without accessing dense data
+
+        Parameters:
+        -----------
+        subj: subject indices
+
+        Return:
+        -------
+        lblstack: LabelStack of selected subjects
+        """
+        subj = np.asarray(subj, dtype = int).ravel()
+        rows = (subj[:, np.newaxis]*self.n_label + np.arange(self.n_label)).ravel()
+        indices, lengths = self.rows_indices(rows)
+        indptr = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+        return LabelStack._from_csr(self.spatial_shape, subj.size, self.labels, indptr, indices)
+
+    def overlap(self, template, label, tlabel, index = 'dice'):
+        """
+        Overlap between a label of each subject and a label of template
+
+        Parameters:
+        -----------
+        template: label image with the same spatial shape
+        label: label of subjects
+        tlabel: label of template
+        index: 'dice' or 'percent', 'percent' is overlap/template size
+
+        Return:
+        -------
+        overlap: overlap of each subject
+        """
+        template = np.asarray(template).reshape(-1)
+        pos = self._label_pos(label)
+        if pos is None:
+            # labels not stored are empty regions in all subjects
+            indices, lengths = np.zeros(0, dtype = self.indices.dtype), np.zeros(self.n_subj, dtype = np.int64)
+        else:
+            rows = np.arange(self.n_subj)*self.n_label + pos
+            indices, lengths = self.rows_indices(rows)
+        hit = template[indices] == tlabel
+        subj = np.repeat(np.arange(self.n_subj), lengths)
+        intersection = np.bincount(subj[hit], minlength = self.n_subj).astype(float)
+        tsize = np.sum(template == tlabel)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            if index == 'dice':
+                overlap = 2.0*intersection/(lengths + tsize)
+            elif index == 'percent':
+                overlap = intersection/tsize
+            else:
+                raise Exception("Only support 'dice' and 'percent' as overlap indices at present.")
+        return overlap
+
+    def toarray(self):
+        """
+        Rebuild dense label stack
+        """
+        stack = np.zeros((self.n_vertex, self.n_subj), dtype = self.labels.dtype)
+        stack[self.indices, self.subject_codes()] = self.labels[self.label_codes()]
+        return stack.reshape(self.spatial_shape+(self.n_subj,))
@@ -0,0 +1,541 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 et:
+
+"""
+Mesh topology tools built on faces array.
+Topology is kept as symmetric scipy.sparse CSR adjacency, neighbours of vertex i are
+adjacency.indices[adjacency.indptr[i]:adjacency.indptr[i+1]].
+"""
+
+import os
+import hashlib
+import numpy as np
+from scipy import sparse
+from scipy.sparse import csgraph
+
+
+def faces_to_edges(faces):
+    """
+    Extract unique undirected edges from faces array
+
+    Parameters:
+    -----------
+    faces: faces array, n_faces x 3
+
+    Return:
+    -------
+    edges: n_edges x 2 array, each row (i, j) satisfies i < j
+
+    Example:
+    --------
+    >>> edges = faces_to_edges(faces)
+    """
+    faces = np.asarray(faces, dtype = np.int64)
+    edges = np.concatenate((faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [0, 2]]), axis = 0)
+    edges.sort(axis = 1)
+    # encode each edge into a single integer to unique them
+    n_vertex = int(edges.max()) + 1 if edges.size else 0
+    codes = np.unique(edges[:, 0]*n_vertex + edges[:, 1])
+    return np.column_stack((codes//n_vertex, codes%n_vertex))
+
+def edges_to_adjacency(edges, n_vertex = None, weights = None):
+    """
+    Build symmetric CSR adjacency matrix from edges
+
+    Parameters:
+    -----------
+    edges: n_edges x 2 array (or list of pairs)
+    n_vertex: vertex number, by default is None, which is the maximum vertex in edges plus 1
+    weights: edge weights, by default is None, which gives a binary adjacency matrix
+
+    Return:
+    -------
+    adjacency: n_vertex x n_vertex scipy.sparse CSR matrix
+    """
+    edges = np.asarray(edges, dtype = np.int64).reshape(-1, 2)
+    if n_vertex is None:
+        n_vertex = int(edges.max()) + 1 if edges.size else 0
+    binary = weights is None
+    if binary:
+        weights = np.ones(edges.shape[0], dtype = np.int8)
+    rows = np.concatenate((edges[:, 0], edges[:, 1]))
+    cols = np.concatenate((edges[:, 1], edges[:, 0]))
+    data = np.concatenate((weights, weights))
+    adjacency = sparse.csr_matrix((data, (rows, cols)), shape = (n_vertex, n_vertex))
+    # duplicated edges were summed in construction
+    if binary:
+        adjacency.data[:] = 1
+    adjacency.sort_indices()
+    return adjacency
+
+def faces_to_adjacency(faces, n_vertex = None):
+    """
+    Build symmetric binary CSR adjacency matrix from faces array
+
+    Parameters:
+    -----------
+    faces: faces array, n_faces x 3
+    n_vertex: vertex number, by default is None, which is the maximum vertex in faces plus 1
+
+    Return:
+    -------
+    adjacency: n_vertex x n_vertex scipy.sparse CSR matrix
+
+    Example:
+    --------
+    >>> adjacency = faces_to_adjacency(faces)
+    """
+    return edges_to_adjacency(faces_to_edges(faces), n_vertex)
+
+def edge_length(coords, edges):
+    """
+    Euclidean length of edges
+
+    Parameters:
+    -----------
+    coords: vertex coordinates, n_vertex x 3
+    edges: n_edges x 2 array
+
+    Return:
+    -------
+    length: length of each edge
+    """
+    coords = np.asarray(coords, dtype = float)
+    edges = np.asarray(edges, dtype = np.int64)
+    return np.linalg.norm(coords[edges[:, 0]] - coords[edges[:, 1]], axis = 1)
+
+def geodesic_adjacency(coords, faces):
+    """
+    Build symmetric CSR adjacency matrix weighted by edge length
+    Shortest paths on this graph approximate geodesic distances on the surface
+
+    Parameters:
+    -----------
+    coords: vertex coordinates, n_vertex x 3
+    faces: faces array, n_faces x 3
+
+    Return:
+    -------
+    adjacency: n_vertex x n_vertex scipy.sparse CSR matrix
+
+    Example:
+    --------
+    >>> coords, faces = iofiles.make_ioinstance('lh.midthickness.surf.gii').load()
+    >>> adjacency = geodesic_adjacency(coords, faces)
+    """
+    edges = faces_to_edges(faces)
+    return edges_to_adjacency(edges, len(coords), edge_length(coords, edges))
+
+def vertex_degree(adjacency):
+    """
+    Degree (neighbour number) of each vertex
+    """
+    return np.diff(adjacency.indptr)
+
+def neighbour_list(adjacency):
+    """
+    Neighbours of each vertex as a list of arrays, views into adjacency.indices
+    """
+    return np.split(adjacency.indices, adjacency.indptr[1:-1])
+
+def n_ring_neighbour(adjacency, n = 1, vertices = None, ordinal = False, include_self = True):
+    """
+    n ring neighbourhoods of vertices in CSR form
+    Neighbourhoods are expanded by sparse matrix products with the adjacency matrix,
+    all vertices (or a subset of vertices) are computed at once.
+
+    Parameters:
+    -----------
+    adjacency: CSR adjacency matrix, computed from faces_to_adjacency
+    n: integer, ring number
+    vertices: vertices to compute, by default is None, which computes all vertices
+    ordinal: True, get the exact n-th ring neighbourhood
+             False, get neighbourhood within n rings
+    include_self: whether the center vertex is included or not when ordinal is False, by default is True
+
+    Return:
+    -------
+    ring: len(vertices) x n_vertex scipy.sparse CSR boolean matrix,
+          neighbours of the i-th vertex are ring.indices[ring.indptr[i]:ring.indptr[i+1]]
+
+    Example:
+    --------
+    >>> ring = n_ring_neighbour(adjacency, 5)
+    """
+    n_vertex = adjacency.shape[0]
+    if vertices is None:
+        vertices = np.arange(n_vertex)
+    vertices = np.atleast_1d(np.asarray(vertices, dtype = np.int64))
+    step = (adjacency + sparse.identity(n_vertex, format = 'csr')).astype(bool).tocsr()
+    seed = sparse.csr_matrix((np.ones(vertices.size, dtype = bool), (np.arange(vertices.size), vertices)),
+                             shape = (vertices.size, n_vertex))
+    reach = seed
+    inner = seed
+    for i in range(n):
+        inner = reach
+        reach = (reach*step).astype(bool)
+    if ordinal:
+        # n-th ring is the difference between n rings and n-1 rings
+        ring = (reach.astype(np.int8) - inner.astype(np.int8)).astype(bool)
+        if n == 0:
+            ring = seed
+    elif include_self:
+        ring = reach
+    else:
+        ring = (reach.astype(np.int8) - seed.astype(np.int8)).astype(bool)
+    ring = ring.tocsr()
+    ring.eliminate_zeros()
+    ring.sort_indices()
+    return ring
+
+def laplacian(adjacency, normed = False):
+    """
+    Graph laplacian of mesh, L = D - A
+
+    Parameters:
+    -----------
+    adjacency: CSR adjacency matrix, binary or weighted
+    normed: compute normalized laplacian I - D^(-1/2)AD^(-1/2) or not, by default is False
+
+    Return:
+    -------
+    lap: n_vertex x n_vertex CSR matrix
+    """
+    return csgraph.laplacian(adjacency.astype(np.float64), normed = normed).tocsr()
+
+def _row_normalize(matrix):
+    """
+    Normalize rows of sparse matrix to sum 1
+    """
+    rowsum = np.asarray(matrix.sum(axis = 1)).ravel()
+    rowsum[rowsum == 0] = 1
+    return (sparse.diags(1.0/rowsum)*matrix).tocsr()
+
+def average_operator(adjacency, iterations = 1, include_self = True):
+    """
+    Smoothing operator of iterative neighbourhood averaging
+    Each iteration replaces the value of a vertex by the mean of its one ring neighbourhood
+
+    Parameters:
+    -----------
+    adjacency: CSR adjacency matrix
+    iterations: iteration number, by default is 1
+    include_self: whether the center vertex is averaged or not, by default is True
+
+    Return:
+    -------
+    operator: n_vertex x n_vertex CSR matrix, smoothed data is operator*data
+
+    Example:
+    --------
+    >>> operator = average_operator(adjacency, 5)
+    """
+    step = (adjacency != 0).astype(np.float64)
+    if include_self:
+        step = step + sparse.identity(adjacency.shape[0], format = 'csr')
+    step = _row_normalize(step)
+    operator = sparse.identity(adjacency.shape[0], format = 'csr')
+    for i in range(iterations):
+        operator = step*operator
+    return operator.tocsr()
+
+def radius_neighbour(adjacency, radius, chunksize = 512):
+    """
+    Vertices within radius of each vertex and their distances
+    Distances are computed by bounded Dijkstra search, chunksize vertices at once
+
+    Parameters:
+    -----------
+    adjacency: CSR adjacency matrix, weighted by edge length for geodesic radius
+    radius: radius of neighbourhood, inclusive
+    chunksize: number of vertices to compute distances at once, by default is 512
+
+    Return:
+    -------
+    neighbour: n_vertex x n_vertex CSR matrix, neighbours of the i-th vertex are
+               neighbour.indices[neighbour.indptr[i]:neighbour.indptr[i+1]] with distances in neighbour.data
+               the center vertex is kept as an explicit zero
+
+    Example:
+    --------
+    >>> neighbour = radius_neighbour(geodesic_adjacency(coords, faces), 10.0)
+    """
+    n_vertex = adjacency.shape[0]
+    rows, cols, dists = [], [], []
+    for start in range(0, n_vertex, chunksize):
+        sources = np.arange(start, min(start+chunksize, n_vertex))
+        dist = distance_matrix(adjacency, sources, radius)
+        row, col = np.nonzero(np.isfinite(dist))
+        rows.append(row + start)
+        cols.append(col)
+        dists.append(dist[row, col])
+    neighbour = sparse.csr_matrix((np.concatenate(dists), (np.concatenate(rows), np.concatenate(cols))), shape = (n_vertex, n_vertex))
+    neighbour.sort_indices()
+    return neighbour
+
+def fwhm_to_sigma(fwhm):
+    """
+    Convert full width at half maximum into sigma of gaussian kernel
+    """
+    return fwhm/np.sqrt(8*np.log(2))
+
+def gaussian_operator(adjacency, fwhm, radius = None, chunksize = 512):
+    """
+    Gaussian (heat kernel) smoothing operator over geodesic distances
+    Weights exp(-d^2/(2*sigma^2)) of vertices within radius are normalized to sum 1 for each vertex
+
+    Parameters:
+    -----------
+    adjacency: CSR adjacency matrix weighted by edge length, computed from geodesic_adjacency
+    fwhm: full width at half maximum of gaussian kernel, in the unit of coordinates (mm)
+    radius: radius of kernel, by default is None, which is 3*sigma
+    chunksize: number of vertices to compute distances at once, by default is 512
+
+    Return:
+    -------
+    operator: n_vertex x n_vertex CSR matrix, smoothed data is operator*data
+
+    Example:
+    --------
+    >>> operator = gaussian_operator(geodesic_adjacency(coords, faces), 4.0)
+    >>> smoothed = smooth(data, operator)
+    """
+    sigma = fwhm_to_sigma(fwhm)
+    if radius is None:
+        radius = 3*sigma
+    operator = radius_neighbour(adjacency, radius, chunksize)
+    operator.data = np.exp(-operator.data**2/(2*sigma**2))
+    return _row_normalize(operator)
+
+def smooth(data, operator):
+    """
+    Apply smoothing operator to surface data
+
+    Parameters:
+    -----------
+    data: n_vertex data, or n_vertex x n_subj (n_vertex x n_timepoint) matrix smoothed at once
+          (n_vertex, 1, 1) and (n_vertex, 1, 1, n_subj) data are also supported
+    operator: smoothing operator from average_operator or gaussian_operator
+
+    Return:
+    -------
+    smoothed: smoothed data with the same shape as data
+    """
+    data = np.asarray(data)
+    smoothed = operator*data.reshape(data.shape[0], -1).astype(np.float64)
+    return smoothed.reshape(data.shape)
+
+def connected_components(adjacency, mask = None):
+    """
+    Label connected components of mesh restricted to mask
+    Masks of all subjects are labeled in one call, components never cross subjects.
+
+    Parameters:
+    -----------
+    adjacency: CSR adjacency matrix
+    mask: boolean mask, n_vertex or n_vertex x n_subj, by default is None, which uses all vertices
+
+    Return:
+    -------
+    labels: component label of each vertex with the same shape as mask, -1 for vertices outside mask
+            component labels are unique across subjects and ordered by subject
+    sizes: vertex number of each component
+
+    Example:
+    --------
+    >>> labels, sizes = connected_components(adjacency, sulcusmask == 1)
+    """
+    n_vertex = adjacency.shape[0]
+    if mask is None:
+        mask = np.ones(n_vertex, dtype = bool)
+    mask = np.asarray(mask, dtype = bool)
+    outshape = mask.shape
+    mask = mask.reshape(n_vertex, -1)
+    n_subj = mask.shape[1]
+    upper = sparse.triu(adjacency, k = 1).tocoo()
+    # keep edges with both ends in mask, vertex i of subject s becomes node i*n_subj+s
+    edge, subj = np.nonzero(mask[upper.row] & mask[upper.col])
+    rows = upper.row[edge].astype(np.int64)*n_subj + subj
+    cols = upper.col[edge].astype(np.int64)*n_subj + subj
+    n_node = n_vertex*n_subj
+    graph = sparse.csr_matrix((np.ones(edge.size, dtype = bool), (rows, cols)), shape = (n_node, n_node))
+    _, nodelabel = csgraph.connected_components(graph, directed = False)
+    nodelabel = nodelabel.reshape(n_vertex, n_subj)
+    labels = np.full((n_vertex, n_subj), -1, dtype = np.int64)
+    # renumber components of masked vertices consecutively, ordered by subject
+    maskT = mask.T
+    _, inverse = np.unique(nodelabel.T[maskT], return_inverse = True)
+    labels.T[maskT] = inverse.ravel()
+    sizes = np.bincount(inverse.ravel())
+    return labels.reshape(outshape), sizes
+
+def seed_component(adjacency, seeds, mask):
+    """
+    Component of mask connected with seed vertex
+    Seed vertex is always included, even if it lies outside mask.
+
+    Parameters:
+    -----------
+    adjacency: CSR adjacency matrix
+    seeds: seed vertex, an integer or one seed for each subject
+    mask: boolean mask, n_vertex or n_vertex x n_subj
+
+    Return:
+    -------
+    component: boolean mask of vertices connected with seed, same shape as mask
+    size: vertex number of the component in each subject
+
+    Example:
+    --------
+    >>> component, size = seed_component(adjacency, 24, sulcusmask == 1)
+    """
+    mask = np.array(mask, dtype = bool)
+    outshape = mask.shape
+    mask = mask.reshape(mask.shape[0], -1)
+    subj = np.arange(mask.shape[1])
+    seeds = np.broadcast_to(np.asarray(seeds, dtype = np.int64), subj.shape)
+    mask[seeds, subj] = True
+    labels, sizes = connected_components(adjacency, mask)
+    seedlabel = labels[seeds, subj]
+    component = labels == seedlabel
+    size = sizes[seedlabel]
+    if len(outshape) == 1:
+        return component.reshape(outshape), size[0]
+    return component, size
+
+def distance_field(adjacency, sources, limit = np.inf):
+    """
+    Minimal distance from a set of source vertices to every vertex, computed by one multi-source search
+    Distance is measured by edge weights of adjacency, i.e. edge number for binary adjacency matrix.
+
+    Parameters:
+    -----------
+    adjacency: CSR adjacency matrix
+    sources: source vertex or vertices
+    limit: maximum distance to search, vertices farther than limit get inf, by default is inf
+
+    Return:
+    -------
+    dist: distance of each vertex to its nearest source vertex, inf for unreachable vertices
+
+    Example:
+    --------
+    >>> dist = distance_field(adjacency, roi_vertices)
+    """
+    sources = np.atleast_1d(np.asarray(sources, dtype = np.int64))
+    if sources.size == 0:
+        return np.full(adjacency.shape[0], np.inf)
+    return csgraph.dijkstra(adjacency, directed = False, indices = sources, min_only = True, limit = limit)
+
+def distance_matrix(adjacency, sources, limit = np.inf):
+    """
+    Distance from each source vertex to every vertex, one row per source vertex
+
+    Parameters:
+    -----------
+    adjacency: CSR adjacency matrix
+    sources: source vertex or vertices
+    limit: maximum distance to search, vertices farther than limit get inf, by default is inf
+           a bounded limit makes the search much faster for small neighbourhoods
+
+    Return:
+    -------
+    dist: len(sources) x n_vertex distance matrix
+    """
+    sources = np.atleast_1d(np.asarray(sources, dtype = np.int64))
+    return csgraph.dijkstra(adjacency, directed = False, indices = sources, limit = limit).reshape(sources.size, -1)
+
+def mesh_hash(coords, faces):
+    """
+    Hash of mesh, computed from vertex coordinates and faces
+    """
+    sha = hashlib.sha1()
+    sha.update(np.ascontiguousarray(coords, dtype = np.float64).tobytes())
+    sha.update(np.ascontiguousarray(faces, dtype = np.int64).tobytes())
+    return sha.hexdigest()
+
+def geodesic_distance(coords, faces, sources, limit = np.inf, min_only = True, cachedir = None):
+    """
+    Geodesic distance fields on mesh
+    Distance is measured along edges weighted by their length.
+
+    Parameters:
+    -----------
+    coords: vertex coordinates, n_vertex x 3
+    faces: faces array, n_faces x 3
+    sources: source vertex or vertices
+    limit: maximum distance to search, vertices farther than limit get inf, by default is inf
+    min_only: True, return one distance field to the nearest source vertex (multi-source)
+              False, return one distance field for each source vertex (single-source)
+    cachedir: directory to cache distance fields, by default is None, which disables cache
+              cache files are keyed by the mesh hash, sources, limit and min_only
+
+    Return:
+    -------
+    dist: n_vertex distance field if min_only is True, otherwise len(sources) x n_vertex matrix
+
+    Example:
+    --------
+    >>> coords, faces = iofiles.make_ioinstance('lh.midthickness.surf.gii').load()
+    >>> dist = geodesic_distance(coords, faces, roi_vertices, limit = 20.0, cachedir = 'geodesic_cache')
+    """
+    sources = np.atleast_1d(np.asarray(sources, dtype = np.int64))
+    cachefile = None
+    if cachedir is not None:
+        sha = hashlib.sha1(sources.tobytes())
+        sha.update('{0}_{1}'.format(float(limit), bool(min_only)).encode())
+        cachefile = os.path.join(cachedir, '{0}_{1}.npy'.format(mesh_hash(coords, faces), sha.hexdigest()))
+        if os.path.isfile(cachefile):
+            return np.load(cachefile)
+    adjacency = geodesic_adjacency(coords, faces)
+    if min_only:
+        dist = distance_field(adjacency, sources, limit)
+    else:
+        dist = distance_matrix(adjacency, sources, limit)
+    if cachefile is not None:
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        np.save(cachefile, dist)
+    return dist
+
+def minimal_distance(adjacency, vertices_a, vertices_b):
+    """
+    Minimal distance from each vertex of a to vertex set b
+    """
+    return distance_field(adjacency, vertices_b)[np.asarray(vertices_a, dtype = np.int64)]
+
+def hausdorff_distance(adjacency, vertices_a, vertices_b):
+    """
+    Hausdorff distance between two vertex sets
+    h(A,B) = max{max(i->A)min(j->B)d(i,j), max(j->B)min(i->A)d(i,j)}
+
+    Parameters:
+    -----------
+    adjacency: CSR adjacency matrix
+    vertices_a, vertices_b: vertices of the two sets
+
+    Return:
+    -------
+    hd: hausdorff distance
+    """
+    dist_ab = minimal_distance(adjacency, vertices_a, vertices_b)
+    dist_ba = minimal_distance(adjacency, vertices_b, vertices_a)
+    return max(np.max(dist_ab, initial = 0), np.max(dist_ba, initial = 0))
+
+def median_minimal_distance(adjacency, vertices_a, vertices_b):
+    """
+    Median minimal distance between two vertex sets
+    mmd = median{min(i->A)d(i,j), min(j->B)d(i,j)}
+
+    Parameters:
+    -----------
+    adjacency: CSR adjacency matrix
+    vertices_a, vertices_b: vertices of the two sets
+
+    Return:
+    -------
+    mmd: median minimal distance
+    """
+    dist_ab = minimal_distance(adjacency, vertices_a, vertices_b)
+    dist_ba = minimal_distance(adjacency, vertices_b, vertices_a)
+    return np.median(np.concatenate((dist_ab, dist_ba)))
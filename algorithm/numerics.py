@@ -0,0 +1,245 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode:nil -*-
+# vi: set ft=python sts=4 sw=4 et:
+
+"""
+Array-native numerical kernels used by tools and the analysis classes.
+
+All kernels work on whole arrays at once, and those that map element to
+element (fisher_r2z, fisher_z2r, r2t, r2p, normalize_sum) accept an out
+parameter so they could be applied in place.
+Microbenchmarks against the per-element implementations it replaces are
+in benchmarks/numerics_benchmark.py.
+"""
+
+import numpy as np
+from scipy import special
+
+
+def fisher_r2z(r, clip = 0.999, out = None):
+    """
+    Fisher r-to-z transformation, z = arctanh(r)
+    r is clipped into [-clip, clip] before transformation to avoid infinite values
+
+    Parameters:
+    -----------
+    r: correlation values, scalar or array
+    clip: clipping bound of r, by default is 0.999
+    out: output array, pass r itself to transform in place
+
+    Return:
+    -------
+    z: z values
+
+    Example:
+    --------
+    >>> z = fisher_r2z(r)
+    >>> fisher_r2z(r, out = r)
+    """
+    if out is None:
+        out = np.array(r, dtype = float)
+    np.clip(r, -clip, clip, out = out)
+    return np.arctanh(out, out = out)
+
+def fisher_z2r(z, out = None):
+    """
+    Fisher z-to-r transformation, r = tanh(z)
+
+    Parameters:
+    -----------
+    z: z values, scalar or array
+    out: output array, pass z itself to transform in place
+
+    Return:
+    -------
+    r: correlation values
+
+    Example:
+    --------
+    >>> r = fisher_z2r(z)
+    """
+    return np.tanh(z, out = out)
+
+def r2t(r, n, out = None):
+    """
+    Convert correlation values into t values
+    t = r*sqrt(df/((1-r)*(1+r))), df = n-2
+
+    Parameters:
+    -----------
+    r: correlation values, scalar or array
+    n: sample size used to compute r
+    out: output array, pass r itself to convert in place
+
+    Return:
+    -------
+    t: t values, r equals to 1/-1 gives inf/-inf
+    """
+    r = np.asarray(r, dtype = float)
+    df = n - 2
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return np.multiply(r, np.sqrt(df/((1.0-r)*(1.0+r))), out = out)
+
+def r2p(r, n, tail = 'both', out = None):
+    """
+    Significance of correlation values through t distribution
+    p = betainc(df/2, 1/2, df/(df+t^2)), df = n-2
+
+    Parameters:
+    -----------
+    r: correlation values, scalar or array
+    n: sample size used to compute r
+    tail: 'both' or 'single'
+    out: output array, pass r itself to convert in place
+
+    Return:
+    -------
+    p: p values
+
+    Example:
+    --------
+    >>> p = r2p(r, 100)
+    """
+    if tail not in ('both', 'single'):
+        raise Exception("tail should be 'both' or 'single'")
+    r = np.asarray(r, dtype = float)
+    df = n - 2
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        t_squared = r**2*(df/((1.0-r)*(1.0+r)))
+        p = special.betainc(0.5*df, 0.5, df/(df+t_squared), out = out)
+    if tail == 'single':
+        p = np.multiply(p, 0.5, out = out)
+    return p
+
+def normalize_sum(array, axis = -1, out = None):
+    """
+    Normalize array to make elements sum to 1 along axis
+
+    Parameters:
+    -----------
+    array: data array
+    axis: axis to normalize, by default is the last axis (each row)
+    out: output array, pass array itself to normalize in place
+
+    Return:
+    -------
+    normarray: normalized array
+    """
+    array = np.asarray(array, dtype = float)
+    return np.divide(array, np.sum(array, axis = axis, keepdims = True), out = out)
+
+def entropy(prob, axis = -1, base = 2):
+    """
+    Shannon entropy of probabilities along axis, 0*log(0) is treated as 0
+
+    Parameters:
+    -----------
+    prob: probabilities, each row sums to 1
+    axis: axis to reduce, by default is the last axis (each row)
+    base: base of logarithm, by default is 2
+
+    Return:
+    -------
+    h: entropy of each row
+    """
+    prob = np.asarray(prob, dtype = float)
+    logprob = np.zeros_like(prob)
+    np.log(prob, out = logprob, where = prob > 0)
+    return -1.0*np.sum(prob*logprob, axis = axis)/np.log(base)
+
+def entropy_nonuniformity(array, axis = -1):
+    """
+    Non-uniformity estimated by Shannon entropy, batched over rows
+    nonuniformity = 1 - H(p)/H(uniform), as uniform distribution has the highest entropy
+
+    Parameters:
+    -----------
+    array: data array, normalized to sum 1 along axis inside
+    axis: axis to reduce, by default is the last axis (each row)
+
+    Return:
+    -------
+    nonuniformity: non-uniformity index of each row
+    """
+    prob = normalize_sum(array, axis)
+    ref_entropy = np.log2(prob.shape[axis])
+    return 1 - entropy(prob, axis = axis, base = 2)/ref_entropy
+
+def l2_nonuniformity(array, axis = -1):
+    """
+    Non-uniformity estimated by L2 norm, batched over rows
+    nonuniformity = (n*sqrt(d)-1)/(sqrt(d)-1)
+    where n is the L2 norm of the normalized vector, d is the vector length
+
+    Parameters:
+    -----------
+    array: data array, normalized to sum 1 along axis inside
+    axis: axis to reduce, by default is the last axis (each row)
+
+    Return:
+    -------
+    nonuniformity: non-uniformity index of each row
+    """
+    prob = normalize_sum(array, axis)
+    sqrt_d = np.sqrt(prob.shape[axis])
+    norm = np.sqrt(np.sum(prob**2, axis = axis))
+    return (norm*sqrt_d-1)/(sqrt_d-1)
+
+def residualize(targets, confounds, intercept = True, inplace = False):
+    """
+    Regress confounds out of multiple targets at once
+    Subjects with missing confounds are ignored. Target columns are grouped by their missing pattern,
+    all columns in a group are solved with one least squares factorization.
+
+    Parameters:
+    -----------
+    targets: n_subj x n_feat matrix (or n_subj vector), nan marks missing values
+    confounds: n_subj x n_cov matrix (or n_subj vector)
+    intercept: add a constant column into confounds or not, by default is True
+    inplace: write residuals into targets or not, by default is False
+             if True, targets should be a float numpy array
+
+    Return:
+    -------
+    residue: residuals with the same shape as targets, nan where targets or confounds are missing
+
+    Example:
+    --------
+    >>> residue = residualize(features, np.column_stack((age, sex, fd, brainsize)))
+    """
+    if inplace:
+        if not (isinstance(targets, np.ndarray) and np.issubdtype(targets.dtype, np.floating)):
+            raise Exception('targets should be a float numpy array if inplace is True')
+        Y = targets
+    else:
+        Y = np.array(targets, dtype = float)
+    n_subj = Y.shape[0]
+    Y = Y.reshape(n_subj, -1)
+    if Y.shape[1] == 0:
+        # nothing to regress
+        return targets if inplace else Y.reshape(np.shape(targets))
+    X = np.asarray(confounds, dtype = float).reshape(n_subj, -1)
+    if intercept:
+        X = np.column_stack((np.ones(n_subj), X))
+
+    observed = ~np.isnan(Y)
+    observed &= ~np.any(np.isnan(X), axis = 1)[:, np.newaxis]
+    # columns share a group when they are observed in exactly the same subjects
+    _, group = np.unique(np.packbits(observed, axis = 0).T, axis = 0, return_inverse = True)
+    group = group.ravel()
+    order = np.argsort(group, kind = 'stable')
+    bounds = np.cumsum(np.bincount(group))[:-1]
+    for cols in np.split(order, bounds):
+        rows = observed[:, cols[0]]
+        Yg = Y[np.ix_(rows, cols)]
+        Y[:, cols] = np.nan
+        if not np.any(rows):
+            continue
+        Xg = X[rows]
+        beta = np.linalg.lstsq(Xg, Yg, rcond = None)[0]
+        Y[np.ix_(rows, cols)] = Yg - np.dot(Xg, beta)
+    if inplace:
+        # reshape copies non-contiguous targets, write residuals back in that case
+        if not np.shares_memory(Y, targets):
+            targets[...] = Y.reshape(targets.shape)
+        return targets
+    return Y.reshape(np.shape(targets))
@@ -0,0 +1,144 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode:nil -*-
+# vi: set ft=python sts=4 sw=4 et:
+
+"""
+Tools for probabilistic maps, shared by surface and volume methods.
+Labels are along the last axis of probabilistic maps, so surface (n_vertex x n_label, n_vertex x 1 x 1 x n_label)
+and volume (x, y, z, n_label) maps are handled the same way.
+"""
+
+from collections.abc import Iterator
+import numpy as np
+
+# row number of probabilistic maps processed at once
+_CHUNKSIZE = 65536
+
+def _row_order(data):
+    """
+    Memory order to flatten data in, 'F' for Fortran-ordered data (e.g. nibabel images) and 'C' otherwise
+    """
+    if data.flags.f_contiguous and not data.flags.c_contiguous:
+        return 'F'
+    return 'C'
+
+def _as_rows(data):
+    """
+    View data as rows of its last axis, only non-contiguous data is copied
+    Rows are in memory order of data, results of rows should be reshaped back with the same order
+
+    Return:
+    -------
+    rows: n_row x data.shape[-1] array
+    order: 'C' or 'F', order rows are flattened in
+    """
+    data = np.asarray(data)
+    order = _row_order(data)
+    return data.reshape(-1, data.shape[-1], order = order), order
+
+def make_mpm(pm, threshold, consider_baseline = False):
+    """
+    Make maximum probabilistic map (mpm)
+    Probabilities lower than threshold (and nan) are discarded, each vertex/voxel is assigned to the label with the maximum probability left.
+    Maps are processed in chunks of rows, no padded copy of the whole pm is made.
+
+    Parameters:
+    -----------
+    pm: probabilistic maps, labels are along the last axis, e.g. n_vertex x n_label or x x y x z x n_label
+    threshold: threshold, or a list of thresholds to make one mpm for each of them
+    consider_baseline: whether consider baseline or not when compute mpm
+                       if True, vertices that contain several probabilities with p1+p2+...+pn < 0.5 are discarded
+                       Details see Liang Wang, et al., Probabilistic Maps of Visual Topology in Human Cortex, 2015
+
+    Return:
+    -------
+    mpm: maximum probabilistic map with shape of pm.shape[:-1] (+ n_threshold if threshold is a list)
+         value i means the i-th label (from 1), 0 for background, uint16 if there're less than 65536 labels
+
+    Example:
+    --------
+    >>> mpm = make_mpm(pm, 0.2, consider_baseline = True)
+    >>> mpms = make_mpm(pm, np.arange(0, 1, 0.1))
+    """
+    pm = np.asarray(pm)
+    thresholds = np.asarray(threshold, dtype = np.float64)
+    rows, order = _as_rows(pm)
+    n_row, n_label = rows.shape
+    mpm = np.zeros((n_row, thresholds.size), dtype = np.promote_types(np.uint16, np.min_scalar_type(n_label)))
+    for start in range(0, n_row, _CHUNKSIZE):
+        block = rows[start:start+_CHUNKSIZE]
+        for j, thr in enumerate(thresholds.ravel()):
+            masked = np.where(block >= thr, block, 0)
+            label = np.argmax(masked, axis = 1)
+            keep = masked[np.arange(label.size), label] > 0
+            if consider_baseline is True:
+                keep &= ~((np.count_nonzero(masked, axis = 1) > 1) & (np.sum(masked, axis = 1) < 0.5))
+            mpm[start:start+block.shape[0], j] = np.where(keep, label+1, 0)
+    if thresholds.ndim == 0:
+        return mpm[:, 0].reshape(pm.shape[:-1], order = order)
+    return mpm.reshape(pm.shape[:-1]+(thresholds.size,), order = order)
+
+def make_apm(act_data, threshold):
+    """
+    Make activation probabilistic map (apm), the fraction of subjects whose activation is not lower than threshold
+    Activation values are binned by sorted thresholds once, apm of all thresholds come from cumulative per-vertex/voxel histograms,
+    so neither the input nor a binarized copy of it is made for each threshold.
+
+    Parameters:
+    -----------
+    act_data: merged activation maps (array or array-like, e.g. nibabel dataobj), subjects are along the last axis
+              or an iterator of activation maps of each subject (e.g. a generator loading them from disk), which are accumulated one by one
+    threshold: threshold of activation value, or a list of thresholds
+               zero and nan values are taken as not activated
+
+    Return:
+    -------
+    apm: activation probabilistic map with shape of one activation map (+ n_threshold if threshold is a list)
+
+    Example:
+    --------
+    >>> apm = make_apm(act_merge, 2.3)
+    >>> apms = make_apm((nib.load(f).get_data() for f in zstat_files), np.arange(1, 6, 0.1))
+    """
+    thresholds = np.asarray(threshold, dtype = np.float64)
+    thr_order = np.argsort(thresholds.ravel(), kind = 'stable')
+    sorted_thr = thresholds.ravel()[thr_order]
+    if not isinstance(act_data, Iterator):
+        act_data = np.asarray(act_data)
+        spatial_shape = act_data.shape[:-1]
+        rows, order = _as_rows(act_data)
+        n_subj = rows.shape[1]
+        counts = np.zeros((rows.shape[0], sorted_thr.size), dtype = np.int64)
+        for start in range(0, rows.shape[0], _CHUNKSIZE):
+            counts[start:start+_CHUNKSIZE] = _activation_counts(rows[start:start+_CHUNKSIZE], sorted_thr)
+    else:
+        counts, n_subj, spatial_shape = None, 0, None
+        for actmap in act_data:
+            actmap = np.asarray(actmap)
+            if counts is None:
+                spatial_shape = actmap.shape
+                order = _row_order(actmap)
+                counts = np.zeros((actmap.size, sorted_thr.size), dtype = np.int64)
+            elif actmap.shape != spatial_shape:
+                raise Exception('Activation maps should have the same shape')
+            counts += _activation_counts(actmap.reshape(-1, 1, order = order), sorted_thr)
+            n_subj += 1
+        if counts is None:
+            raise Exception('No activation map is given')
+    apm = np.empty(counts.shape)
+    apm[:, thr_order] = counts/float(n_subj)
+    if thresholds.ndim == 0:
+        return apm[:, 0].reshape(spatial_shape, order = order)
+    return apm.reshape(spatial_shape+(thresholds.size,), order = order)
+
+def _activation_counts(block, sorted_thr):
+    """
+    Number of values not lower than each of sorted thresholds in each row of block
+    """
+    n_row = block.shape[0]
+    valid = np.isfinite(block) & (block != 0)
+    row = np.broadcast_to(np.arange(n_row)[:, np.newaxis], block.shape)[valid]
+    # bin of a value is the number of thresholds not higher than it
+    bins = np.searchsorted(sorted_thr, block[valid], side = 'right')
+    hist = np.bincount(row*(sorted_thr.size+1) + bins, minlength = n_row*(sorted_thr.size+1)).reshape(n_row, sorted_thr.size+1)
+    # a value is counted by thresholds lower than its bin
+    return np.cumsum(hist[:, ::-1], axis = 1)[:, ::-1][:, 1:]
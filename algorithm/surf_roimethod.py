@@ -1,9 +1,15 @@
 # emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode:nil -*-
 # vi: set ft=python sts=4 sw=4 et:
 
+import os
+import json
+import multiprocessing
+import warnings
 import numpy as np
-from surf_tools import caloverlap
-import tools
+from scipy import sparse
+from . import label_tools
+from . import pm_tools
+from .tools import calc_overlap as caloverlap
 
 def mask_apm(act_merge, thr):
     """
@@ -11,23 +17,19 @@ def mask_apm(act_merge, thr):
 
     Parameters:
     -----------
-    act_merge: merged activation map
-    thr_val: threshold of activation value
+    act_merge: merged activation map, or an iterator of activation maps of each subject, see pm_tools.make_apm
+    thr_val: threshold of activation value, or a list of thresholds
 
     Return:
     -------
-    apm: activation probabilistic map
+    apm: activation probabilistic map, the last axis is threshold if thr is a list
 
     Example:
     --------
     >>> apm = mask_apm(act_merge, thr = 5.0)
+    >>> apms = mask_apm(act_merge, thr = np.arange(1.0, 6.0, 0.1))
     """
-    import copy
-    act_tmp = copy.deepcopy(act_merge)
-    act_tmp[act_tmp<thr] = 0
-    act_tmp[act_tmp!=0] = 1
-    apm = np.mean(act_tmp,axis=-1)
-    return apm
+    return pm_tools.make_apm(act_merge, thr)
 
 def make_pm(mask, meth = 'all', labelnum = None):
     """
@@ -36,7 +38,7 @@ def make_pm(mask, meth = 'all', labelnum = None):
     Parameters:
     -----------
     mask: merged mask
-          note that should be 2/4 dimension data
+          note that should be 2/4 dimension data, or label_tools.LabelIndex/label_tools.LabelStack of the merged mask
     meth: 'all' or 'part'
           'all', all subjects are taken into account
           'part', part subjects are taken into account, except subject with no roi label in specific roi
@@ -51,28 +53,49 @@ def make_pm(mask, meth = 'all', labelnum = None):
     >>> pm = make_pm(mask, 'all')
     
     """
-    if (mask.ndim != 2)&(mask.ndim != 4):
+    if isinstance(mask, label_tools.LabelStack):
+        return _make_pm_labelstack(mask, meth, labelnum)
+    lblindex = label_tools.as_labelindex(mask)
+    if (len(lblindex.shape) != 2)&(len(lblindex.shape) != 4):
         raise Exception('masks should be a 2/4 dimension file to get pm')
-    if mask.ndim == 4:
-        mask = mask.reshape(mask.shape[0], mask.shape[3])
+    if meth not in ('all', 'part'):
+        raise Exception('Miss parameter meth')
+    n_vertex, n_subj = lblindex.shape[0], lblindex.shape[-1]
     if labelnum is None:
-        labels = range(1, int(np.max(mask))+1)
+        labels = range(1, lblindex.labelnum+1)
     else:
         labels = range(1, labelnum+1)
-    pm = np.zeros((mask.shape[0],len(labels)))
-    if meth == 'all':
-        for i,e in enumerate(labels):
-            pm[...,i] = np.mean(mask == e, axis = 1)
-    elif meth == 'part':
-        for i,e in enumerate(labels):
-            mask_i = mask == e
-            subj = np.any(mask_i, axis = 0)
-            pm[...,i] = np.mean(mask_i[...,subj],axis = 1)
-    else:
-        raise Exception('Miss parameter meth')
+    pm = np.zeros((n_vertex,len(labels)))
+    # flat index of a merged mask is vertex*n_subj+subject
+    for i,e in enumerate(labels):
+        roiloc = lblindex.roi(e)
+        if meth == 'all':
+            pm[...,i] = np.bincount(roiloc//n_subj, minlength = n_vertex)/float(n_subj)
+        else:
+            subj = np.unique(roiloc%n_subj)
+            if subj.size:
+                pm[...,i] = np.bincount(roiloc//n_subj, minlength = n_vertex)/float(subj.size)
+            else:
+                pm[...,i] = np.nan
     pm = pm.reshape((pm.shape[0], 1, 1, pm.shape[1]))
     return pm
 
+def _make_pm_labelstack(lblstack, meth = 'all', labelnum = None):
+    """
+    Compute probabilistic map from label_tools.LabelStack, labels absent from lblstack are taken as empty regions
+    """
+    if labelnum is None:
+        labelnum = int(np.max(lblstack.labels)) if lblstack.n_label else 0
+    pm_stack = lblstack.pm(meth)
+    if meth == 'all':
+        pm = np.zeros((lblstack.n_vertex, labelnum))
+    else:
+        pm = np.full((lblstack.n_vertex, labelnum), np.nan)
+    for i,e in enumerate(lblstack.labels):
+        if (e >= 1)&(e <= labelnum):
+            pm[:,int(e)-1] = pm_stack[:,i]
+    return pm.reshape((pm.shape[0], 1, 1, pm.shape[1]))
+
 def make_mpm(pm, threshold, consider_baseline = False):
     """
     Make maximum probablistic map (mpm)
@@ -88,31 +111,23 @@ def make_mpm(pm, threshold, consider_baseline = False):
     
     Return:
     -------
-    mpm: maximum probabilistic map
+    mpm: maximum probabilistic map, n_vertex x 1 x 1 uint16 array, see pm_tools.make_mpm
     
     Example:
     >>> mpm = make_mpm(pm, 0.2)
     """
     if (pm.ndim != 4)&(pm.ndim != 2):
         raise Exception('Probablistic map should be 2/4 dimension to get maximum probablistic map')
-    if pm.ndim == 4:
-        pm = pm.reshape(pm.shape[0], pm.shape[3])
-    pm[np.isnan(pm)] = 0
-    pm_temp = np.zeros((pm.shape[0], pm.shape[1]+1))
-    pm_temp[:, range(1,pm.shape[1]+1)] = pm
-    pm_temp[pm_temp<threshold] = 0
-    if consider_baseline is True:
-        vex_discard = [(np.count_nonzero(pm_temp[i,:])>1)&((np.sum(pm_temp[i,:]))<0.5) for i in range(pm_temp.shape[0])]
-        vex_disind = [i for i,e in enumerate(vex_discard) if e]
-        pm_temp[vex_disind,:] = 0 
-    mpm = np.argmax(pm_temp, axis=1)
+    mpm = pm_tools.make_mpm(pm, threshold, consider_baseline)
     mpm = mpm.reshape((mpm.shape[0], 1, 1))
     return mpm
     
-def nfold_maximum_threshold(imgdata, labels, labelnum = None, index = 'dice', prob_meth = 'part', n_fold=2, thr_range = [0,1,0.1], n_permutation=1, controlsize = False, actdata = None):
+def nfold_maximum_threshold(imgdata, labels, labelnum = None, index = 'dice', prob_meth = 'part', n_fold=2, thr_range = [0,1,0.1], n_permutation=1, controlsize = False, actdata = None, seed = None, n_jobs = 1, outpath = None):
     """
     Decide the maximum threshold from raw image data.
     Here using the cross validation method to decide threhold using for getting the maximum probabilistic map
+    Splits of all permutations are generated in advance from a seeded random generator, so results are reproducible
+    no matter how permutations are distributed to processes.
     
     Parameters:
     -----------
@@ -123,48 +138,205 @@ def nfold_maximum_threshold(imgdata, labels, labelnum = None, index = 'dice', pr
     prob_meth: 'all' or 'part' subjects to use to compute probablistic map
     n_fold: split data into n_fold part, using first n_fold-1 part to get probabilistic map, then using rest part to evaluate overlap condition, by default is 2
     thr_range: pre-set threshold range to find the best maximum probabilistic threshold, the best threshold will search in this parameters, by default is [0,1,0.1], as the format of [start, stop, step]
-    n_permuation: times of permutation, by default is 10
+    n_permuation: times of permutation, by default is 1
     controlsize: whether control label data size with template mpm label size or not, by default is False.
     actdata: if controlsize is True, please input actdata as a parameter. By default is None.
+    seed: seed of random generator to split subjects, by default is None
+    n_jobs: process number, by default is 1. Input data are shared with processes by shared memory.
+    outpath: directory to save result of each permutation once it finished, by default is None, which saves nothing
+             rerun with the same outpath (and the same seed and parameters) resumes from finished permutations, rerun with different parameters is refused
+             splits are saved in outpath too, if seed is None, a rerun reuses saved splits instead of drawing new ones
 
     Return:
     -------
     output_overlap: dice coefficient/percentage computed from function
                     output_dice consists of a 4 dimension array
-                    permutation x threhold x subjects x regions
+                    permutation x subjects x threhold x regions
                     the first dimension permutation means the results of each permutation
-                    the second dimension threhold means the results of pre-set threshold
-                    the third dimension subjects means the results of each subject
+                    the second dimension subjects means the results of each subject
+                    the third dimension threhold means the results of pre-set threshold
                     the fourth dimension regions means the result of each region
     
     Example:
     --------
-    >>> output_overlap = nfold_maximum_threshold(imgdata, [2,4], labelnum = 4)
+    >>> output_overlap = nfold_maximum_threshold(imgdata, [2,4], labelnum = 4, n_permutation = 1000, seed = 0, n_jobs = 8, outpath = 'nfold_perm')
     """        
     assert (imgdata.ndim==2)|(imgdata.ndim==4), "imgdata should be 2/4 dimension"
     if imgdata.ndim == 4:
         imgdata = imgdata.reshape((imgdata.shape[0], imgdata.shape[3]))
+    if (actdata is not None) and (actdata.ndim == 4):
+        actdata = actdata.reshape((actdata.shape[0], actdata.shape[3]))
     n_subj = imgdata.shape[1]
     if labelnum is None:
         labelnum = int(np.max(np.unique(imgdata)))
     assert (np.max(labels)<labelnum+1), "the maximum of labels should smaller than labelnum"
-    output_overlap = []
-    for n in range(n_permutation):
-        print("permutation {} starts".format(n+1))
-        test_subj = np.sort(np.random.choice(range(n_subj), n_subj-n_subj/n_fold, replace = False)).tolist()
-        verify_subj = [val for val in range(n_subj) if val not in test_subj]
-        test_data = imgdata[:,test_subj]
-        verify_data = imgdata[:,verify_subj]
-        if actdata is not None:
-            verify_actdata = actdata[...,verify_subj]
-        else:
-            verify_actdata = None
-        pm = make_pm(test_data, prob_meth, labelnum)
-        pm_temp = cv_pm_overlap(pm, verify_data, labels, labels, index = index, cmpalllbl = False, controlsize = controlsize, actdata = verify_actdata)
-        output_overlap.append(pm_temp)
-    output_overlap = np.array(output_overlap)
+    splits = permutation_splits(n_subj, n_subj - n_subj//n_fold, n_permutation, seed)
+    params = {'labels': labels, 'labelnum': labelnum, 'index': index, 'prob_meth': prob_meth, 'thr_range': thr_range, 'controlsize': controlsize}
+
+    finished = {}
+    if outpath is not None:
+        splits, finished = _load_permutations(outpath, splits, params, imgdata.shape, seed)
+    todo = [(n, splits[n]) for n in range(n_permutation) if n not in finished]
+    arrays = {'imgdata': imgdata}
+    if actdata is not None:
+        arrays['actdata'] = actdata
+    if n_jobs == 1:
+        _init_nfold(arrays, params)
+        results = map(_nfold_permutation, todo)
+        shms = []
+    else:
+        shms, shminfo = _share_arrays(arrays)
+        pool = multiprocessing.Pool(n_jobs, initializer = _init_nfold_shared, initargs = (shminfo, params))
+        results = pool.imap_unordered(_nfold_permutation, todo)
+    completed = False
+    try:
+        for n, pm_temp in results:
+            print("permutation {} finished".format(n+1))
+            finished[n] = pm_temp
+            if outpath is not None:
+                _save_permutation(outpath, n, pm_temp)
+        completed = True
+    finally:
+        if n_jobs != 1:
+            # do not wait for remaining tasks if a worker failed
+            if completed:
+                pool.close()
+            else:
+                pool.terminate()
+            pool.join()
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+        _nfold_state.clear()
+    output_overlap = np.array([finished[n] for n in range(n_permutation)])
     return output_overlap
 
+def permutation_splits(n_subj, n_test, n_permutation, seed = None):
+    """
+    Pre-generate subject splits of permutations from a seeded numpy.random.Generator
+
+    Parameters:
+    -----------
+    n_subj: subject number
+    n_test: number of subjects used to make probabilistic map in each permutation
+    n_permutation: permutation number
+    seed: seed of random generator
+
+    Return:
+    -------
+    splits: n_permutation x n_test array, sorted subjects used to make probabilistic map in each permutation
+    """
+    rng = np.random.default_rng(seed)
+    splits = np.empty((n_permutation, n_test), dtype = np.int64)
+    for n in range(n_permutation):
+        splits[n] = np.sort(rng.choice(n_subj, n_test, replace = False))
+    return splits
+
+# input data and parameters shared by processes of nfold_maximum_threshold
+_nfold_state = {}
+
+def _init_nfold(arrays, params):
+    _nfold_state.update(arrays)
+    _nfold_state['params'] = params
+
+def _init_nfold_shared(shminfo, params):
+    """
+    Attach input arrays from shared memory in worker process
+    """
+    from multiprocessing import shared_memory
+    arrays = {}
+    shms = []
+    for key, (name, shape, dtype) in shminfo.items():
+        shm = shared_memory.SharedMemory(name = name)
+        shms.append(shm)
+        arrays[key] = np.ndarray(shape, dtype = dtype, buffer = shm.buf)
+    _nfold_state['shms'] = shms
+    _init_nfold(arrays, params)
+
+def _share_arrays(arrays):
+    """
+    Copy arrays into shared memory, return shared memory blocks and their (name, shape, dtype)
+    """
+    from multiprocessing import shared_memory
+    shms = []
+    shminfo = {}
+    for key, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        shm = shared_memory.SharedMemory(create = True, size = max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype = array.dtype, buffer = shm.buf)[...] = array
+        shms.append(shm)
+        shminfo[key] = (shm.name, array.shape, array.dtype.str)
+    return shms, shminfo
+
+def _nfold_permutation(task):
+    """
+    One permutation of nfold_maximum_threshold
+    """
+    n, test_subj = task
+    params = _nfold_state['params']
+    imgdata = _nfold_state['imgdata']
+    verify_subj = np.setdiff1d(np.arange(imgdata.shape[1]), test_subj)
+    test_data = imgdata[:,test_subj]
+    verify_data = imgdata[:,verify_subj]
+    if 'actdata' in _nfold_state:
+        verify_actdata = _nfold_state['actdata'][...,verify_subj]
+    else:
+        verify_actdata = None
+    pm = make_pm(test_data, params['prob_meth'], params['labelnum'])
+    pm_temp = cv_pm_overlap(pm, verify_data, params['labels'], params['labels'], index = params['index'], thr_range = params['thr_range'], cmpalllbl = False, controlsize = params['controlsize'], actdata = verify_actdata)
+    return n, pm_temp
+
+def _save_permutation(outpath, n, result):
+    """
+    Save result of one permutation, file is renamed after written to avoid partial files
+    """
+    tmpfile = os.path.join(outpath, 'permutation_{0}.tmp.npy'.format(n))
+    np.save(tmpfile, result)
+    os.replace(tmpfile, os.path.join(outpath, 'permutation_{0}.npy'.format(n)))
+
+def _load_permutations(outpath, splits, params, datashape, seed):
+    """
+    Load splits and finished permutations from outpath
+    Splits and run parameters (params and shape of data) are saved at the first run and checked when resuming,
+    splits of a run without seed are not reproducible, so saved splits are reused instead
+    """
+    if not os.path.isdir(outpath):
+        os.makedirs(outpath)
+    splitfile = os.path.join(outpath, 'splits.npy')
+    paramfile = os.path.join(outpath, 'params.json')
+    runparams = {'labels': np.asarray(params['labels']).tolist(),
+                 'labelnum': int(params['labelnum']),
+                 'index': params['index'],
+                 'prob_meth': params['prob_meth'],
+                 'thr_range': np.asarray(params['thr_range'], dtype = np.float64).tolist(),
+                 'controlsize': bool(params['controlsize']),
+                 'datashape': [int(e) for e in datashape]}
+    if os.path.isfile(splitfile) or os.path.isfile(paramfile):
+        if not (os.path.isfile(splitfile) and os.path.isfile(paramfile)):
+            raise Exception('Splits or parameters of finished permutations are missing in {0}, please use a new outpath'.format(outpath))
+        savedsplits = np.load(splitfile)
+        if seed is None:
+            if savedsplits.shape != splits.shape:
+                raise Exception('Splits saved in {0} differ in shape from current splits, please check n_fold and n_permutation'.format(outpath))
+            splits = savedsplits
+        elif not np.array_equal(savedsplits, splits):
+            raise Exception('Splits saved in {0} differ from current splits, please check seed and parameters'.format(outpath))
+        with open(paramfile, 'r') as f:
+            savedparams = json.load(f)
+        diffkeys = sorted(k for k in runparams if savedparams.get(k) != runparams[k])
+        if diffkeys:
+            raise Exception('Parameters {0} saved in {1} differ from current parameters, please use a new outpath'.format(diffkeys, outpath))
+    else:
+        np.save(splitfile, splits)
+        with open(paramfile, 'w') as f:
+            json.dump(runparams, f)
+    finished = {}
+    for n in range(splits.shape[0]):
+        permfile = os.path.join(outpath, 'permutation_{0}.npy'.format(n))
+        if os.path.isfile(permfile):
+            finished[n] = np.load(permfile)
+    return splits, finished
+
 def leave1out_maximum_threshold(imgdata, labels, labelnum = None, index = 'dice', prob_meth = 'part', thr_range = [0,1,0.1], controlsize = False, actdata = None):
     """
     A leave one out cross validation metho for threshold to best overlapping in probabilistic map
@@ -195,15 +367,40 @@ def leave1out_maximum_threshold(imgdata, labels, labelnum = None, index = 'dice'
     """
     if imgdata.ndim == 4:
         imgdata = imgdata.reshape(imgdata.shape[0], imgdata.shape[-1])
-    if actdata.ndim == 4:
+    if (actdata is not None) and (actdata.ndim == 4):
         actdata = actdata.reshape(actdata.shape[0], actdata.shape[-1])
+    if prob_meth not in ('all', 'part'):
+        raise Exception('Miss parameter meth')
+    n_vertex, n_subj = imgdata.shape
+    if labelnum is None:
+        labelnum = int(np.max(imgdata))
+    # label counts of all subjects are computed once, then each subject is subtracted and added back
+    lblcode = np.zeros(imgdata.shape, dtype = np.int64)
+    inrange = (imgdata >= 1) & (imgdata <= labelnum)
+    lblcode[inrange] = imgdata[inrange]
+    vertex, subj = np.nonzero(inrange)
+    lblpos = lblcode[vertex, subj] - 1
+    counts = np.bincount(vertex*labelnum + lblpos, minlength = n_vertex*labelnum).reshape(n_vertex, labelnum).astype(np.float64)
+    hasroi = np.zeros((n_subj, labelnum), dtype = bool)
+    hasroi[subj, lblpos] = True
+    n_hasroi = np.sum(hasroi, axis = 0)
     output_overlap = []
-    for i in range(imgdata.shape[-1]):
-        data_temp = np.delete(imgdata, i, axis=1)
+    for i in range(n_subj):
+        subj_vertex = np.flatnonzero(inrange[:,i])
+        subj_lblpos = lblcode[subj_vertex, i] - 1
+        counts[subj_vertex, subj_lblpos] -= 1
+        if prob_meth == 'all':
+            pm = counts/float(n_subj-1)
+        else:
+            with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                pm = counts/(n_hasroi - hasroi[i]).astype(np.float64)
+        counts[subj_vertex, subj_lblpos] += 1
         testdata = np.expand_dims(imgdata[:,i],axis=1)
-        test_actdata = np.expand_dims(actdata[:,i],axis=1)
-        pm = make_pm(data_temp, prob_meth, labelnum)
-        pm_temp = cv_pm_overlap(pm, testdata, labels, labels, index = index, cmpalllbl = False, controlsize = controlsize, actdata = test_actdata)
+        if actdata is not None:
+            test_actdata = np.expand_dims(actdata[:,i],axis=1)
+        else:
+            test_actdata = None
+        pm_temp = cv_pm_overlap(pm.reshape(n_vertex, 1, 1, labelnum), testdata, labels, labels, index = index, thr_range = thr_range, cmpalllbl = False, controlsize = controlsize, actdata = test_actdata)
         output_overlap.append(pm_temp)
     output_array = np.array(output_overlap)
     return output_array.reshape(output_array.shape[0], output_array.shape[2], output_array.shape[3])
@@ -212,6 +409,7 @@ def pm_overlap(pm1, pm2, thr_range, option = 'number', index = 'dice'):
     """
     Analysis for probabilistic map overlap without using test data 
     The idea of this analysis is to control vertices number/threshold same among pm1 and pm2, binaried them then compute overlap
+    Both maps are sorted once, the whole overlap curve is got from cumulative counts over ranks (or sorted values)
     
     Parameters:
     -----------
@@ -219,40 +417,78 @@ def pm_overlap(pm1, pm2, thr_range, option = 'number', index = 'dice'):
     pm2: probabilistic map 2
     thr_range: threshold range, format as [min, max, step], which could be vertex numbers or probablistic threshold
     option: 'number', compute overlap between probablistic maps by multiple vertex numbers
+                      vertices with the highest k non-zero values are kept
             'threshold', compute overlap between probablistic maps by multiple thresholds
+                      vertices with values higher than threshold are kept
     index: 'dice', overlap indices as dice coefficient
-           'percent', overlap indices as percent
+           'percent', overlap indices as percent, overlap/vertex number of pm1
+
+    Return:
+    -------
+    output_overlap: overlap of each threshold, 0 if not defined
+
+    Example:
+    --------
+    >>> output_overlap = pm_overlap(pm1, pm2, [100, 2000, 100], 'number')
     """
     assert (pm1.ndim == 1)|(pm1.ndim == 3), "pm1 should not contain multiple probablistic map"
     assert (pm2.ndim == 1)|(pm2.ndim == 3), "pm2 should not contain multiple probablistic map" 
-    if pm1.ndim == 3:
-        pm1 = pm1.reshape(pm1.shape[0], pm1.shape[-1])
-    if pm1.ndim == 1:
-        pm1 = np.expand_dims(pm1, axis=0)
-    if pm2.ndim == 3:
-        pm2 = pm2.reshape(pm2.shape[0], pm2.shape[-1])
-    if pm2.ndim == 1:
-        pm2 = np.expand_dims(pm2, axis=0)
-
     assert len(thr_range) == 3, "thr_range should be a 3 elements list, as [min, max, step]"
+    pm1 = np.nan_to_num(np.asarray(pm1, dtype = np.float64).ravel())
+    pm2 = np.nan_to_num(np.asarray(pm2, dtype = np.float64).ravel())
+    if pm1.size != pm2.size:
+        raise Exception('pm1 and pm2 should have the same size')
+    thresholds = np.arange(thr_range[0], thr_range[1], thr_range[2])
     if option == 'number':
-        thre_func = tools.threshold_by_number
+        size1, size2, intersection = _overlap_curve_by_number(pm1, pm2, thresholds)
     elif option == 'threshold':
-        thre_func = tools.threshold_by_values
+        size1, size2, intersection = _overlap_curve_by_value(pm1, pm2, thresholds)
     else:
         raise Exception('Missing option')
-
-    output_overlap = []
-    for i in np.arange(thr_range[0], thr_range[1], thr_range[2]):
-        print('Computing overlap of vertices {}'.format(i))
-        pm1_thr = thre_func(pm1, i)
-        pm2_thr = thre_func(pm2, i)
-        pm1_thr[pm1_thr!=0] = 1
-        pm2_thr[pm2_thr!=0] = 1
-        output_overlap.append(caloverlap(pm1_thr, pm2_thr, 1, 1))
-    output_overlap = np.array(output_overlap)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        if index == 'dice':
+            output_overlap = 2.0*intersection/(size1+size2)
+        elif index == 'percent':
+            output_overlap = 1.0*intersection/size1
+        else:
+            raise Exception("Only support 'dice' and 'percent' as overlap indices at present.")
     output_overlap[np.isnan(output_overlap)] = 0
     return output_overlap
+
+def _overlap_curve_by_number(pm1, pm2, numbers):
+    """
+    Sizes and intersections of the highest k non-zero vertices of pm1 and pm2 for each k in numbers
+    A vertex is in both top k sets if the larger one of its two ranks is lower than k
+    Ties are ranked by vertex order, same as tools.threshold_by_number
+    """
+    n_vertex = pm1.size
+    numbers = np.clip(np.asarray(numbers).astype(np.int64), 0, n_vertex)
+    rank1 = np.empty(n_vertex, dtype = np.int64)
+    rank2 = np.empty(n_vertex, dtype = np.int64)
+    order1 = np.argsort(-pm1, kind = 'stable')
+    order2 = np.argsort(-pm2, kind = 'stable')
+    rank1[order1] = np.arange(n_vertex)
+    rank2[order2] = np.arange(n_vertex)
+    # cumulative counts of the first k ranks, padded with 0 for k = 0
+    padcumsum = lambda x: np.concatenate(([0], np.cumsum(x)))
+    size1 = padcumsum(pm1[order1] != 0)[numbers]
+    size2 = padcumsum(pm2[order2] != 0)[numbers]
+    both = (pm1 != 0) & (pm2 != 0)
+    jointrank = np.maximum(rank1[both], rank2[both])
+    intersection = padcumsum(np.bincount(jointrank, minlength = n_vertex))[numbers]
+    return size1, size2, intersection
+
+def _overlap_curve_by_value(pm1, pm2, thresholds):
+    """
+    Sizes and intersections of non-zero vertices higher than each threshold in pm1 and pm2
+    A vertex is in both sets if the smaller one of its two values is higher than threshold
+    """
+    count_above = lambda values: values.size - np.searchsorted(np.sort(values), thresholds, side = 'right')
+    both = (pm1 != 0) & (pm2 != 0)
+    size1 = count_above(pm1[pm1 != 0])
+    size2 = count_above(pm2[pm2 != 0])
+    intersection = count_above(np.minimum(pm1[both], pm2[both]))
+    return size1, size2, intersection
          
 def cv_pm_overlap(pm, test_data, labels_template, labels_testdata, index = 'dice', thr_range = [0, 1, 0.1], cmpalllbl = True, controlsize = False, actdata = None):
     """
@@ -261,7 +497,7 @@ def cv_pm_overlap(pm, test_data, labels_template, labels_testdata, index = 'dice
     Parameters:
     -----------
     pm: probabilistic map
-    test_data: subject specific label data used as test data
+    test_data: subject specific label data used as test data, could be a label_tools.LabelStack
     labels_template: list, label number of template (pm) used to extract overlap values 
     label_testdata: list, label number of test data used to extract overlap values
     index: 'dice' or 'percent'
@@ -288,66 +524,207 @@ def cv_pm_overlap(pm, test_data, labels_template, labels_testdata, index = 'dice
     """
     if cmpalllbl is False:
         assert len(labels_template) == len(labels_testdata), "Notice that labels_template should have same length of labels_testdata if cmpalllbl is False"
+    if isinstance(test_data, label_tools.LabelStack):
+        if controlsize is True:
+            raise Exception('Not support to control size of label_tools.LabelStack')
+        return _cv_pm_overlap_labelstack(pm, test_data, labels_template, labels_testdata, index, thr_range, cmpalllbl)
     if test_data.ndim == 4:
         test_data = test_data.reshape(test_data.shape[0], test_data.shape[-1])
-    if actdata is not None:
+    if cmpalllbl is True:
+        lblpairs = [(lbltmp, lbltst) for lbltmp in labels_template for lbltst in labels_testdata]
+    else:
+        lblpairs = list(zip(labels_template, labels_testdata))
+    # mpm of each threshold is computed once for all subjects
+    thresholds = np.arange(thr_range[0], thr_range[1], thr_range[2])
+    mpms = pm_tools.make_mpm(pm.reshape(pm.shape[0], pm.shape[-1]), thresholds)
+    if controlsize is True:
+        if actdata is None:
+            raise Exception('Please give actdata here!')
         if actdata.ndim == 4:
             actdata = actdata.reshape(actdata.shape[0], actdata.shape[-1])
-    output_overlap = []
-    for i in range(test_data.shape[-1]):
-        mpm_temp = []
-        if actdata is not None:
-            verify_actdata = actdata[:,i]
-        else:
-            verify_actdata = None
-        for j,e in enumerate(np.arange(thr_range[0], thr_range[1], thr_range[2])):
-            print("threshold {} is verifing".format(e))
-            mpm = make_mpm(pm, e)
-            if cmpalllbl is True:
-                mpm_temp.append([caloverlap(mpm, test_data[:,i], lbltmp, lbltst, index, controlsize = controlsize, actdata = verify_actdata) for lbltmp in labels_template for lbltst in labels_testdata])
+        output_overlap = np.empty((test_data.shape[-1], len(thresholds), len(lblpairs)))
+        for i in range(test_data.shape[-1]):
+            for j in range(len(thresholds)):
+                output_overlap[i,j] = [caloverlap(mpms[:,j], test_data[:,i], lbltmp, lbltst, index, controlsize = controlsize, actdata = actdata[:,i]) for lbltmp, lbltst in lblpairs]
+        return output_overlap
+    return _overlap_table(mpms, test_data, lblpairs, index)
+
+def _onehot_columns(stack, labels):
+    """
+    Sparse indicator of labels in each column of stack
+    Entry (v, c*n_label+l) is 1 if stack[v, c] equals to the l-th label
+    """
+    stack = np.asarray(stack).reshape(stack.shape[0], -1)
+    n_label = len(labels)
+    position = label_tools.remap_labels(stack, zip(labels, np.arange(1, n_label+1)), default = 0)
+    vertex, col = np.nonzero(position)
+    cols = col*n_label + position[vertex, col].astype(np.int64) - 1
+    return sparse.csr_matrix((np.ones(vertex.size), (vertex, cols)), shape = (stack.shape[0], stack.shape[1]*n_label))
+
+def _overlap_table(mpms, test_data, lblpairs, index = 'dice'):
+    """
+    Overlap between each mpm and each subject of test data for all label pairs
+    Intersections of all (mpm, label, subject, label) combinations come from one sparse co-occurrence product
+
+    Parameters:
+    -----------
+    mpms: n_vertex x n_mpm label array
+    test_data: n_vertex x n_subj label array
+    lblpairs: list of (mpm label, test data label)
+    index: 'dice' or 'percent', 'percent' is overlap/mpm label size
+
+    Return:
+    -------
+    overlap: n_subj x n_mpm x n_pair array, nan if not defined
+    """
+    tmplabels = np.unique([lbltmp for lbltmp, _ in lblpairs])
+    tstlabels = np.unique([lbltst for _, lbltst in lblpairs])
+    tmp_onehot = _onehot_columns(mpms, tmplabels)
+    tst_onehot = _onehot_columns(test_data, tstlabels)
+    cooccur = (tmp_onehot.T*tst_onehot).toarray()
+    tmpsize = np.asarray(tmp_onehot.sum(axis = 0)).ravel()
+    tstsize = np.asarray(tst_onehot.sum(axis = 0)).ravel()
+    n_mpm, n_subj = mpms.shape[1], test_data.shape[1]
+    tmprow = lambda lbl: np.arange(n_mpm)*tmplabels.size + np.searchsorted(tmplabels, lbl)
+    tstcol = lambda lbl: np.arange(n_subj)*tstlabels.size + np.searchsorted(tstlabels, lbl)
+    overlap = np.empty((n_subj, n_mpm, len(lblpairs)))
+    for k, (lbltmp, lbltst) in enumerate(lblpairs):
+        rows, cols = tmprow(lbltmp), tstcol(lbltst)
+        intersection = cooccur[np.ix_(rows, cols)].T
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            if index == 'dice':
+                overlap[...,k] = 2.0*intersection/(tmpsize[rows][np.newaxis,:] + tstsize[cols][:,np.newaxis])
+            elif index == 'percent':
+                overlap[...,k] = intersection/np.broadcast_to(tmpsize[rows][np.newaxis,:], intersection.shape)
             else:
-                mpm_temp.append([caloverlap(mpm, test_data[:,i], labels_template[idx], lbld, index, controlsize = controlsize, actdata = verify_actdata) for idx, lbld in enumerate(labels_testdata)])
-        output_overlap.append(mpm_temp)
-    return np.array(output_overlap)
+                raise Exception("Only support 'dice' and 'percent' as overlap indices at present.")
+    return overlap
 
-def overlap_bysubject(imgdata, labels, subj_range, labelnum = None, prob_meth = 'part', index = 'dice'):
+def _cv_pm_overlap_labelstack(pm, lblstack, labels_template, labels_testdata, index = 'dice', thr_range = [0, 1, 0.1], cmpalllbl = True):
+    """
+    cv_pm_overlap for test data stored as label_tools.LabelStack, all subjects are computed at once
+    """
+    if cmpalllbl is True:
+        lblpairs = [(lbltmp, lbltst) for lbltmp in labels_template for lbltst in labels_testdata]
+    else:
+        lblpairs = list(zip(labels_template, labels_testdata))
+    thresholds = np.arange(thr_range[0], thr_range[1], thr_range[2])
+    mpms = pm_tools.make_mpm(pm.reshape(pm.shape[0], pm.shape[-1]), thresholds)
+    output_overlap = np.empty((lblstack.n_subj, len(thresholds), len(lblpairs)))
+    for j in range(len(thresholds)):
+        for k,(lbltmp, lbltst) in enumerate(lblpairs):
+            output_overlap[:,j,k] = lblstack.overlap(mpms[:,j], lbltst, lbltmp, index)
+    return output_overlap
+
+def overlap_bysubject(imgdata, labels, subj_range, labelnum = None, prob_meth = 'part', index = 'dice', n_repeat = 1, ci = 95, seed = None, n_jobs = 1, return_ci = False):
     """
     A function used for computing overlap between template (probilistic map created by all subjects) and probabilistic map of randomly chosen subjects.
+    Overlap is computed between non-zero regions of probabilistic maps.
+    In each repeat subjects are shuffled once and subsets of increasing size are taken from the head of the shuffled order,
+    so label counts of a subset are accumulated from the previous one with only the newly added subjects.
     
     Parameters:
     -----------
-    imgdata: label image data
+    imgdata: label image data, or its label_tools.LabelStack
     labels: list, label number indicated regions
     subj_range: range of subjects, the format as [minsubj, maxsubj, step]
     labelnum: label numbers, by default is None
     prob_meth: method for probabilistic map, 'all' to compute all subjects that contains non-regions, 'part' to compute part subjects that ignore subjects with non-regions.
+               non-zero regions of both kinds of probabilistic map are the same, so labelnum and prob_meth do not change overlap.
+    index: 'dice' or 'percent', 'percent' is overlap/template size
+    n_repeat: repeat times of random subsets for each amount of subjects, by default is 1
+    ci: confidence interval in percent, by default is 95
+    seed: seed of random generator to draw subsets, by default is None
+    n_jobs: process number, repeats are distributed to processes, by default is 1
+    return_ci: return confidence interval or not, by default is False
 
     Returns:
     --------
-    overlap_subj: overlap indices of each amount of subjects
+    overlap_mean: mean overlap indices of repeats, amount of subjects x labels
+    overlap_ci: lower and upper bound of confidence interval, 2 x amount of subjects x labels, returned if return_ci is True
 
     Example:
     --------
-    >>> overlap_subj = overlap_bysubject(imgdata, [4], [0,100,10], labelnum = 4) 
-    """
-    nsubj = imgdata.shape[-1]
-    pm = make_pm(imgdata, meth = prob_meth, labelnum = labelnum)
-    overlap_subj = []
-    for i in np.arange(subj_range[0], subj_range[1], subj_range[2]):
-        subj_num = np.random.choice(nsubj, i, replace=False)        
-        sub_imgdata = imgdata[...,subj_num]
-        if sub_imgdata.ndim == 3:
-            sub_imgdata = np.expand_dims(sub_imgdata, axis=-1)
-        pm_sub = make_pm(sub_imgdata, meth = prob_meth, labelnum = labelnum)
-        overlap_lbl = []
-        for lbl in labels:
-            pm_lbl = pm[...,lbl-1]
-            pm_sub_lbl = pm_sub[...,lbl-1]
-            pm_lbl[pm_lbl!=0] = 1
-            pm_sub_lbl[pm_sub_lbl!=0] = 1
-            overlap_lbl.append(caloverlap(pm_lbl, pm_sub_lbl, 1, 1, index = index))
-        overlap_subj.append(overlap_lbl)
-    return np.array(overlap_subj)
+    >>> overlap_subj = overlap_bysubject(imgdata, [4], [10,100,10], labelnum = 4)
+    >>> overlap_mean, overlap_ci = overlap_bysubject(imgdata, [4], [10,100,10], labelnum = 4, n_repeat = 1000, seed = 0, n_jobs = 8, return_ci = True)
+    """
+    if isinstance(imgdata, label_tools.LabelStack):
+        lblstack = imgdata
+    else:
+        lblstack = label_tools.LabelStack(imgdata, labels)
+    nsubj = lblstack.n_subj
+    subj_num = np.arange(subj_range[0], subj_range[1], subj_range[2]).astype(int)
+    if np.any(subj_num < 0) or np.any(subj_num > nsubj):
+        raise Exception('amount of subjects should be in [0, {0}]'.format(nsubj))
+    # count of each template label in each vertex, from all subjects
+    labels = np.asarray(labels).ravel()
+    lblpos = np.searchsorted(lblstack.labels, labels)
+    stored = (lblpos < lblstack.n_label) & (lblstack.labels[np.minimum(lblpos, lblstack.n_label-1)] == labels) if lblstack.n_label else np.zeros(labels.size, dtype = bool)
+    counts = lblstack.counts()
+    ref_support = np.zeros((labels.size, lblstack.n_vertex), dtype = bool)
+    ref_support[stored] = counts[:, lblpos[stored]].T > 0
+    rng = np.random.default_rng(seed)
+    orders = [rng.permutation(nsubj) for r in range(n_repeat)]
+    params = {'subj_num': subj_num, 'lblpos': lblpos, 'stored': stored, 'index': index}
+    if n_jobs == 1:
+        _init_subsample(lblstack, ref_support, params)
+        overlap_repeat = [_subsample_overlap(order) for order in orders]
+    else:
+        pool = multiprocessing.Pool(n_jobs, initializer = _init_subsample, initargs = (lblstack, ref_support, params))
+        try:
+            overlap_repeat = pool.map(_subsample_overlap, orders)
+        finally:
+            pool.close()
+            pool.join()
+    _subsample_state.clear()
+    overlap_repeat = np.array(overlap_repeat).reshape(n_repeat, subj_num.size, labels.size)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        overlap_mean = np.nanmean(overlap_repeat, axis = 0)
+        if not return_ci:
+            return overlap_mean
+        overlap_ci = np.nanpercentile(overlap_repeat, [(100-ci)/2.0, 100-(100-ci)/2.0], axis = 0)
+    return overlap_mean, overlap_ci
+
+# label stack, template regions and parameters shared by processes of overlap_bysubject
+_subsample_state = {}
+
+def _init_subsample(lblstack, ref_support, params):
+    _subsample_state['lblstack'] = lblstack
+    _subsample_state['ref_support'] = ref_support
+    _subsample_state['params'] = params
+
+def _subsample_overlap(order):
+    """
+    Overlap curve of one repeat, order is the shuffled subjects
+    """
+    lblstack = _subsample_state['lblstack']
+    ref_support = _subsample_state['ref_support']
+    params = _subsample_state['params']
+    subj_num, lblpos, stored, index = params['subj_num'], params['lblpos'], params['stored'], params['index']
+    n_label, n_vertex = ref_support.shape
+    ref_size = np.sum(ref_support, axis = 1)
+    counts = np.zeros(n_label*n_vertex, dtype = np.int64)
+    overlap = np.full((subj_num.size, n_label), np.nan)
+    added = 0
+    for i in np.argsort(subj_num, kind = 'stable'):
+        subj = order[added:subj_num[i]]
+        added = max(added, subj_num[i])
+        if subj.size and np.any(stored):
+            rows = (subj[:, np.newaxis]*lblstack.n_label + lblpos[stored]).ravel()
+            indices, lengths = lblstack.rows_indices(rows)
+            code = np.repeat(np.tile(np.flatnonzero(stored), subj.size), lengths)*n_vertex + indices
+            counts += np.bincount(code, minlength = counts.size)
+        support = counts.reshape(n_label, n_vertex) > 0
+        intersection = np.sum(support & ref_support, axis = 1).astype(float)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            if index == 'dice':
+                overlap[i] = 2.0*intersection/(ref_size + np.sum(support, axis = 1))
+            elif index == 'percent':
+                overlap[i] = intersection/ref_size
+            else:
+                raise Exception("Only support 'dice' and 'percent' as overlap indices at present.")
+    return overlap
 
 class GetLblRegion(object):
     """
@@ -380,15 +757,9 @@ class GetLblRegion(object):
         >>> out_template = glr_cls.by_lblimg(lbldata)
         """
         assert lbldata.shape == self._template.shape, "the shape of template should be equal to the shape of lbldata"
-        labels = np.sort(np.unique(lbldata)[1:]).astype('int')
-        out_template = np.zeros_like(lbldata)
-        out_template = out_template[...,np.newaxis]
-        out_template = np.tile(out_template, (1, len(labels)))
-        for i,lbl in enumerate(labels):
-            lbldata_tmp = tools.get_specificroi(lbldata, lbl)
-            lbldata_tmp[lbldata_tmp!=0] = 1
-            part_template = self._template*lbldata_tmp
-            template_lbl = np.sort(np.unique(part_template)[1:])
-            out_template[...,i] = tools.get_specificroi(self._template, template_lbl)
+        table, labels, template_labels, _, template_pos = label_tools.label_cooccurrence(lbldata, self._template, return_positions = True)
+        # template regions (except background) touched by each roi
+        touched = (table[labels != 0] > 0) & (template_labels != 0)
+        out_template = np.where(touched.T[template_pos], self._template[...,np.newaxis], 0).astype(lbldata.dtype)
         return out_template
 
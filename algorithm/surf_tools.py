@@ -4,7 +4,8 @@
 import numpy as np
 from scipy import sparse
 from . import tools
-import copy
+from . import label_tools
+from . import mesh_tools
 
 def extract_edge_from_faces(faces):
     """
@@ -12,25 +13,21 @@ def extract_edge_from_faces(faces):
     
     Parameters:
     ----------
-    faces: faces array
+    faces: faces array or surface.Mesh
     
     Return:
     -------
-    edge: edge, format as [(i1,j1), (i2,j2), ...]
+    edge: edge, format as [(i1,j1), (i2,j2), ...], each edge appears once with i<j
 
     Example:
     -------
     >>> edge = extract_edge_from_faces(faces)
     """
-    import itertools
-    edge = []
-    for i,fa in enumerate(faces):
-        c_gen = itertools.combinations(fa, 2)
-        for j in c_gen:
-            if j not in edge:
-                edge.append(j)
-        print('{} finished'.format(i))
-    return edge
+    if hasattr(faces, 'edges'):
+        edge = faces.edges
+    else:
+        edge = mesh_tools.faces_to_edges(faces)
+    return [tuple(eg) for eg in edge.tolist()]
 
 class GenAdjacentMatrix(object):
     """
@@ -38,7 +35,7 @@ class GenAdjacentMatrix(object):
     
     Return:
     --------
-    ad_matrix: adjacent matrix
+    ad_matrix: adjacent matrix, scipy.sparse CSR matrix
     
     Example:
     --------
@@ -57,19 +54,16 @@ class GenAdjacentMatrix(object):
         edge: edge list, which have the format like below, 
               [(i1,j1), (i2,j2), ...] 
               note that i,j is the number of vertex/node
+              n_edges x 2 array is also supported
         
         Return:
         -----------
-        adjmatrix: adjacent matrix
+        adjmatrix: adjacent matrix, symmetric scipy.sparse CSR matrix
         """ 
-        assert isinstance(edge, list), "edge should be a list"
-        edge_node_num = [len(i) for i in edge]
-        assert edge_node_num.count((edge_node_num[0]) == len(edge_node_num)), "One edge should only contain 2 nodes"
-        node_number = np.max(edge)+1
-        ad_matrix = np.zeros((node_number, node_number))
-        for eg in edge:
-            ad_matrix[eg] = 1
-        ad_matrix = np.logical_or(ad_matrix, ad_matrix.T)
+        assert isinstance(edge, (list, np.ndarray)), "edge should be a list"
+        edge = np.asarray(edge)
+        assert (edge.ndim == 2)&(edge.shape[-1] == 2), "One edge should only contain 2 nodes"
+        ad_matrix = mesh_tools.edges_to_adjacency(edge)
         ad_matrix = ad_matrix.astype('int')
         return ad_matrix
 
@@ -85,14 +79,14 @@ class GenAdjacentMatrix(object):
         
         Return:
         ----------
-        adjmatrix: adjacent matrix 
+        adjmatrix: adjacent matrix, scipy.sparse CSR matrix 
         """
         assert isinstance(ring, list), "ring should be a list"
         node_number = len(ring)
-        adjmatrix = np.zeros((node_number, node_number))
-        for i,e in enumerate(ring):
-            for j in e:
-                adjmatrix[i,j] = 1
+        indptr = np.concatenate(([0], np.cumsum([len(e) for e in ring])))
+        indices = np.fromiter((j for e in ring for j in e), dtype = int, count = indptr[-1])
+        adjmatrix = sparse.csr_matrix((np.ones(indices.size), indices, indptr), shape = (node_number, node_number))
+        adjmatrix.sort_indices()
         return adjmatrix
 
 def get_masksize(mask, labelnum = None):
@@ -101,7 +95,7 @@ def get_masksize(mask, labelnum = None):
     
     Parameters:
     ----------
-    mask: label image (mask)
+    mask: label image (mask), or its label_tools.LabelIndex
     labelnum: mask's label number, use for group analysis
 
     Return:
@@ -112,30 +106,31 @@ def get_masksize(mask, labelnum = None):
     --------
     >>> masksize = get_masksize(mask)
     """
-    if mask.ndim == 3:
-        mask = mask[:,0,0]
-    labels = np.unique(mask)[1:]
+    lblindex = label_tools.as_labelindex(mask)
     if labelnum is None:
-        labelnum = int(np.max(labels))
+        labelnum = lblindex.labelnum
     masksize = []
     for i in range(labelnum):
-        masksize.append(len(mask[mask == i+1]))
+        masksize.append(lblindex.size(i+1))
     return np.array(masksize)
     
 def get_signals(atlas, mask, method = 'mean', labelnum = None):
     """
     Extract roi signals of atlas from mask
+    All rois (and all subjects) are reduced at once by label_tools.label_reduce
     
     Parameters:
     -----------
-    atlas: atlas
-    mask: mask, a label image
+    atlas: atlas, or a n_vertex x n_subj data matrix to get signals of all subjects at once
+    mask: mask, a label image or its label_tools.LabelIndex
+          a label stack (n_vertex x n_subj) is also supported when atlas is a data matrix
     method: 'mean', 'std', 'ste', 'max', 'vertex', etc.
     labelnum: mask's label numbers, add this parameters for group analysis
 
     Return:
     -------
     signals: signals of specific roi
+             n_subj x labelnum array if atlas is a data matrix or mask is a label stack
    
     Example:
     -------
@@ -143,36 +138,38 @@ def get_signals(atlas, mask, method = 'mean', labelnum = None):
     """
     if atlas.ndim == 3:
         atlas = atlas[:,0,0]
-    if mask.ndim == 3:
-        mask = mask[:,0,0]
-    
-    
-    labels = np.unique(mask)[1:]
+    if atlas.ndim == 4:
+        atlas = atlas.reshape(atlas.shape[0], -1)
+    if isinstance(mask, label_tools.LabelIndex):
+        lblindex = mask
+        mask = mask.toarray()
+    else:
+        lblindex = None
+    mask = np.asarray(mask)
+    mask = mask.reshape(mask.shape[0], -1)
     if labelnum is None:
-        try:
-            labelnum = int(np.max(labels))
-        except ValueError as e:
+        labelnum = int(np.max(mask)) if mask.size else 0
+        if labelnum == 0:
             print('value in mask are all zeros')
-            labelnum = 0
-    if method == 'mean':
-        calfunc = np.nanmean
-    elif method == 'std':
-        calfunc = np.nanstd
-    elif method == 'max':
-        calfunc = np.max
+    if method in ('mean', 'std', 'ste', 'max'):
+        signals = label_tools.label_reduce(atlas, mask, np.arange(1, labelnum+1), method)
+        # one row per subject of atlas data matrix or of label stack
+        if (atlas.ndim == 2) or (signals.shape[0] != 1):
+            return signals
+        return signals[0].tolist()
     elif method == 'vertex':
-        calfunc = np.array
-    elif method == 'ste':
-        calfunc = tools.ste
+        if lblindex is None:
+            lblindex = label_tools.LabelIndex(mask)
+        signals = []
+        for i in range(labelnum):
+            roiloc = lblindex.roi(i+1)
+            if roiloc.size:
+                signals.append(atlas[roiloc])
+            else:
+                signals.append(np.array([np.nan]))
+        return signals
     else:
         raise Exception('Miss paramter of method')
-    signals = []
-    for i in range(labelnum):
-        if np.any(mask==i+1):
-            signals.append(atlas[mask==i+1])
-        else:
-            signals.append(np.array([np.nan]))
-    return [calfunc(sg) for sg in signals]
 
 def get_vexnumber(atlas, mask, method = 'peak', labelnum = None):
     """
@@ -181,7 +178,7 @@ def get_vexnumber(atlas, mask, method = 'peak', labelnum = None):
     Parameters:
     -----------
     atlas: atlas
-    mask: mask, a label image
+    mask: mask, a label image or its label_tools.LabelIndex
     method: 'peak' ,'center', or 'vertex', 
             'peak' means peak vertex number with maximum signals from specific roi
             'vertex' means extract all vertex of each roi
@@ -197,34 +194,50 @@ def get_vexnumber(atlas, mask, method = 'peak', labelnum = None):
     """
     if atlas.ndim == 3:
         atlas = atlas[:,0,0]
-    if mask.ndim == 3:
-        mask = mask[:,0,0]
-    labels = np.unique(mask)[1:]
+    if method not in ('peak', 'center', 'vertex'):
+        raise Exception('Miss parameter of method')
+    lblindex = label_tools.as_labelindex(mask)
     if labelnum is None:
-        labelnum = int(np.max(labels))
-
-    extractpeak = lambda x: np.unravel_index(x.argmax(), x.shape)[0]
-    extractcenter = lambda x: np.mean(np.transpose(np.nonzero(x)))
-    extractvertex = lambda x: x[x!=0]
-    
+        labelnum = lblindex.labelnum
+    labels = np.arange(1, labelnum+1)
+    mask = lblindex.toarray().ravel()
+
+    if method == 'vertex':
+        vexnumber = []
+        for i in range(labelnum):
+            roisignal = atlas[lblindex.roi(i+1)]
+            if np.any(roisignal):
+                vexnumber.append(roisignal[roisignal!=0])
+            else:
+                vexnumber.append(np.array([np.nan]))
+        return vexnumber
+
+    # rois with all zero signals get nan
+    nonzero = label_tools.label_reduce(atlas != 0, mask, labels, 'sum')[0] > 0
     if method == 'peak':
-        calfunc = extractpeak
-    elif method == 'center':
-        calfunc = extractcenter
-    elif method == 'vertex':
-        calfunc = extractvertex
+        vertex = label_tools.label_reduce(atlas, mask, labels, 'peak')[0]
     else:
-        raise Exception('Miss parameter of method')
-
+        vertex = label_tools.label_reduce(np.arange(mask.size), np.where(atlas != 0, mask, 0), labels, 'mean')[0]
     vexnumber = []
     for i in range(labelnum):
-        roisignal = atlas*(mask==(i+1))
-        if np.any(roisignal):
-            vexnumber.append(calfunc(roisignal))
+        if nonzero[i]:
+            vexnumber.append(int(vertex[i]) if method == 'peak' else vertex[i])
         else:
             vexnumber.append(np.array([np.nan]))
     return vexnumber
 
+def _as_adjacency(topology):
+    """
+    CSR adjacency matrix from surface.Mesh, CSR adjacency matrix, faces array or one ring neighbour list
+    """
+    if hasattr(topology, 'adjacency'):
+        return topology.adjacency
+    if sparse.issparse(topology):
+        return topology
+    if isinstance(topology, np.ndarray) and topology.ndim == 2:
+        return mesh_tools.faces_to_adjacency(topology)
+    return GenAdjacentMatrix().from_ring(topology)
+
 def surf_dist(vtx_src, vtx_dst, one_ring_neighbour):
     """
     Distance between vtx_src and vtx_dst
@@ -238,27 +251,18 @@ def surf_dist(vtx_src, vtx_dst, one_ring_neighbour):
     the format of this matrix:
     [{i1,j1,...}, {i2,j2,k2}]
     each element correspond to a vertex label
+    CSR adjacency matrix from mesh_tools.faces_to_adjacency or surface.Mesh is also supported
 
     Return:
     -------
-    dist: distance between vtx_src and vtx_dst
+    dist: distance between vtx_src and vtx_dst, inf if they are not connected
 
     Example:
     --------
     >>> dist = surf_dist(vtx_src, vtx_dst, one_ring_neighbour)
     """
-    if len(one_ring_neighbour[vtx_dst]) == 1:
-        return np.inf
-    
-    noderep = copy.deepcopy(one_ring_neighbour[vtx_src])
-    dist = 1
-    while vtx_dst not in noderep:
-        temprep = set()
-        for ndlast in noderep:
-            temprep.update(one_ring_neighbour[ndlast])
-        noderep.update(temprep)
-        dist += 1
-    return dist
+    adjacency = _as_adjacency(one_ring_neighbour)
+    return mesh_tools.distance_field(adjacency, vtx_src)[vtx_dst]
   
 def hausdoff_distance(imgdata1, imgdata2, label1, label2, one_ring_neighbour):
     """
@@ -283,8 +287,9 @@ def hausdoff_distance(imgdata1, imgdata2, label1, label2, one_ring_neighbour):
     """
     imgdata1 = tools.get_specificroi(imgdata1, label1)
     imgdata2 = tools.get_specificroi(imgdata2, label2)
-    hd1 = _hausdoff_ab(imgdata1, imgdata2, one_ring_neighbour) 
-    hd2 = _hausdoff_ab(imgdata2, imgdata1, one_ring_neighbour)
+    adjacency = _as_adjacency(one_ring_neighbour)
+    hd1 = _hausdoff_ab(imgdata1, imgdata2, adjacency) 
+    hd2 = _hausdoff_ab(imgdata2, imgdata1, adjacency)
     return max(hd1, hd2)
  
 def _hausdoff_ab(a, b, one_ring_neighbour):
@@ -303,18 +308,8 @@ def _hausdoff_ab(a, b, one_ring_neighbour):
     h: hausdoff(a,b)
 
     """
-    a = np.array(a)
-    b = np.array(b)
-    h = 0
-    for i in np.flatnonzero(a):
-        hd = np.inf
-        for j in np.flatnonzero(b):
-            d = surf_dist(i,j, one_ring_neighbour)    
-            if d<hd:
-                hd = copy.deepcopy(d)
-        if hd>h:
-            h = hd
-    return h
+    h = _mmd_ab(a, b, one_ring_neighbour)
+    return max(h, default = 0)
 
 def median_minimal_distance(imgdata1, imgdata2, label1, label2, one_ring_neighbour):
     """
@@ -339,8 +334,9 @@ def median_minimal_distance(imgdata1, imgdata2, label1, label2, one_ring_neighbo
     """
     imgdata1 = tools.get_specificroi(imgdata1, label1)
     imgdata2 = tools.get_specificroi(imgdata2, label2)
-    dist1 = _mmd_ab(imgdata1, imgdata2, one_ring_neighbour)
-    dist2 = _mmd_ab(imgdata2, imgdata1, one_ring_neighbour)
+    adjacency = _as_adjacency(one_ring_neighbour)
+    dist1 = _mmd_ab(imgdata1, imgdata2, adjacency)
+    dist2 = _mmd_ab(imgdata2, imgdata1, adjacency)
     return np.median(dist1 + dist2)
 
 def _mmd_ab(a, b, one_ring_neighbour):
@@ -348,6 +344,7 @@ def _mmd_ab(a, b, one_ring_neighbour):
     Compute median minimal distance between a,b
     
     part computational completion of median_minimal_distance
+    Minimal distances of all vertices in a are read from one distance field of b
 
     Parameters:
     -----------
@@ -360,15 +357,9 @@ def _mmd_ab(a, b, one_ring_neighbour):
     """
     a = np.array(a)
     b = np.array(b)
-    h = []
-    for i in np.flatnonzero(a):
-        hd = np.inf
-        for j in np.flatnonzero(b):
-            d = surf_dist(i, j, one_ring_neighbour)
-            if d<hd:
-                hd = d
-        h.append(hd)
-    return h
+    adjacency = _as_adjacency(one_ring_neighbour)
+    h = mesh_tools.minimal_distance(adjacency, np.flatnonzero(a), np.flatnonzero(b))
+    return h.tolist()
 
 def get_n_ring_neighbor(vertx, faces, n=1, ordinal=False):
     """
@@ -377,7 +368,7 @@ def get_n_ring_neighbor(vertx, faces, n=1, ordinal=False):
     Parameters:
     ---------
     vertex: vertex number
-    faces : the array of shape [n_triangles, 3]
+    faces : the array of shape [n_triangles, 3], surface.Mesh, or CSR adjacency matrix from mesh_tools.faces_to_adjacency
     n : integer
         specify which ring should be got
     ordinal : bool
@@ -389,35 +380,24 @@ def get_n_ring_neighbor(vertx, faces, n=1, ordinal=False):
     ringlist: array of ring nodes of each vertex
               The format of output will like below
               [{i1,j1,k1,...}, {i2,j2,k2,...}, ...]
-			  each index of the list represents a vertex number
+              each index of the list represents a vertex number
               each element is a set which includes neighbors of corresponding vertex
+              For neighbourhood of all vertices, mesh_tools.n_ring_neighbour gives a CSR matrix directly
 
     Example:
     ---------
     >>> ringlist = get_n_ring_neighbour(24, faces, n)
     """
-    if isinstance(vertx, int):
+    if isinstance(vertx, (int, np.integer)):
         vertx = [vertx]
-    nth_ring = [set([vx]) for vx in vertx]
-    nring = [set([vx]) for vx in vertx]
-
-    while n != 0:
-        n = n - 1
-        for idx, neighbor_set in enumerate(nth_ring):
-            neighbor_set_tmp = [_get_connvex_neigh(vx, faces) for vx in neighbor_set]
-            neighbor_set_tmp = set([item for sublist in neighbor_set_tmp for item in sublist])
-            neighbor_set_tmp.difference_update(nring[idx])
-            nth_ring[idx] = neighbor_set_tmp
-            nring[idx].update(nth_ring[idx])
-    if ordinal is True:
-        return nth_ring
-    else:
-        return nring
+    adjacency = _as_adjacency(faces)
+    ring = mesh_tools.n_ring_neighbour(adjacency, n, vertx, ordinal = ordinal)
+    return [set(nb.tolist()) for nb in np.split(ring.indices, ring.indptr[1:-1])]
 
 def get_connvex(seedvex, faces, mask, masklabel = 1):
     """
     Get connected vertices that contain in mask
-    We firstly need a start point to acquire connected vertices, then do region growing until all vertices in mask were included
+    We firstly need a start point to acquire connected vertices, then find the connected component of mask containing it
     That means, output should satisfied two condition:
     1 overlap with mask
     2 connected with each other
@@ -425,7 +405,7 @@ def get_connvex(seedvex, faces, mask, masklabel = 1):
     Parameters:
     -----------
     seedvex: seed point (start point)
-    faces: faces array, vertex relationship
+    faces: faces array, vertex relationship, surface.Mesh or CSR adjacency matrix is also supported
     mask: overlapping mask
     masklabel: specific mask label used as restriction
 
@@ -437,33 +417,9 @@ def get_connvex(seedvex, faces, mask, masklabel = 1):
     --------
     >>> connvex = get_connvex(24, faces, mask)
     """
-    connvex = set()
-    connvex.add(seedvex)
-    connvex_temp = _get_connvex_neigh(seedvex, faces, mask, masklabel)
-    while not connvex_temp.issubset(connvex):
-        connvex_dif = connvex_temp.difference(connvex)
-        connvex.update(connvex_dif)
-        connvex_temp = set()
-        for sx in connvex_dif: 
-            connvex_temp.update(_get_connvex_neigh(sx, faces, mask, masklabel))
-        print('Size of sulcus {0}'.format(len(connvex)))
-    return connvex  
-
-def _get_connvex_neigh(seedvex, faces, mask = None, masklabel = 1):
-    """
-    Function to get neighbouring vertices of a seed that satisfied overlap with mask
-    """
-    if mask is not None:
-        assert mask.shape[0] == np.max(faces) + 1 ,"mask need to have same vertex number with faces connection relationship"
     assert isinstance(seedvex, (int, np.integer)), "only allow input an integer as seedvex"
-
-    raw_faces, _ = np.where(faces == seedvex)
-    rawconnvex = np.unique(faces[raw_faces])
-    if mask is not None:
-        connvex = set()
-        [connvex.add(i) for i in rawconnvex if mask[i] == masklabel]
-    else:
-        connvex = set(rawconnvex)
-    connvex.discard(seedvex)
-    return connvex
-
+    mask = np.asarray(mask).ravel()
+    adjacency = _as_adjacency(faces)
+    assert mask.shape[0] == adjacency.shape[0] ,"mask need to have same vertex number with faces connection relationship"
+    component, _ = mesh_tools.seed_component(adjacency, seedvex, mask == masklabel)
+    return set(np.flatnonzero(component).tolist())
@@ -6,6 +6,8 @@ from scipy import stats
 from scipy.spatial import distance
 import copy
 import pandas as pd
+from . import numerics
+from . import label_tools
 
 
 def _overlap(c1, c2, index='dice'):
@@ -182,6 +184,7 @@ def convert_listvalue_to_ordinal(listdata):
 def regressoutvariable(rawdata, covariate):
     """
     Regress out covariate variables from raw data
+    To regress multiple covariates out of multiple features, use numerics.residualize
     -------------------------------------------------
     Parameters:
         rawdata: rawdata
@@ -232,12 +235,7 @@ def pearsonr(A, B):
     p4 = N*((A**2).sum(0)) - (sA**2)
     rcorr = ((p1-p2)/np.sqrt(p4*p3[:,None]))
 
-    df = A.T.shape[1] - 2
-    
-    r_forp = rcorr*1.0
-    r_forp[r_forp==1.0] = 0.0
-    t_squared = rcorr.T**2*(df/((1.0-rcorr.T)*(1.0+rcorr.T)))
-    pcorr = stats.betai(0.5*df, 0.5, df/(df+t_squared))
+    pcorr = numerics.r2p(rcorr.T, A.T.shape[1])
     return rcorr.T, pcorr
 
 def r2z(r):
@@ -246,6 +244,7 @@ def r2z(r):
     formula:
     z = (1/2)*(log(1+r) - log(1-r))
     se = 1/sqrt(n-3)
+    r is clipped into [-0.999, 0.999] to avoid infinite z values
     --------------------------------------
     Parameters:
         r: r matrix or array
@@ -254,15 +253,10 @@ def r2z(r):
     Example:
         >>> z = r2z(r)
     """
-    from math import log
-    func_rz = lambda r: 0.5*(log(1+r) - log(1-r))
-    if isinstance(r,float):
-        z = func_rz(r)
+    if isinstance(r, float):
+        z = float(numerics.fisher_r2z(r))
     else:
-        r_flat = r.flatten()
-        r_flat[r_flat>0.999] = 0.999
-        z_flat = np.array([func_rz(rvalue) for rvalue in r_flat])
-        z = z_flat.reshape(r.shape)
+        z = numerics.fisher_r2z(r)
     return z
 
 def z2r(z):
@@ -277,13 +271,10 @@ def z2r(z):
     Example:
         >>> r = z2r(z)
     """
-    from math import tanh
     if isinstance(z, float):
-        r = tanh(z)
+        r = float(numerics.fisher_z2r(z))
     else:
-        z_flat = z.flatten()
-        r_flat = np.array([tanh(zvalue) for zvalue in z_flat])
-        r = r_flat.reshape(z.shape)
+        r = numerics.fisher_z2r(np.asarray(z, dtype = float))
     return r
 
 def hemi_merge(left_region, right_region, meth = 'single', weight = None):
@@ -402,11 +393,7 @@ def get_specificroi(image, labellist):
     output:
         specific_data: data with extracted roi
     """
-    logic_array = np.full(image.shape, False, dtype = bool)
-    if isinstance(labellist, int):
-        labellist = [labellist]
-    for i,e in enumerate(labellist):
-        logic_array += (image == e)
+    logic_array = label_tools.label_mask(image, labellist)
     specific_data = image*logic_array
     return specific_data
 
@@ -616,6 +603,7 @@ class PCorrection(object):
 class NonUniformity(object):
     """
     Indices for non-uniformity
+    A 2D array is treated as multiple vectors, non-uniformity is computed for each row.
     -------------------------------
     Parameters:
         array: data arrays
@@ -624,8 +612,8 @@ class NonUniformity(object):
     """
     def __init__(self, array):
         # normalize array to make it comparable
-        self._array = array/sum(array)
-        self._len = len(array)
+        self._array = numerics.normalize_sum(array)
+        self._len = self._array.shape[-1]
     
     def entropy_meth(self):
         """
@@ -639,14 +627,7 @@ class NonUniformity(object):
         Example:
             >>> values = nu.entropy_meth()
         """
-        # create an array that have the highest entropy
-        from math import log
-        ref_array = np.array([1.0/self._len]*self._len)
-        entropy = lambda array: -1*sum(array.flatten()*np.array([log(i,2) for i in array.flatten()]))
-        ref_entropy = entropy(ref_array)
-        act_entropy = entropy(self._array)
-        nonuniformity = 1 - act_entropy/ref_entropy        
-        return nonuniformity
+        return numerics.entropy_nonuniformity(self._array)
 
     def l2norm(self):
         """
@@ -663,7 +644,7 @@ class NonUniformity(object):
         Example:
             >>> values = nu.l2norm()
         """
-        return (np.linalg.norm(self._array)*np.sqrt(self._len)-1)/(np.sqrt(self._len)-1)
+        return numerics.l2_nonuniformity(self._array)
 
 def threshold_by_number(imgdata, thr, threshold_type = 'number', option = 'descend'):
     """
@@ -2,50 +2,57 @@
 # vi: set ft=python sts=4 sw=4 et:
 
 import numpy as np
+from . import label_tools
+from . import pm_tools
 
 def make_pm(mask, meth = 'all'):
     """
     Make probabilistic map
     ------------------------------
     Parameters:
-        mask: mask
+        mask: mask, or its label_tools.LabelIndex/label_tools.LabelStack
         meth: 'all' or 'part'. 
               all, all subjects are taken into account
               part, part subjects are taken into account
     Return:
         pm = probabilistic map
     """
-    if mask.ndim != 4:
+    if isinstance(mask, label_tools.LabelStack):
+        if len(mask.spatial_shape) != 3:
+            raise Exception('Masks should be a 4D nifti file contains subjects')
+        pm = mask.pm(meth)
+        return pm.reshape(mask.spatial_shape+(mask.n_label,))
+    lblindex = label_tools.as_labelindex(mask)
+    if len(lblindex.shape) != 4:
         raise Exception('Masks should be a 4D nifti file contains subjects')
-    labels = np.unique(mask)[1:]
-    pm = np.empty((mask.shape[0], mask.shape[1], mask.shape[2], labels.shape[0]))
-    if meth == 'all':
-        for i in range(labels.shape[0]):
-            pm[..., i] = np.mean(mask == labels[i], axis = 3)
-    elif meth == 'part':
-        for i in range(labels.shape[0]):
-            mask_i = mask == labels[i]
-            subj = np.any(mask_i, axis = (0,1,2))
-            pm[..., i] = np.mean(mask_i[..., subj], axis = 3)
-    else:
+    if meth not in ('all', 'part'):
         raise Exception('method not supported')
-    return pm
+    labels = lblindex.labels
+    nvox = int(np.prod(lblindex.shape[:3]))
+    nsubj = lblindex.shape[3]
+    pm = np.empty((nvox, labels.shape[0]))
+    # flat index of a 4D mask is voxel*nsubj+subject
+    for i in range(labels.shape[0]):
+        roiloc = lblindex.roi(labels[i])
+        if meth == 'all':
+            pm[..., i] = np.bincount(roiloc//nsubj, minlength = nvox)/float(nsubj)
+        else:
+            subj = np.unique(roiloc%nsubj)
+            pm[..., i] = np.bincount(roiloc//nsubj, minlength = nvox)/float(subj.size)
+    return pm.reshape(lblindex.shape[:3]+(labels.shape[0],))
         
-def make_mpm(pm, threshold):
+def make_mpm(pm, threshold, consider_baseline = False):
     """
     Make maximum probabilistic map (mpm)
     ---------------------------------------
     Parameters:
         pm: probabilistic map
-        threshold: threholds to mask probabilistic maps
+        threshold: threholds to mask probabilistic maps, could be a list of thresholds
+        consider_baseline: whether discard voxels that contain several probabilities with sum lower than 0.5, see pm_tools.make_mpm
     Return:
-        mpm: maximum probabilisic map
+        mpm: maximum probabilisic map, uint16 array
     """
-    pm_temp = np.empty((pm.shape[0], pm.shape[1], pm.shape[2], pm.shape[3]+1))
-    pm_temp[..., range(1, pm.shape[3]+1)] = pm 
-    pm_temp[pm_temp < threshold] = 0
-    mpm = np.argmax(pm_temp, axis=3)
-    return mpm    
+    return pm_tools.make_mpm(pm, threshold, consider_baseline)
 
 def sphere_roi(voxloc, radius, value, datashape = (91,109,91), data = None):
     """
@@ -2,6 +2,7 @@
 # vi: set ft=python sts=4 sw=4 et:
 
 import numpy as np
+from . import label_tools
 
 def vox2MNI(vox, affine):
     """
@@ -37,20 +38,28 @@ def get_masksize(mask):
     Compute mask size
     -------------------------------------
     Parameters:
-        mask: mask.
+        mask: mask, or its label_tools.LabelIndex/label_tools.LabelStack
     Return:
         masksize: mask size of each roi
     """
-    labels = np.unique(mask)[1:]
-    if mask.ndim == 3:
-        mask = np.expand_dims(mask, axis = 3)
-    masksize = np.empty((mask.shape[3], int(np.max(labels))))
-    for i in range(mask.shape[3]):
-        for j in range(int(np.max(labels))):
-            if np.any(mask[...,i] == j+1):
-                masksize[i, j] = np.sum(mask[...,i] == j+1)
-            else:
-                masksize[i, j] = np.nan
+    if isinstance(mask, label_tools.LabelStack):
+        labelnum = int(np.max(mask.labels)) if mask.n_label else 0
+        masksize = np.full((mask.n_subj, labelnum), np.nan)
+        sizes = mask.sizes()
+        for j,e in enumerate(mask.labels):
+            if e >= 1:
+                masksize[sizes[:,j] != 0, int(e)-1] = sizes[sizes[:,j] != 0, j]
+        return masksize
+    lblindex = label_tools.as_labelindex(mask)
+    if len(lblindex.shape) == 4:
+        nsubj = lblindex.shape[3]
+    else:
+        nsubj = 1
+    masksize = np.full((nsubj, lblindex.labelnum), np.nan)
+    for j in range(lblindex.labelnum):
+        # the last axis varies fastest in flat indices
+        subjsize = np.bincount(lblindex.roi(j+1) % nsubj, minlength = nsubj)
+        masksize[subjsize != 0, j] = subjsize[subjsize != 0]
     return masksize
 
 def get_signals(atlas, mask, method = 'mean', labelnum = None):
@@ -59,16 +68,16 @@ def get_signals(atlas, mask, method = 'mean', labelnum = None):
     --------------------------------------
     Parameters:
         atlas: atlas
-        mask: masks. Different roi labelled differently
+        mask: masks. Different roi labelled differently. Could also be its label_tools.LabelIndex
         method: 'mean', 'std', 'ste'(standard error), 'max', 'voxel', etc.
         labelnum: Mask's label numbers, by default is None. Add this parameters for group analysis
     Return:
         signals: nroi for activation data
                  resting signal x roi for resting data
     """
-    labels = np.unique(mask)[1:]
+    lblindex = label_tools.as_labelindex(mask)
     if labelnum is None:
-        labelnum = int(np.max(labels))
+        labelnum = lblindex.labelnum
     signals = []
     if method == 'mean':
         calfunc = np.nanmean
@@ -83,9 +92,7 @@ def get_signals(atlas, mask, method = 'mean', labelnum = None):
     else:
         raise Exception('Method contains mean or std or peak')
     for i in range(labelnum):
-        loc_raw = np.where(mask == (i+1))
-        roiloc = zip(loc_raw[0], loc_raw[1], loc_raw[2])
-        roisignal = [atlas[roiloc[i]] for i in range(len(roiloc))]
+        roisignal = atlas[lblindex.coords(i+1)]
         if np.any(roisignal):
             signals.append(roisignal)
         else:
@@ -99,7 +106,7 @@ def get_coordinate(atlas, mask, size = [2,2,2], method = 'peak', labelnum = None
     --------------------------------------------
     Parameters:
         atlas: atlas
-        mask: roi mask.
+        mask: roi mask, or its label_tools.LabelIndex
         size: voxel size
         method: 'peak' or 'center'
         labelnum: mask label numbers in total, by default is None, set parameters if you want to do group analysis
@@ -107,13 +114,14 @@ def get_coordinate(atlas, mask, size = [2,2,2], method = 'peak', labelnum = None
         coordinates: nroi x 3 for activation data
                      Note that do not extract coordinate of resting data
     """
-    labels = np.unique(mask)[1:]
+    lblindex = label_tools.as_labelindex(mask)
     if labelnum is None:
-        labelnum = np.max(labels)
+        labelnum = lblindex.labelnum
     coordinate = np.empty((labelnum, 3))
 
-    extractpeak = lambda x: np.unravel_index(x.argmax(), x.shape)
-    extractcenter = lambda x: np.mean(np.transpose(np.nonzero(x)))
+    # roi signals and their coordinates (nvox x 3) as input
+    extractpeak = lambda x, loc: loc[x.argmax()]
+    extractcenter = lambda x, loc: np.mean(loc[x!=0])
 
     if method == 'peak':
         calfunc = extractpeak
@@ -122,15 +130,11 @@ def get_coordinate(atlas, mask, size = [2,2,2], method = 'peak', labelnum = None
     else:
         raise Exception('Method contains peak or center')
     for i in range(labelnum):
-        roisignal = atlas*(mask == (i+1))
+        roiloc = lblindex.coords(i+1)
+        roisignal = atlas[roiloc]
         if np.any(roisignal):
-            coordinate[i,:] = calfunc(roisignal)
+            coordinate[i,:] = calfunc(roisignal, np.transpose(roiloc))
             coordinate[i,:] = vox2MNI(coordinate[i,:], size)
         else:
             coordinate[i,:] = np.array([np.nan, np.nan, np.nan])
     return coordinate
-
-
-
-
-
@@ -0,0 +1,84 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode:nil -*-
+# vi: set ft=python sts=4 sw=4 et:
+
+"""
+Microbenchmarks of ATT.algorithm.numerics kernels against the per-element
+implementations they replaced in ATT.algorithm.tools.
+
+Usage:
+    python benchmarks/numerics_benchmark.py
+"""
+
+import timeit
+from math import log, tanh
+import numpy as np
+from ATT.algorithm import numerics
+
+def loop_r2z(r):
+    """
+    Per-element Fisher r-to-z, as tools.r2z used to do
+    """
+    return np.array([0.5*(log(1+e) - log(1-e)) for e in r])
+
+def loop_z2r(z):
+    """
+    Per-element Fisher z-to-r, as tools.z2r used to do
+    """
+    return np.array([tanh(e) for e in z])
+
+def loop_entropy(rows):
+    """
+    Per-row entropy, as tools.NonUniformity used to do
+    """
+    rows = rows/rows.sum(axis = 1, keepdims = True)
+    return [-1*sum(e*np.array([log(i, 2) for i in e])) for e in rows]
+
+def loop_residualize(features, confounds):
+    """
+    Per-column least square regression of confounds
+    """
+    X = np.column_stack((np.ones(confounds.shape[0]), confounds))
+    residuals = np.empty(features.shape)
+    for i in range(features.shape[1]):
+        samp = ~np.isnan(features[:, i])
+        beta = np.linalg.lstsq(X[samp], features[samp, i], rcond = None)[0]
+        residuals[:, i] = np.nan
+        residuals[samp, i] = features[samp, i] - np.dot(X[samp], beta)
+    return residuals
+
+def benchmark(n = 900000, repeat = 3):
+    """
+    Print time of each kernel against its per-element implementation
+
+    Parameters:
+    -----------
+    n: number of correlation values
+    repeat: repeat times of array kernels, the minimum time is reported
+    """
+    rng = np.random.RandomState(0)
+    r = rng.uniform(-0.99, 0.99, n)
+    z = numerics.fisher_r2z(r)
+    rbuf = r.copy()
+    rows = rng.uniform(0.01, 1, (n//100, 100))
+    confounds = rng.randn(1000, 4)
+    features = rng.randn(1000, 2000)
+    features[:, :100][rng.rand(1000, 100) < 0.01] = np.nan
+
+    cases = [('r2z', lambda: loop_r2z(r), lambda: numerics.fisher_r2z(r)),
+             ('r2z(in place)', lambda: loop_r2z(r), lambda: numerics.fisher_r2z(rbuf, out = rbuf)),
+             ('z2r', lambda: loop_z2r(z), lambda: numerics.fisher_z2r(z)),
+             ('r2p', None, lambda: numerics.r2p(r, 100)),
+             ('entropy rows', lambda: loop_entropy(rows), lambda: numerics.entropy_nonuniformity(rows)),
+             ('l2norm rows', None, lambda: numerics.l2_nonuniformity(rows)),
+             ('residualize', lambda: loop_residualize(features, confounds), lambda: numerics.residualize(features, confounds))]
+    print('{0:<16}{1:>14}{2:>14}'.format('kernel', 'loop (s)', 'array (s)'))
+    for name, loopfunc, arrfunc in cases:
+        t_arr = min(timeit.repeat(arrfunc, number = 1, repeat = repeat))
+        if loopfunc is None:
+            t_loop = np.nan
+        else:
+            t_loop = min(timeit.repeat(loopfunc, number = 1, repeat = 1))
+        print('{0:<16}{1:>14.4f}{2:>14.4f}'.format(name, t_loop, t_arr))
+
+if __name__ == '__main__':
+    benchmark()
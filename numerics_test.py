@@ -0,0 +1,38 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 et:
+
+import numpy as np
+from ATT.algorithm import numerics
+
+def _loop_residualize(targets, confounds):
+    """
+    Per-column least square regression as reference
+    """
+    X = np.column_stack((np.ones(confounds.shape[0]), confounds))
+    residue = np.full(targets.shape, np.nan)
+    for i in range(targets.shape[1]):
+        samp = ~np.isnan(targets[:, i])
+        beta = np.linalg.lstsq(X[samp], targets[samp, i], rcond = None)[0]
+        residue[samp, i] = targets[samp, i] - np.dot(X[samp], beta)
+    return residue
+
+def test_residualize():
+    rng = np.random.RandomState(0)
+    targets = rng.randn(50, 20)
+    targets[rng.rand(50, 20) < 0.05] = np.nan
+    confounds = rng.randn(50, 3)
+    expected = _loop_residualize(targets, confounds)
+    assert np.allclose(numerics.residualize(targets, confounds), expected, equal_nan = True)
+    inplace = targets.copy()
+    numerics.residualize(inplace, confounds, inplace = True)
+    assert np.allclose(inplace, expected, equal_nan = True)
+
+def test_residualize_no_feature():
+    confounds = np.random.RandomState(0).randn(5, 2)
+    assert numerics.residualize(np.zeros((5, 0)), confounds).shape == (5, 0)
+    targets = np.zeros((5, 0))
+    assert numerics.residualize(targets, confounds, inplace = True) is targets
+
+if __name__ == '__main__':
+    test_residualize()
+    test_residualize_no_feature()
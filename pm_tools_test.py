@@ -0,0 +1,52 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 et:
+
+import numpy as np
+from ATT.algorithm import pm_tools
+
+def _loop_mpm(pm, threshold):
+    """
+    Per-voxel maximum probabilistic map as reference
+    """
+    rows = pm.reshape(-1, pm.shape[-1])
+    mpm = np.zeros(rows.shape[0], dtype = int)
+    for i, row in enumerate(rows):
+        row = np.where(row >= threshold, row, 0)
+        if row.max() > 0:
+            mpm[i] = np.argmax(row) + 1
+    return mpm.reshape(pm.shape[:-1])
+
+def test_as_rows_fortran_view():
+    pm = np.asfortranarray(np.random.RandomState(0).rand(4, 5, 6, 3))
+    rows, order = pm_tools._as_rows(pm)
+    assert order == 'F'
+    assert rows.shape == (120, 3)
+    assert np.shares_memory(rows, pm)
+
+def test_as_rows_c_view():
+    pm = np.random.RandomState(0).rand(4, 5, 6, 3)
+    rows, order = pm_tools._as_rows(pm)
+    assert order == 'C'
+    assert np.shares_memory(rows, pm)
+    assert not np.shares_memory(pm_tools._as_rows(pm[::2])[0], pm)
+
+def test_make_mpm_fortran():
+    pm = np.random.RandomState(0).rand(4, 5, 6, 3)
+    expected = _loop_mpm(pm, 0.3)
+    assert np.array_equal(pm_tools.make_mpm(np.asfortranarray(pm), 0.3), expected)
+    mpms = pm_tools.make_mpm(np.asfortranarray(pm), [0.3, 0.6])
+    assert np.array_equal(mpms[..., 0], expected)
+    assert np.array_equal(mpms[..., 1], _loop_mpm(pm, 0.6))
+
+def test_make_apm_fortran():
+    act = np.random.RandomState(0).randn(4, 5, 6, 10)
+    expected = np.mean(act >= 0.5, axis = -1)
+    assert np.allclose(pm_tools.make_apm(np.asfortranarray(act), 0.5), expected)
+    apms = pm_tools.make_apm(iter([np.asfortranarray(act[..., i]) for i in range(10)]), [1.0, 0.5])
+    assert np.allclose(apms[..., 1], expected)
+
+if __name__ == '__main__':
+    test_as_rows_fortran_view()
+    test_as_rows_c_view()
+    test_make_mpm_fortran()
+    test_make_apm_fortran()
@@ -1,6 +1,10 @@
 # emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
 # vi: set ft=python sts=4 ts=4 et:
 
-__all__ = []
+from .meshbase import Mesh
+from .atlasbase import SurfaceAtlas
+from .analysebase import SurfaceSearchlight
+
+__all__ = ['Mesh', 'SurfaceAtlas', 'SurfaceSearchlight']
 # from . import atlasbase
 # from . import analysebase
@@ -1,4 +1,172 @@
 # emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
 # vi: set ft=python sts=4 ts=4 et:
 
+import multiprocessing
+import numpy as np
+from ATT.algorithm import mesh_tools
 
+def patch_index(neighbour):
+    """
+    Convert neighbourhoods in CSR form into padded index array
+
+    Parameters:
+    -----------
+    neighbour: n_vertex x n_vertex CSR matrix, e.g. from mesh_tools.n_ring_neighbour or mesh_tools.radius_neighbour
+
+    Return:
+    -------
+    index: n_vertex x max_patch_size vertex index array, padded with 0
+    valid: n_vertex x max_patch_size boolean array, False for padding
+    """
+    size = np.diff(neighbour.indptr)
+    maxsize = int(size.max()) if size.size else 0
+    valid = np.arange(maxsize) < size[:, np.newaxis]
+    index = np.zeros(valid.shape, dtype = np.min_scalar_type(max(neighbour.shape[1]-1, 0)))
+    # row major order of valid positions is the CSR order of neighbours
+    index[valid] = neighbour.indices
+    return index, valid
+
+def _masked_moments(patches, valid):
+    """
+    Masked patch values (padding as 0), their weights, vertex numbers and means of patches
+    """
+    if patches.ndim > valid.ndim:
+        valid = valid.reshape(valid.shape + (1,)*(patches.ndim-valid.ndim))
+    weight = valid.astype(np.float64)
+    patches = np.where(valid, patches, 0.0)
+    n = weight.sum(axis = 1)
+    mean = patches.sum(axis = 1)/n
+    return patches, weight, n, mean
+
+def patch_variance(patches, valid):
+    """
+    Variance of values in each patch
+    """
+    patches, weight, n, mean = _masked_moments(patches, valid)
+    return np.sum(weight*(patches-mean[:, np.newaxis])**2, axis = 1)/n
+
+def patch_correlation(patches1, patches2, valid):
+    """
+    Pattern correlation between two maps in each patch
+    """
+    patches1, weight, n, mean1 = _masked_moments(patches1, valid)
+    patches2, _, _, mean2 = _masked_moments(patches2, valid)
+    diff1 = weight*(patches1-mean1[:, np.newaxis])
+    diff2 = weight*(patches2-mean2[:, np.newaxis])
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return np.sum(diff1*diff2, axis = 1)/np.sqrt(np.sum(diff1**2, axis = 1)*np.sum(diff2**2, axis = 1))
+
+def patch_dice(patches1, patches2, valid):
+    """
+    Dice coefficient between two binary maps in each patch, nan if both maps are empty in patch
+    """
+    patches1, _, _, _ = _masked_moments(patches1 != 0, valid)
+    patches2, _, _, _ = _masked_moments(patches2 != 0, valid)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return 2.0*np.sum(patches1*patches2, axis = 1)/(np.sum(patches1, axis = 1)+np.sum(patches2, axis = 1))
+
+_PATCH_STATS = {'variance': patch_variance, 'correlation': patch_correlation, 'dice': patch_dice}
+
+# data shared by worker processes of searchlight, set once by the pool initializer
+_searchlight_state = {}
+
+def _init_searchlight(statfunc, data, index, valid):
+    _searchlight_state['statfunc'] = statfunc
+    _searchlight_state['data'] = data
+    _searchlight_state['index'] = index
+    _searchlight_state['valid'] = valid
+
+def _searchlight_chunk(bound):
+    """
+    Evaluate statistic of patches of vertices in [start, stop)
+    """
+    start, stop = bound
+    index = _searchlight_state['index'][start:stop]
+    valid = _searchlight_state['valid'][start:stop]
+    patches = [d[index] for d in _searchlight_state['data']]
+    return _searchlight_state['statfunc'](*(patches + [valid]))
+
+class SurfaceSearchlight(object):
+    """
+    Searchlight on surface
+    Patches of all vertices (n ring or geodesic radius) are precomputed once as padded index arrays,
+    statistic is evaluated on gathered patches of a chunk of vertices at once, chunks could be distributed to processes.
+
+    Parameters:
+    -----------
+    mesh: surface.Mesh, or CSR adjacency matrix (binary for n_ring, weighted by edge length for radius)
+    n_ring: ring number of patches, by default is 1
+    radius: geodesic radius of patches, by default is None, n_ring is used if radius is None
+
+    Example:
+    --------
+    >>> slcls = SurfaceSearchlight(mesh, n_ring = 3)
+    >>> rmap = slcls.run('correlation', zstat1, zstat2, n_jobs = 8)
+    """
+    def __init__(self, mesh, n_ring = 1, radius = None):
+        if radius is not None:
+            adjacency = mesh.geodesic_adjacency if hasattr(mesh, 'geodesic_adjacency') else mesh
+            neighbour = mesh_tools.radius_neighbour(adjacency, radius)
+        elif hasattr(mesh, 'n_ring'):
+            neighbour = mesh.n_ring(n_ring)
+        else:
+            neighbour = mesh_tools.n_ring_neighbour(mesh, n_ring)
+        self.index, self.valid = patch_index(neighbour)
+
+    @property
+    def n_vertex(self):
+        return self.index.shape[0]
+
+    @property
+    def patch_size(self):
+        return self.valid.sum(axis = 1)
+
+    def run(self, statfunc, *data, **kwargs):
+        """
+        Evaluate statistic on patches of all vertices
+
+        Parameters:
+        -----------
+        statfunc: 'variance', 'correlation', 'dice', or a function as statfunc(patches1, ..., valid)
+                  patches are n_chunk x max_patch_size (x n_feature) arrays gathered from data, valid marks non-padding positions
+                  the function should be defined at module level when n_jobs > 1
+        data: surface data, n_vertex or n_vertex x n_feature arrays
+        n_jobs: process number, by default is 1
+        chunksize: vertex number of each chunk, by default is 2048
+
+        Return:
+        -------
+        statmap: statistic of each vertex
+
+        Example:
+        --------
+        >>> varmap = slcls.run('variance', zstat)
+        """
+        n_jobs = kwargs.pop('n_jobs', 1)
+        chunksize = kwargs.pop('chunksize', 2048)
+        if kwargs:
+            raise Exception('Unexpected parameters {0}'.format(list(kwargs.keys())))
+        if isinstance(statfunc, str):
+            if statfunc not in _PATCH_STATS:
+                raise Exception('statfunc should be one of {0} or a function'.format(sorted(_PATCH_STATS.keys())))
+            statfunc = _PATCH_STATS[statfunc]
+        surfdata = []
+        for d in data:
+            d = np.asarray(d)
+            if d.shape[0] != self.n_vertex:
+                raise Exception('data and mesh have different vertex number')
+            d = d.reshape(d.shape[0], -1)
+            surfdata.append(d[:, 0] if d.shape[1] == 1 else d)
+        bounds = [(start, min(start+chunksize, self.n_vertex)) for start in range(0, self.n_vertex, chunksize)]
+        if n_jobs == 1:
+            _init_searchlight(statfunc, surfdata, self.index, self.valid)
+            results = [_searchlight_chunk(b) for b in bounds]
+        else:
+            pool = multiprocessing.Pool(n_jobs, initializer = _init_searchlight, initargs = (statfunc, surfdata, self.index, self.valid))
+            try:
+                results = pool.map(_searchlight_chunk, bounds)
+            finally:
+                pool.close()
+                pool.join()
+        _searchlight_state.clear()
+        return np.concatenate(results)
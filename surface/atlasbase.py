@@ -1,4 +1,171 @@
 # emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
 # vi: set ft=python sts=4 ts=4 et:
 
+import numpy as np
+from ATT.algorithm import label_tools, pm_tools
+from ATT.iofunc import iofiles
 
+def load_surfdata(surfdata):
+    """
+    Load surface data as n_vertex x n_subj array
+
+    Parameters:
+    -----------
+    surfdata: surface data array (n_vertex, n_vertex x n_subj or n_vertex x 1 x 1 x n_subj), or a GIFTI file path
+              each data array of GIFTI file is taken as a subject
+
+    Return:
+    -------
+    data: n_vertex x n_subj array
+    """
+    if isinstance(surfdata, str):
+        surfdata = iofiles.make_ioinstance(surfdata).load()
+        if isinstance(surfdata, list):
+            surfdata = np.column_stack(surfdata)
+    surfdata = np.asarray(surfdata)
+    if surfdata.ndim not in (1, 2, 4):
+        raise Exception('surface data should be 1/2/4 dimension')
+    return surfdata.reshape(surfdata.shape[0], -1)
+
+class SurfaceAtlas(object):
+    """
+    Atlas of surface label stack, mirror of atlas.Atlas for surface data
+    Reductions over ROIs are done by sparse label matrices for all subjects at once
+
+    Parameters:
+    -----------
+    atlas_data: label stack, n_vertex x n_subj (or n_vertex x 1 x 1 x n_subj) array, or a GIFTI file path
+    roi_id: labels of ROIs
+    roi_name: names of ROIs
+    mesh: surface.Mesh, used to compute surface area, by default is None, which takes each vertex as unit area
+    task, contrast, threshold, subj_id, subj_gender: information of atlas, same as atlas.Atlas
+
+    Example:
+    --------
+    >>> satlas = SurfaceAtlas(label_stack, [1, 2], ['ffa', 'ofa'], mesh)
+    >>> meas = satlas.collect_scalar_meas(zstat_stack, 'mean')
+    >>> area = satlas.volume()
+    >>> pm = satlas.make_pm('all')
+    >>> mpm = satlas.make_mpm(0.2)
+    """
+    def __init__(self, atlas_data, roi_id, roi_name = None, mesh = None, task = None, contrast = None, threshold = None, subj_id = None, subj_gender = None):
+        self.atlas_data = load_surfdata(atlas_data)
+        self.roi_id = np.asarray(roi_id).ravel()
+        self.roi_name = roi_name
+        self.mesh = mesh
+        if (mesh is not None) and (mesh.n_vertex != self.atlas_data.shape[0]):
+            raise Exception('mesh and atlas data have different vertex number')
+        self.task = task
+        self.contrast = contrast
+        self.threshold = threshold
+        self.subj_id = subj_id
+        self.subj_gender = subj_gender
+        self.vol = None
+        self.pm = None
+        self.mpm = None
+        self._lblmatrix = {}
+
+    @property
+    def n_vertex(self):
+        return self.atlas_data.shape[0]
+
+    @property
+    def n_subj(self):
+        return self.atlas_data.shape[1]
+
+    @property
+    def n_roi(self):
+        return self.roi_id.size
+
+    def _label_matrix(self, n_subj):
+        """
+        Sparse label indicator matrix of atlas for n_subj subjects, single subject atlas is shared by all subjects
+        """
+        if n_subj not in self._lblmatrix:
+            stack = self.atlas_data
+            if stack.shape[1] != n_subj:
+                if stack.shape[1] != 1:
+                    raise Exception('Atlas data and target data are not match!')
+                stack = np.broadcast_to(stack, (self.n_vertex, n_subj))
+            self._lblmatrix[n_subj] = label_tools.label_matrix(stack, self.roi_id)
+        return self._lblmatrix[n_subj]
+
+    def collect_scalar_meas(self, meas_data, metric = 'mean'):
+        """
+        Collect scalar measures for atlas
+
+        Parameters:
+        -----------
+        meas_data: measures data, n_vertex or n_vertex x n_subj array (4D data is also supported), or a GIFTI file path
+        metric: metric to summarize ROI info, 'sum', 'mean', 'max', 'min', 'std', 'median', 'skewness' or 'kurtosis'
+                nan values are ignored
+
+        Return:
+        -------
+        meas: collected scalar measures, n_subj x n_roi array, nan for ROIs absent in subject
+        """
+        scalar_metric = ['sum', 'mean', 'max', 'min', 'std', 'median', 'skewness', 'kurtosis']
+        if metric not in scalar_metric:
+            raise Exception('Metric is not supported!')
+        targ = load_surfdata(meas_data)
+        if targ.shape[0] != self.n_vertex:
+            raise Exception('Atlas data and target data are not match!')
+        return label_tools.label_reduce(targ, self.atlas_data, self.roi_id, metric)
+
+    def volume(self):
+        """
+        Surface area of the rois
+        Area of each vertex is got from mesh, if mesh is None, vertex number is returned
+
+        Return:
+        -------
+        vol: area of the rois, n_subj x n_roi array
+        """
+        lblmatrix = self._label_matrix(self.n_subj)
+        if self.mesh is None:
+            area = np.ones(self.n_vertex*self.n_subj)
+        else:
+            area = np.repeat(self.mesh.vertex_areas, self.n_subj)
+        vol = (lblmatrix*area).reshape(self.n_subj, self.n_roi)
+        self.vol = vol
+        return vol
+
+    def make_pm(self, meth = 'all'):
+        """
+        Make probabilistic map (pm) from surface label stack
+
+        Parameters:
+        -----------
+        meth: 'all' or 'part'. all, all subjects are taken into account; part, only
+              part of subjects who have roi are taken into account.
+
+        Return:
+        -------
+        pm: n_vertex x n_roi array, nan for rois absent in all subjects when meth is 'part'
+        """
+        if meth not in ('all', 'part'):
+            raise Exception('meth is not supported!')
+        lblstack = label_tools.LabelStack(self.atlas_data, self.roi_id)
+        # stored labels are sorted, keep columns in order of roi_id
+        pm = lblstack.pm(meth)[:, np.searchsorted(lblstack.labels, self.roi_id)]
+        self.pm = pm
+        return self.pm
+
+    def make_mpm(self, threshold, consider_baseline = False):
+        """
+        Make maximum probabilistic map (mpm) from probabilistic maps
+
+        Parameters:
+        -----------
+        threshold: threshold to mask probabilistic maps, or a list of thresholds
+        consider_baseline: whether discard vertices that contain several probabilities with sum lower than 0.5, by default is False
+
+        Return:
+        -------
+        mpm: n_vertex (x n_threshold) uint16 array, value i means the i-th roi (from 1), 0 for background
+        """
+        if self.pm is None:
+            raise Exception('pm is empty! You should make pm first')
+        mpm = pm_tools.make_mpm(self.pm, threshold, consider_baseline)
+        self.mpm = mpm
+        return mpm
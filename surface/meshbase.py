@@ -0,0 +1,239 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 et:
+
+import numpy as np
+from scipy import sparse
+from ATT.algorithm import mesh_tools
+from ATT.iofunc import iofiles
+
+class Mesh(object):
+    """
+    Surface mesh with lazily computed and cached topology
+    Topology (edges, adjacency, n ring neighbourhoods, vertex areas, normals, laplacian, smoothing operators) is computed at the first request and kept
+
+    Parameters:
+    -----------
+    coords: vertex coordinates, n_vertex x 3
+    faces: faces array, n_faces x 3
+
+    Example:
+    --------
+    >>> mesh = Mesh.from_gifti('lh.midthickness.surf.gii')
+    >>> adjacency = mesh.adjacency
+    >>> mesh.save('lh.midthickness.npz')
+    >>> mesh = Mesh.load('lh.midthickness.npz')
+    """
+    def __init__(self, coords, faces):
+        self.coords = np.asarray(coords, dtype = np.float64)
+        self.faces = np.asarray(faces, dtype = np.int64)
+        if self.faces.ndim != 2 or self.faces.shape[1] != 3:
+            raise Exception('faces should be a n_faces x 3 array')
+        if self.faces.size and self.faces.max() >= self.coords.shape[0]:
+            raise Exception('faces refer to vertices out of coords')
+        self._cache = {}
+
+    @classmethod
+    def from_gifti(cls, surfpath):
+        """
+        Load mesh from GIFTI surface file, which contains coordinates and faces
+
+        Parameters:
+        -----------
+        surfpath: path of surface file, e.g. lh.midthickness.surf.gii
+
+        Return:
+        -------
+        mesh: Mesh instance
+        """
+        data = iofiles.make_ioinstance(surfpath).load()
+        if not isinstance(data, list) or len(data) < 2:
+            raise Exception('{0} does not contain both coordinates and faces'.format(surfpath))
+        # coordinates are float pointset, faces are integer triangles
+        coords = [d for d in data if np.issubdtype(np.asarray(d).dtype, np.floating)]
+        faces = [d for d in data if np.issubdtype(np.asarray(d).dtype, np.integer)]
+        if len(coords) == 0 or len(faces) == 0:
+            raise Exception('{0} does not contain both coordinates and faces'.format(surfpath))
+        return cls(coords[0], faces[0])
+
+    @classmethod
+    def load(cls, npzpath):
+        """
+        Load mesh and its cached topology from .npz file saved by Mesh.save
+        """
+        npzdata = np.load(npzpath)
+        mesh = cls(npzdata['coords'], npzdata['faces'])
+        if 'edges' in npzdata:
+            mesh._cache['edges'] = npzdata['edges']
+        if 'adj_indptr' in npzdata:
+            mesh._cache['adjacency'] = sparse.csr_matrix((np.ones(npzdata['adj_indices'].size, dtype = np.int8), npzdata['adj_indices'], npzdata['adj_indptr']), shape = (mesh.n_vertex, mesh.n_vertex))
+        if 'vertex_areas' in npzdata:
+            mesh._cache['vertex_areas'] = npzdata['vertex_areas']
+        return mesh
+
+    def save(self, npzpath):
+        """
+        Save mesh into compact .npz file, cached edges, adjacency and vertex areas are saved together
+        """
+        outdata = {'coords': self.coords, 'faces': self.faces.astype(np.int32)}
+        if 'edges' in self._cache:
+            outdata['edges'] = self._cache['edges'].astype(np.int32)
+        if 'adjacency' in self._cache:
+            outdata['adj_indptr'] = self._cache['adjacency'].indptr
+            outdata['adj_indices'] = self._cache['adjacency'].indices
+        if 'vertex_areas' in self._cache:
+            outdata['vertex_areas'] = self._cache['vertex_areas']
+        np.savez_compressed(npzpath, **outdata)
+
+    @property
+    def n_vertex(self):
+        return self.coords.shape[0]
+
+    @property
+    def n_face(self):
+        return self.faces.shape[0]
+
+    @property
+    def hash(self):
+        """
+        Hash of mesh, used to key cached results on disk
+        """
+        if 'hash' not in self._cache:
+            self._cache['hash'] = mesh_tools.mesh_hash(self.coords, self.faces)
+        return self._cache['hash']
+
+    @property
+    def edges(self):
+        """
+        Unique edges, n_edges x 2 array
+        """
+        if 'edges' not in self._cache:
+            self._cache['edges'] = mesh_tools.faces_to_edges(self.faces)
+        return self._cache['edges']
+
+    @property
+    def adjacency(self):
+        """
+        Binary CSR adjacency matrix
+        """
+        if 'adjacency' not in self._cache:
+            self._cache['adjacency'] = mesh_tools.edges_to_adjacency(self.edges, self.n_vertex)
+        return self._cache['adjacency']
+
+    @property
+    def geodesic_adjacency(self):
+        """
+        CSR adjacency matrix weighted by edge length
+        """
+        if 'geodesic_adjacency' not in self._cache:
+            self._cache['geodesic_adjacency'] = mesh_tools.edges_to_adjacency(self.edges, self.n_vertex, mesh_tools.edge_length(self.coords, self.edges))
+        return self._cache['geodesic_adjacency']
+
+    def n_ring(self, n = 1, ordinal = False):
+        """
+        n ring neighbourhoods of all vertices as CSR boolean matrix, see mesh_tools.n_ring_neighbour
+        """
+        key = ('n_ring', n, ordinal)
+        if key not in self._cache:
+            self._cache[key] = mesh_tools.n_ring_neighbour(self.adjacency, n, ordinal = ordinal)
+        return self._cache[key]
+
+    @property
+    def face_areas(self):
+        """
+        Area of each face
+        """
+        if 'face_areas' not in self._cache:
+            self._cache['face_areas'] = 0.5*np.linalg.norm(self._face_cross(), axis = 1)
+        return self._cache['face_areas']
+
+    @property
+    def vertex_areas(self):
+        """
+        Area of each vertex, one third of the area of its faces
+        """
+        if 'vertex_areas' not in self._cache:
+            self._cache['vertex_areas'] = np.bincount(self.faces.ravel(), np.repeat(self.face_areas/3.0, 3), minlength = self.n_vertex)
+        return self._cache['vertex_areas']
+
+    @property
+    def face_normals(self):
+        """
+        Unit normal of each face
+        """
+        if 'face_normals' not in self._cache:
+            cross = self._face_cross()
+            self._cache['face_normals'] = cross/_safe_norm(cross)
+        return self._cache['face_normals']
+
+    @property
+    def vertex_normals(self):
+        """
+        Unit normal of each vertex, averaged from normals of its faces weighted by face area
+        """
+        if 'vertex_normals' not in self._cache:
+            cross = self._face_cross()
+            normals = np.zeros((self.n_vertex, 3))
+            for i in range(3):
+                np.add.at(normals, self.faces[:, i], cross)
+            self._cache['vertex_normals'] = normals/_safe_norm(normals)
+        return self._cache['vertex_normals']
+
+    @property
+    def laplacian(self):
+        """
+        Graph laplacian of mesh, L = D - A, as CSR matrix
+        """
+        if 'laplacian' not in self._cache:
+            self._cache['laplacian'] = mesh_tools.laplacian(self.adjacency)
+        return self._cache['laplacian']
+
+    def smoothing_operator(self, fwhm = None, iterations = None):
+        """
+        Smoothing operator of mesh, cached by kernel
+        Give fwhm to get gaussian operator over geodesic distances, or iterations to get neighbourhood averaging operator
+
+        Parameters:
+        -----------
+        fwhm: full width at half maximum of gaussian kernel, in mm
+        iterations: iteration number of neighbourhood averaging
+
+        Return:
+        -------
+        operator: n_vertex x n_vertex CSR matrix
+        """
+        if (fwhm is None) == (iterations is None):
+            raise Exception('Please give one of fwhm and iterations')
+        if fwhm is not None:
+            key = ('gaussian', float(fwhm))
+            if key not in self._cache:
+                self._cache[key] = mesh_tools.gaussian_operator(self.geodesic_adjacency, fwhm)
+        else:
+            key = ('average', int(iterations))
+            if key not in self._cache:
+                self._cache[key] = mesh_tools.average_operator(self.adjacency, iterations)
+        return self._cache[key]
+
+    def smooth(self, data, fwhm = None, iterations = None):
+        """
+        Smooth surface data (n_vertex, or n_vertex x n_subj matrix at once), see smoothing_operator
+
+        Example:
+        --------
+        >>> smoothed = mesh.smooth(zstat_stack, fwhm = 4.0)
+        """
+        return mesh_tools.smooth(data, self.smoothing_operator(fwhm, iterations))
+
+    def _face_cross(self):
+        """
+        Cross product of two edges of each face, its norm equals to twice the face area
+        """
+        v0 = self.coords[self.faces[:, 0]]
+        return np.cross(self.coords[self.faces[:, 1]] - v0, self.coords[self.faces[:, 2]] - v0)
+
+def _safe_norm(vectors):
+    """
+    Norm of row vectors, zero norm is replaced by 1 to avoid division by zero
+    """
+    norm = np.linalg.norm(vectors, axis = 1, keepdims = True)
+    norm[norm == 0] = 1
+    return norm
@@ -7,7 +7,7 @@ from scipy import stats
 import nibabel as nib
 from scipy.spatial.distance import pdist
 
-from ATT.algorithm import vol_tools, tools, vol_roimethod
+from ATT.algorithm import vol_tools, tools, vol_roimethod, label_tools
 from ATT.util import plotfig
 from ATT.iofunc import iofiles
 
@@ -320,23 +320,28 @@ class EvaluateMap(object):
         Evaluate drawing accuracy by dice coefficient
         -------------------------------------------
         Parameters:
-            data1, data2: raw data
+            data1, data2: raw data, or their label_tools.LabelIndex
             filename: if save, output file name. By default is dice.pkl 
         Output:
             dice: dice coefficient
         """
-        if data1.ndim != data2.ndim:
+        lblindex1 = label_tools.as_labelindex(data1)
+        lblindex2 = label_tools.as_labelindex(data2)
+        if len(lblindex1.shape) != len(lblindex2.shape):
             raise Exception('Two raw data need have the same dimensions')
-        label1 = np.unique(data1)[1:]
-        label2 = np.unique(data2)[1:]
-        label = np.sort(np.unique(np.concatenate((label1, label2))))
-        if data1.ndim == 3:
-            data1 = np.expand_dims(data1, axis = 3)
-        if data2.ndim == 3:
-            data2 = np.expand_dims(data2, axis = 3)
-        dice = []
-        for i in range(data1.shape[3]):
-            dice.append(vol_tools.caldice(data1[...,i], data2[...,i], label))
+        label = np.union1d(lblindex1.labels, lblindex2.labels)
+        nsubj = lblindex1.shape[3] if len(lblindex1.shape) == 4 else 1
+        dice = np.empty((nsubj, label.size))
+        for j, lbl in enumerate(label):
+            roiloc1 = lblindex1.roi(lbl)
+            roiloc2 = lblindex2.roi(lbl)
+            # the last axis (subject) varies fastest in flat indices
+            size1 = np.bincount(roiloc1 % nsubj, minlength = nsubj)
+            size2 = np.bincount(roiloc2 % nsubj, minlength = nsubj)
+            common = np.intersect1d(roiloc1, roiloc2, assume_unique = True)
+            intersection = np.bincount(common % nsubj, minlength = nsubj)
+            with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                dice[:, j] = 2.0*intersection/(size1 + size2)
         dice = np.array(dice)
         if self.issave:
             iofactory = iofiles.IOFactory()
@@ -354,17 +359,22 @@ class PositionRelationship(object):
     Note that we recommend you giving numbers of roi so to avoid mess.
     ---------------------------------------------------
     Parameters:
-        roimask: roi label data
+        roimask: roi label data, or its label_tools.LabelIndex
         roinumber: the number of roi in your label data
     """
     def __init__(self, roimask, roinumber = None):
-        try:
-            roimask.shape
-        except AttributeError:
-            roimask = nib.load(roimask).get_data()
-        finally:
-            self._roimask = roimask
-        self._masklabel = np.unique(roimask)[1:]
+        if isinstance(roimask, label_tools.LabelIndex):
+            lblindex = roimask
+            roimask = lblindex.toarray()
+        else:
+            try:
+                roimask.shape
+            except AttributeError:
+                roimask = nib.load(roimask).get_data()
+            lblindex = label_tools.LabelIndex(roimask)
+        self._roimask = roimask
+        self._lblindex = lblindex
+        self._masklabel = lblindex.labels
         if roinumber is None:
             self._roinumber = self._masklabel.size
         else:
@@ -397,10 +407,9 @@ class PositionRelationship(object):
             templabel = np.array(range(1,tempnumber+1))
         overlaparray = np.empty((templabel.size, self._roinumber))
         
-        roiloc = np.transpose(np.nonzero(self._roimask))
-        tup_roiloc = map(tuple, roiloc)
-        tempextlabel_all = np.array([template[i] for i in tup_roiloc])
-        roiextlabel_all = np.array([self._roimask[i] for i in tup_roiloc])
+        roiloc = np.unravel_index(self._lblindex.indices, self._lblindex.shape)
+        tempextlabel_all = template[roiloc]
+        roiextlabel_all = np.repeat(self._masklabel, self._lblindex.sizes)
         tempextlabel = np.delete(tempextlabel_all, np.where(tempextlabel_all==0))
         roiextlabel = np.delete(roiextlabel_all, np.where(tempextlabel_all==0))
         uni_tempextlbl = np.unique(tempextlabel)
@@ -408,14 +417,14 @@ class PositionRelationship(object):
             for j, valj in enumerate(range(1, 1+self._roinumber)):
                 if para == 'percent':
                     try:
-                        overlaparray[i,j] = 1.0*tempextlabel[(tempextlabel == vali)*(roiextlabel == valj)].size/self._roimask[self._roimask == valj].size
+                        overlaparray[i,j] = 1.0*tempextlabel[(tempextlabel == vali)*(roiextlabel == valj)].size/self._lblindex.size(valj)
                     except ZeroDivisionError:
                         overlaparray[i,j] = np.nan
                 elif para == 'amount':
                     overlaparray[i,j] = tempextlabel[(tempextlabel == vali)*(roiextlabel == valj)].size
                 elif para == 'dice':
                     try:
-                        overlaparray[i,j] = 2.0*tempextlabel[(tempextlabel == vali)*(roiextlabel == valj)].size/(template[template == vali].size + self._roimask[self._roimask == valj].size)
+                        overlaparray[i,j] = 2.0*tempextlabel[(tempextlabel == vali)*(roiextlabel == valj)].size/(template[template == vali].size + self._lblindex.size(valj))
                     except ZeroDivisionError:
                         overlaparray[i,j] = np.nan
                 else:
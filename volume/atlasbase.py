@@ -5,7 +5,7 @@ import numpy as np
 import os
 import nibabel as nib
 import copy
-from ATT.algorithm import vol_roimethod, vol_tools, tools
+from ATT.algorithm import vol_roimethod, vol_tools, tools, label_tools
 from ATT.iofunc import iofiles
 
 class ImageCalculator(object):
@@ -108,7 +108,7 @@ class ImageCalculator(object):
         Relabel roi image, convert discontinous label image into label-continue image
         --------------------------
         Parameters:
-            roiimg: roi image
+            roiimg: roi image, or its label_tools.LabelIndex
 
         Output:
             relabelimg: relabeling image with continous label sequence
@@ -117,12 +117,15 @@ class ImageCalculator(object):
         Example:
             >>> relabelimg, corr_label = m.relabel_roi(roiimg)
         """
-        relabelimg = np.zeros_like(roiimg)
-        rawlabel = np.sort(np.unique(roiimg))[1:].astype('int')
+        if isinstance(roiimg, label_tools.LabelIndex):
+            rawlabel = roiimg.labels
+            relabelimg = np.zeros(roiimg.shape, dtype = roiimg.dtype)
+            relabelimg.flat[roiimg.indices] = np.repeat(np.arange(1, rawlabel.size+1), roiimg.sizes)
+        else:
+            relabelimg, rawlabel = label_tools.relabel_consecutive(roiimg)
+        rawlabel = rawlabel.astype('int')
         newlabel = np.array(range(1, len(rawlabel)+1)).astype('int')
-        corr_label = zip(rawlabel, newlabel)
-        for i,e in enumerate(rawlabel):
-            relabelimg[roiimg==e] = newlabel[i]
+        corr_label = list(zip(rawlabel, newlabel))
         return relabelimg, corr_label
 
 class ExtractSignals(object):
@@ -236,19 +239,20 @@ class MakeMasks(object):
                 factory.save_nifti(pm, self._header)
         return pm
 
-    def makempm(self, threshold, pmfile = None, maskname = 'mpm.nii.gz'):
+    def makempm(self, threshold, pmfile = None, maskname = 'mpm.nii.gz', consider_baseline = False):
         """
         Make maximum probabilistic maps
         --------------------------------
         Parameters:
             threshold: mpm threshold
             maskname: output mask name. By default is 'mpm.nii.gz'
+            consider_baseline: whether discard voxels that contain several probabilities with sum lower than 0.5. By default is False
         """
         if pmfile is not None:
             self._pm = pmfile
         if self._pm is None:
             raise Exception('please execute makepm first or give pmfile in this method')
-        mpm = vol_roimethod.make_mpm(self._pm, threshold)
+        mpm = vol_roimethod.make_mpm(self._pm, threshold, consider_baseline)
         if self._issave is True:
             iofactory = iofiles.IOFactory()
             factory = iofactory.createfactory(self._savepath, maskname)